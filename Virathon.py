@@ -1,28 +1,56 @@
 #! /usr/bin/env python3
 #Virathon: Genomic Analysis of Viruses of Archaea and Bacteria
 from collections import defaultdict
+from collections import OrderedDict
 from Bio import SeqIO
 from Bio import SearchIO
 #from Bio.SeqUtils import gc_fraction
-from Bio.SeqUtils import GC
 from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
 #from matplotlib import pyplot as plt
 import pandas as pd
+import numpy as np
+import scipy.sparse
+import scipy.io
 #import seaborn as sns
 import argparse
 import subprocess
 import re
+import csv
+import io
 import glob
 import gzip
+import hashlib
+import json
+import pickle
 import os
+import shutil
+import filecmp
+import tempfile
+import time
+import multiprocessing
+import threading
+import concurrent.futures
+from array import array
+try:
+    import pyarrow
+    import pyarrow.parquet
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--genome_files", help="File of genomic sequences", type =str, nargs="+")
 parser.add_argument("--cds_files", help="File of CDS protein sequences", type =str, nargs="+")
 parser.add_argument("--gene_files", help="File of CDS DNA sequences", type =str, nargs="+")
 parser.add_argument("--in_format", help="Input Sequence file format", default="fasta", type =str)
+parser.add_argument("--chunk_size", help="Number of lines read at a time when parsing large tabular outputs of external programs", default=1000000, type=int)
+parser.add_argument("--max_pairs_in_memory", help="Maximum number of genome pair partial scores kept in memory while parsing tabular search outputs before spilling them to disk", default=20000000, type=int)
+parser.add_argument("--io_buffer_size", help="Size (in bytes) of the blocks used when reading and writing sequence files", default=16777216, type=int)
 parser.add_argument("--info_output", help="The output table file with the generated data for the genomic sequences", default="Seq_Info.tsv", type =str)
+parser.add_argument("--output_format", help="Format of the output tables (Seq_Info, OG tables, abundance tables, Host_Genomes_Info and Coord_Info): tsv, parquet or feather (Arrow IPC). The .tsv extension of the output files is replaced by .parquet or .feather. Parquet and feather require pyarrow", default="tsv", type=str, choices=['tsv','parquet','feather'])
+parser.add_argument("--output_compression", help="Compression of parquet and feather output tables: zstd, lz4 or none (snappy and gzip are also valid for parquet)", default="zstd", type=str)
+parser.add_argument("--output_row_group_size", help="Number of rows per row group (parquet) or record batch (feather) of the output tables", default=131072, type=int)
 parser.add_argument("--rename_seqs", help="Flag to rename genomic sequences while indexing. CDS and Gene sequence files cannot be renamed.", default=False, type=bool)
 parser.add_argument("--string_rename", help="String to use when renaming genomics sequences", default='Seq_', type=str)
 parser.add_argument("--min_length", help="Minimum genomic sequence length", default=0, type=int)
@@ -33,17 +61,23 @@ parser.add_argument("--call_vibrant_module", help="Flag to run the VIBRANT modul
 parser.add_argument("--call_checkv_module", help="Flag to run the CheckV module", default=False, type=bool)
 parser.add_argument("--call_vhmnet_module", help="Flag to run the VirHostMatcher-Net module", default=False, type=bool)
 parser.add_argument("--call_virsorter2_module", help="Flag to run the VirSorter2 module", default=False, type=bool)
+parser.add_argument("--split_batch_size", help="Maximum number of files per subdirectory when splitting the viral genomes into one file per sequence for VirHostMatcher-Net, which is then run once per subdirectory. 0 keeps all the files in a single directory", default=0, type=int)
 parser.add_argument("--vhmnet_mode_short", help="Flag to run the VirHostMatcher-Net using the --short-contig flag", default=False, type=bool)
 parser.add_argument("--phist_host_prediction", help="Flag to run the PHIST module for host prediction", default=False, type=bool)
 parser.add_argument("--putative_host_genomes_directory", help="Directory containing fasta files of putative host genomes to be used by the PHIST module for host prediction", type=str)
 parser.add_argument("--extension_putative_host_genomes", help="Extension of the fasta files in the directory containing putative host genomes", type=str, default="fasta")
 parser.add_argument("--remove_exact_matches", help="Flag to remove exact matches with viral sequences from putative host genomes before running PHIST. Useful for when hostgs might be contaminaded with viral sequences or contain prophages", default=False, type=bool)
+parser.add_argument("--host_catalogue", help="Directory of a persistent catalogue of the putative host genomes used with --remove_exact_matches. It keeps the host sequence table, the BLAST database and the masked host genomes, which are only updated for new or modified host genome files", default='NA', type=str)
 parser.add_argument("--call_rafah", help="Flag to run the RaFAH module for host prediction", default=False, type=bool)
 parser.add_argument("--call_vpf_class", help="Flag to run the VPF-class module for taxonomic assingment and host prediction", default=False, type=bool)
 parser.add_argument("--vpf_class_yaml", help=".yaml file necessary to run vpf_class",  default='/mnt/lustre/bio/users/fcoutinho/VPF_Class_Files/data-index.yaml', type=str)
 parser.add_argument("--rafah_min_score", help="Minimum RaFAH score to consider a prediction as valid", default=0, type=float)
 parser.add_argument("--metabat2", help="Flag to perform sequence binning through Metabat2", default=False, type=bool)
 parser.add_argument("--make_pops_module", help="Flag to run the viral population pipeline", default=False, type=bool)
+parser.add_argument("--vp_min_ani", help="Minimum ANI between two genomes to assign them to the same viral population", default=95, type=float)
+parser.add_argument("--vp_min_matched", help="Minimum number of matched genes between two genomes to assign them to the same viral population", default=3, type=int)
+parser.add_argument("--vp_min_perc_matched", help="Minimum percentage of matched genes between two genomes to assign them to the same viral population", default=80, type=float)
+parser.add_argument("--pops_catalogue", help="Directory of a persistent viral population catalogue. If the directory holds a catalogue only the genes of new genomes are searched against its representatives, and new genomes are assigned to its VPs or to new ones. Otherwise the catalogue is created from the results of the viral population module", default='NA', type=str)
 parser.add_argument("--make_plots_module", help="Flag to run the Plotting module based on the collected Seq Info", default=False, type=bool)
 parser.add_argument("--pairwise_protein_scores", help="Flag to run the Paiwise Protein Scores (PPS) module", default=False, type=bool)
 parser.add_argument("--pps_subject_fasta", help="Fasta file containing the subject protein sequences to be used by the PPS module", default='NA', type=str)
@@ -58,6 +92,7 @@ parser.add_argument("--og_phylogeny", help="Flag to run the Orthologous Group ph
 parser.add_argument("--call_hmmer", help="Flag to query the CDS file against a hmmer database", default=False, type=bool)
 parser.add_argument("--hmmer_db", help="Hmmer DB file prefix", default=False, type=str)
 parser.add_argument("--hmmer_program", help="Hmmer program to run (hmmscan or hmmsearch)", default='hmmsearch', type=str)
+parser.add_argument("--hmmer_shards", help="Number of hmmsearch/hmmscan processes to run concurrently, each on a part of the queries (the HMMs for hmmsearch and the proteins for hmmscan). The threads are divided among them", default=1, type=int)
 parser.add_argument("--hmmer_min_score", help="Minimum Hmmer score to consider a match as valid", default=50, type=float)
 parser.add_argument("--hmmer_max_evalue", help="Maximum Hmmer -evalue to consider a match as valid", default=0.001, type=float)
 #Bowtie2 Abundance options
@@ -65,6 +100,8 @@ parser.add_argument("--abundance_table", help="Flag to run the abundance calcula
 parser.add_argument("--abundance_rpkm", help="Flag to calculate abundance as RPKM", default=False, type=bool)
 parser.add_argument("--abundance_max_reads", help="Set a maximum number of reads per sample to be mapped by parsed by bowtie2. All other reads are ignored. Default behavior is to use all reads in the sample", default=0, type=int)
 parser.add_argument("--abundance_min_count", help="Set a minimum number of reads mapped to a sequence to consider include it in the abundance tables. Default behavior is to use all counts above 0", default=0, type=int)
+parser.add_argument("--abundance_keep_bam", help="Flag to keep the sorted and indexed BAM files of each sample group. Default behavior is to count mapped reads by streaming the bowtie2 output through samtools idxstats", default=False, type=bool)
+parser.add_argument("--mapping_threads_per_group", help="Number of threads used to map the reads of each sample group. Groups are mapped concurrently while there are enough threads (--threads) and RAM (--max_ram)", default=8, type=int)
 parser.add_argument("--bowtiedb", help="Prefix of Bowtie DB to use for abundance calculations instead of building from the genomes file", default='NA', type=str)
 parser.add_argument("--bowtie_mode", help="Alignment mode to run bowtie", default='sensitive', type=str)
 parser.add_argument("--bowtie_k", help="Value for the Bowtie2 -k parameter. If not specified will use default mode, i.e. look for all alignments and only report the best one(s)", default=0, type=int)
@@ -75,225 +112,546 @@ parser.add_argument("--metagenomes_dir", help="Directories containing metagenome
 parser.add_argument("--metagenomes_extension", help="Extension of the fastq files in metagenomes_dir to be used for abundance calculation", default="fastq", type=str)
 parser.add_argument("--assemble", help="Flag to run the assembly module", default=False, type=bool)
 parser.add_argument("--min_cluster_size", help="The minimum number of proteins in a cluster to be used by the ogscoretable_module and ogphylogeny modules", default=3, type=int)
+parser.add_argument("--db_cache_dir", help="Directory where built databases (Bowtie2, BLAST, HMMER and MMseqs2) are cached and reused by later runs with the same input sequences and parameters", default='NA', type=str)
+parser.add_argument("--db_cache_max_size", help="Maximum size (in GB) of the database cache. The least recently used databases are removed when it is exceeded", default=100, type=float)
+parser.add_argument("--dense_table_max_cells", help="Maximum number of cells (Sequences x OGs) of the OG count and score tables written as dense tables. Larger tables are only written in the sparse Matrix Market format (.mtx)", default=100000000, type=int)
+parser.add_argument("--og_partition_memory", help="Memory (in MB) used to buffer protein sequences when splitting them into one fasta file per OG", default=1024, type=int)
 parser.add_argument("--threads", help="The number of threads to be used", default=1, type=int)
+parser.add_argument("--module_threads", help="Maximum number of threads given to each annotation module (e.g. VIBRANT, CheckV, VirSorter2) when they run concurrently", default=16, type=int)
+parser.add_argument("--module_ram", help="RAM (in GB) reserved for each annotation module running concurrently. The number of modules running at the same time is limited to --max_ram / --module_ram", default=4, type=float)
 parser.add_argument("--max_ram", help="The maxmimum RAM to be used during analysis", default=1, type=int)
+parser.add_argument("--resume", help="Flag to skip the stages that completed in a previous run (as recorded in --manifest_file) with the same inputs and parameters, and whose outputs were not modified since", default=False, type=bool)
+parser.add_argument("--manifest_file", help="JSON file recording the inputs, parameters, outputs and status of each stage of the run", default='Virathon_Manifest.json', type=str)
 parser.add_argument("--parse_only", help="Flag to skip running any programs and only parse their output using selected parameters", default=False, type=bool)
 args = parser.parse_args()
 
 
 #This is the main function that calls all the other functions according to the user specified parameters
 def central():
+    if ((args.output_format != 'tsv') and (pyarrow is None)):
+        exit(f'pyarrow is required to write the output tables in {args.output_format} format')
+    #Sequences of the viral population catalogue are identified by their IDs, and renamed IDs restart at Seq_1 on every run, so they would match sequences of previous runs
+    if ((args.pops_catalogue != 'NA') and ((args.rename_seqs == True) or (args.assemble == True))):
+        exit('--pops_catalogue can not be used with --rename_seqs or --assemble, as renamed sequence IDs are not unique across runs')
+    #Stages are recorded in the manifest so a run with --resume can skip the ones that are still valid
+    load_manifest()
     #Run the assembly module if specified by the user
     if (args.assemble == True):
         if ((args.genome_files) or (args.cds_files) or (args.gene_files)):
             print(f"WARNING! The sequences generated by the assembly will be used and any genome, cds, or gene files provided will be ignored.")  
-        args.genome_files = call_spades(raw_read_table=args.raw_read_table,spades_memory=args.max_ram)
+        args.genome_files = [run_stage('assembly',[args.raw_read_table],dict(stage_params('max_ram'),Read_Files=read_file_fingerprints(args.raw_read_table)),[],call_spades,raw_read_table=args.raw_read_table,spades_memory=args.max_ram)]
         #Scaffold generated by SPAdes must always be renamed
         args.rename_seqs = True
     #Run the index module for the genomic sequences, if provided
     if (args.genome_files):
         merged_genomes_file = 'All_Genomic.fasta'
-        index_seqs(in_seq_files=args.genome_files,rename_seqs=args.rename_seqs, seq_type="genomic", out_seq_file=merged_genomes_file)
+        run_stage('index_genomes',args.genome_files,stage_params('rename_seqs','string_rename','min_length','max_length','in_format'),[merged_genomes_file],index_seqs,in_seq_files=args.genome_files,rename_seqs=args.rename_seqs, seq_type="genomic", out_seq_file=merged_genomes_file)
         #print(f"Merged genomic seqs file: {merged_genomes_file}")
     #Some functions will fail if no genes/cds file is provided. So prodigal is called if these files will be necessayr in the future, even if the user has nto specified so
     if ((args.gene_files == None) and (args.make_pops_module == True)):
         args.call_prodigal_module = True
     #Perform gene calling with prodigal through the call_prodigal function if specified by the user
     if (args.call_prodigal_module == True):
-        call_prodigal(merged_genomes_file)
+        run_stage('prodigal',[merged_genomes_file],{},[merged_cds_file,merged_genes_file,merged_gff_file],call_prodigal,merged_genomes_file)
         print('Generated files:',merged_cds_file,merged_genes_file,merged_gff_file)
         #Index gene and cds files generated by prodigal
-        index_seqs(in_seq_files=[merged_genes_file],rename_seqs=False, seq_type="gene")
-        index_seqs(in_seq_files=[merged_cds_file],rename_seqs=False, seq_type="cds")
+        run_stage('index_genes',[merged_genes_file],{},[],index_seqs,in_seq_files=[merged_genes_file],rename_seqs=False, seq_type="gene")
+        run_stage('index_cds',[merged_cds_file],{},[],index_seqs,in_seq_files=[merged_cds_file],rename_seqs=False, seq_type="cds")
     #Index gene and cds files supplid by the user, only when prodigal generated files have not been generated.
     else:
         if (args.gene_files):
-            index_seqs(in_seq_files=args.gene_files,rename_seqs=False, seq_type="gene", out_seq_file=merged_genes_file)
+            run_stage('index_genes',args.gene_files,stage_params('in_format'),[merged_genes_file],index_seqs,in_seq_files=args.gene_files,rename_seqs=False, seq_type="gene", out_seq_file=merged_genes_file)
         if (args.cds_files):
-            index_seqs(in_seq_files=args.cds_files,rename_seqs=False, seq_type="cds", out_seq_file=merged_cds_file)
+            run_stage('index_cds',args.cds_files,stage_params('in_format'),[merged_cds_file],index_seqs,in_seq_files=args.cds_files,rename_seqs=False, seq_type="cds", out_seq_file=merged_cds_file)
     #Cluster sequences into viral populations if specified by the user
     vpop_out_file = 'NA'
     if (args.make_pops_module):
-        vpop_out_file = make_pops(merged_genomes_file, merged_genes_file)
-    #If specified by the user perform virus prediction with VIBRANT and Index the results
-    bacphlip_out_file = 'NA'
+        pops_catalogue_inputs = glob.glob(f'{args.pops_catalogue}/Population_Assignments.tsv')
+        vpop_out_file = run_stage('make_pops',[merged_genomes_file,merged_genes_file]+pops_catalogue_inputs,stage_params('vp_min_ani','vp_min_matched','vp_min_perc_matched','pops_catalogue'),[],make_pops,merged_genomes_file, merged_genes_file)
+    #Annotation modules only read the merged genomic (and CDS) sequences, so they are run concurrently by run_annotation_modules and their results are parsed into seq_info afterwards
+    annotation_modules = []
     if (args.bacphlip == True):
-        (bacphlip_out_file) = call_bacphlip(merged_genomes_file)
-    #If specified by the user perform virus prediction with VirSorter2 and Index the results
-    virsorter_outfile = 'NA'
+        annotation_modules.append({'Name': 'bacphlip', 'Function': call_bacphlip, 'Args': [merged_genomes_file], 'Inputs': [merged_genomes_file], 'Params': {}, 'Depends': []})
     if (args.call_virsorter2_module == True):
-        (virsorter_outfile) = call_virsorter2(merged_genomes_file)
-    #If specified by the user perform virus prediction with VIBRANT and Index the results
-    vibrant_out_quality_file = 'NA'
-    vibrant_out_amg_file = 'NA'
+        annotation_modules.append({'Name': 'virsorter2', 'Function': call_virsorter2, 'Args': [merged_genomes_file], 'Inputs': [merged_genomes_file], 'Params': {}, 'Depends': []})
     if (args.call_vibrant_module == True):
-        (vibrant_out_quality_file,vibrant_out_amg_file) = call_vibrant(merged_genomes_file)
-    #If specified by the user perform virus genome QC with CheckV and Index the results
-    checkv_out_summary_file = 'NA'
+        annotation_modules.append({'Name': 'vibrant', 'Function': call_vibrant, 'Args': [merged_genomes_file], 'Inputs': [merged_genomes_file], 'Params': {}, 'Depends': []})
     if (args.call_checkv_module == True):
-        checkv_out_summary_file = call_checkv(merged_genomes_file)
-    rafah_out_file = 'NA'
+        annotation_modules.append({'Name': 'checkv', 'Function': call_checkv, 'Args': [merged_genomes_file], 'Inputs': [merged_genomes_file], 'Params': {}, 'Depends': []})
     if (args.call_rafah == True):
-        rafah_out_file = call_rafah(merged_genomes_file,args.cds,args.rafah_min_score)
-    phist_out_file = 'NA'
+        annotation_modules.append({'Name': 'rafah', 'Function': call_rafah, 'Args': [merged_genomes_file,merged_cds_file,args.rafah_min_score], 'Inputs': [merged_genomes_file,merged_cds_file], 'Params': stage_params('rafah_min_score'), 'Depends': []})
     if (args.phist_host_prediction == True):
-        phist_out_file = call_phist(genome_file=merged_genomes_file,putative_host_genomes_directory=args.putative_host_genomes_directory,extension_putative_host_genomes=args.extension_putative_host_genomes,remove_exact_matches=args.remove_exact_matches)
-    #If specified by the user perform virus host prediction through VirHostMatcher-Net and Index the results
-    vhmnet_out_dir = 'NA'
+        annotation_modules.append({'Name': 'phist', 'Function': call_phist, 'Args': [merged_genomes_file,args.remove_exact_matches,args.putative_host_genomes_directory,args.extension_putative_host_genomes], 'Inputs': [merged_genomes_file,args.putative_host_genomes_directory], 'Params': stage_params('extension_putative_host_genomes','remove_exact_matches','host_catalogue','output_format'), 'Depends': []})
     if (args.call_vhmnet_module == True):
-        vhmnet_out_dir = call_vhmnet(merged_genomes_file)
+        annotation_modules.append({'Name': 'vhmnet', 'Function': call_vhmnet, 'Args': [merged_genomes_file], 'Inputs': [merged_genomes_file], 'Params': stage_params('vhmnet_mode_short'), 'Depends': []})
+    if (args.call_vpf_class == True):
+        annotation_modules.append({'Name': 'vpf_class', 'Function': call_vpf_class, 'Args': [merged_genomes_file,args.vpf_class_yaml], 'Inputs': [merged_genomes_file,args.vpf_class_yaml], 'Params': {}, 'Depends': []})
+    if (args.metabat2 == True):
+        annotation_modules.append({'Name': 'metabat2', 'Function': call_metabat, 'Args': [merged_genomes_file], 'Inputs': [merged_genomes_file], 'Params': {}, 'Depends': []})
+    annotation_results = run_annotation_modules(annotation_modules)
+    #If specified by the user perform virus prediction with VIBRANT and Index the results
+    bacphlip_out_file = annotation_results.get('bacphlip','NA')
+    if (args.bacphlip == True):
+        parse_bacphlip(bacphlip_out_file)
+    #If specified by the user perform virus prediction with VirSorter2 and Index the results
+    virsorter_outfile = annotation_results.get('virsorter2','NA')
+    if (args.call_virsorter2_module == True):
+        parse_virsorter2(virsorter_outfile)
+    #If specified by the user perform virus prediction with VIBRANT and Index the results
+    (vibrant_out_quality_file,vibrant_out_amg_file) = annotation_results.get('vibrant',('NA','NA'))
+    #If specified by the user perform virus genome QC with CheckV and Index the results
+    checkv_out_summary_file = annotation_results.get('checkv','NA')
+    rafah_out_file = annotation_results.get('rafah','NA')
+    phist_out_file = annotation_results.get('phist','NA')
+    #If specified by the user perform virus host prediction through VirHostMatcher-Net and Index the results
+    vhmnet_out_dir = annotation_results.get('vhmnet','NA')
     #If specificed by the user (args.hmmer == True) run the hmmer module
     if (args.call_hmmer == True):
-        hmmer_search_outfile = call_hmmer(args.cds,args.hmmer_db,args.hmmer_program)
-        (genome_hmm_scores,pairwise_scores) = parse_hmmer_output(hmmer_search_outfile,args.hmmer_max_evalue,args.hmmer_min_score)
-        #Print pairwise_scores to og_score_table_out_file
-        pairwise_score_table_out_file = 'OG_Pairwise_Score_Table_'+hmmer_search_outfile+'.tsv'
-        pairwise_score_table_data_frame = pd.DataFrame.from_dict(pairwise_scores)
-        print(f'Printing OG x CDS pairwise scores table to {pairwise_score_table_out_file}')
-        pairwise_score_table_data_frame.to_csv(pairwise_score_table_out_file,sep="\t",na_rep='NA')
+        hmmer_search_outfile = run_stage('hmmer',[merged_cds_file,args.hmmer_db],stage_params('hmmer_program'),[],call_hmmer,merged_cds_file,args.hmmer_db,args.hmmer_program)
+        #Print the valid matches to pairwise_score_table_out_file. The query of hmmsearch is the HMM database and the query of hmmscan is the CDS file
+        pairwise_score_table_out_file = table_file_name('OG_Pairwise_Score_Table_'+hmmer_search_outfile+'.tsv')
+        hmmer_query_file = merged_cds_file if (args.hmmer_program == 'hmmscan') else args.hmmer_db
+        write_hmmer_tables(hmmer_search_outfile,hmmer_query_file,args.hmmer_max_evalue,args.hmmer_min_score,pairwise_score_table_out_file)
     #If specified by the user perform clustering of proteins into OGs and Index the results
     og_table_out_file = 'NA'
     if (args.call_ogtable_module == True):
-        (og_table_out_file) = make_og_table(merged_genomes_file,args.cds)
+        (og_table_out_file) = run_stage('og_table',[merged_cds_file],stage_params('output_format','dense_table_max_cells'),[],make_og_table,merged_genomes_file,merged_cds_file)
     #If specified by the user perform clustering of proteins into OGs, align OGs, convert to HMMs map CDS back to OGs with hmmscan and Index the results
     og_score_table_out_file = 'NA'
     if ((args.call_ogscoretable_module == True) or (args.og_phylogeny == True)):
-        og_score_table_out_file = make_og_score_table_and_phylogeny(merged_genomes_file,args.cds,args.min_cluster_size,args.call_ogscoretable_module,args.og_phylogeny)
+        og_score_table_out_file = run_stage('og_score_table',[merged_cds_file],stage_params('min_cluster_size','call_ogscoretable_module','og_phylogeny','output_format','dense_table_max_cells'),[],make_og_score_table_and_phylogeny,merged_genomes_file,merged_cds_file,args.min_cluster_size,args.call_ogscoretable_module,args.og_phylogeny)
     #If specified by the user perform binning  through Metabat2 and Index the results
-    metabat_out_file = 'NA'
-    if (args.metabat2 == True):
-        metabat_out_file = call_metabat(merged_genomes_file)
-        #If specified by the user perform binning  through Metabat2 and Index the results
+    metabat_out_file = annotation_results.get('metabat2','NA')
     abundance_out_file = 'NA'
     if (args.abundance_table == True):
-        abundance_out_file = calc_abundance(merged_genomes_file,args.bowtiedb,args.metagenomes_dir,args.metagenomes_extension,args.abundance_max_reads,args.bowtie_mode,args.abundance_min_count,args.raw_read_table)
+        abundance_out_file = run_stage('abundance',[merged_genomes_file,args.raw_read_table]+(args.metagenomes_dir or []),dict(stage_params('bowtiedb','bowtie_mode','bowtie_k','abundance_max_reads','abundance_min_count','abundance_rpkm','abundance_keep_bam','output_format'),Read_Files=read_file_fingerprints(args.raw_read_table)),[],calc_abundance,merged_genomes_file,args.bowtiedb,args.metagenomes_dir,args.metagenomes_extension,args.abundance_max_reads,args.bowtie_mode,args.abundance_min_count,args.raw_read_table)
     if (args.pairwise_protein_scores == True):
-        calc_pps(merged_genomes_file,merged_cds_file,args.pps_subject_fasta,args.pps_subject_db,args.pps_hits_table)
+        run_stage('pps',[merged_cds_file,args.pps_subject_fasta,args.pps_hits_table],stage_params('pps_subject_db','pps_min_aai','pps_min_matched','pps_min_perc_matched'),[],calc_pps,merged_genomes_file,merged_cds_file,args.pps_subject_fasta,args.pps_subject_db,args.pps_hits_table)
     if (args.call_vpf_class == True):
-        vpf_class_outfile = call_vpf_class(merged_genomes_file,args.vpf_class_yaml)
+        parse_vpf_class(annotation_results['vpf_class'])
     #Always print the results collected in seq_info
     print_results(seq_info,og_table_out_file,og_score_table_out_file,vibrant_out_quality_file,vibrant_out_amg_file,checkv_out_summary_file,vhmnet_out_dir,args.info_output,merged_genomes_file,metabat_out_file,rafah_out_file)
 
+def run_stage(stage,input_files,params,output_files,stage_function,*stage_args,**stage_kwargs):
+    #Run stage_function as a stage of the manifest and checkpoint seq_info once it completes. With --resume the stage is skipped, and seq_info restored from its checkpoint, if it completed before with the same inputs and parameters and its outputs are unchanged
+    #The key of each stage includes the key of the stage before it, so once a stage runs again all the following stages do too
+    params = json.dumps({'Previous_Stage': stage_chain['Key'], 'Parameters': params},sort_keys=True,default=str)
+    checkpoint_file = f'{checkpoint_dir}/{stage}.pkl'
+    (is_valid,input_hash) = check_stage(stage,input_files,params)
+    stage_chain['Key'] = input_hash
+    if ((is_valid) and (os.path.exists(checkpoint_file))):
+        print(f'Skipping stage {stage}: completed in a previous run with the same inputs and parameters')
+        seq_info.load(checkpoint_file)
+        return run_manifest['Stages'][stage]['Result']
+    record_stage(stage,input_hash,params,'running',output_files)
+    try:
+        result = stage_function(*stage_args,**stage_kwargs)
+    except BaseException:
+        record_stage(stage,input_hash,params,'failed',output_files)
+        raise
+    os.makedirs(checkpoint_dir,exist_ok=True)
+    seq_info.save(checkpoint_file)
+    record_stage(stage,input_hash,params,'complete',output_files+result_paths(result),result)
+    return result
+
+def run_annotation_modules(modules):
+    #Run annotation modules as a flat pool: every module only reads the merged sequence files, so a module starts as soon as there is a free slot. Each module is a dict with the Name, Function and Args of the call, and the Inputs and Params that define if it can be skipped with --resume
+    #A module may list the names of other modules in Depends to start only after they finished, but none of the current modules needs to
+    #Threads are split evenly among the modules running at the same time, and the number of modules running at the same time is limited by --max_ram / --module_ram
+    results = dict()
+    if (not modules):
+        return results
+    slots = max(1,min(len(modules),args.threads // max(1,args.module_threads),int(args.max_ram // max(args.module_ram,0.001))))
+    module_threads = max(1,args.threads // slots)
+    print(f'Running {len(modules)} annotation modules, {slots} at a time with {module_threads} threads each')
+    start_time = time.time()
+    #Keys are checked before any module runs, so the following stages depend on all of them
+    module_keys = []
+    for module in modules:
+        module['Params'] = json.dumps(module['Params'],sort_keys=True,default=str)
+        (module['Is_Valid'],module['Input_Hash']) = check_stage(module['Name'],module['Inputs'],module['Params'])
+        module_keys.append(module['Input_Hash'])
+    stage_chain['Key'] = hashlib.blake2b('\t'.join([stage_chain['Key']] + module_keys).encode(),digest_size=20).hexdigest()
+    pending = list(modules)
+    running = dict()
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=slots) as executor:
+        while ((pending) or (running)):
+            for module in list(pending):
+                if ((len(running) < slots) and (all(dependency in results for dependency in module['Depends']))):
+                    pending.remove(module)
+                    running[executor.submit(run_annotation_module,module,module_threads)] = module
+            #Modules left pending here depend on a module that failed
+            if (not running):
+                break
+            (finished,unfinished) = concurrent.futures.wait(running,return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                module = running.pop(future)
+                try:
+                    results[module['Name']] = future.result()
+                except Exception as error:
+                    print(f'Annotation module {module["Name"]} failed: {error}')
+                    failed.append(module['Name'])
+    print(f'Finished {len(results)} annotation modules in {time.time() - start_time:.1f} seconds')
+    if ((failed) or (pending)):
+        raise Exception(f'Annotation modules failed: {",".join(failed)}. Not run: {",".join(module["Name"] for module in pending)}')
+    return results
+
+def run_annotation_module(module,threads):
+    if (module['Is_Valid']):
+        print(f'Skipping annotation module {module["Name"]}: completed in a previous run with the same inputs and parameters')
+        return run_manifest['Stages'][module['Name']]['Result']
+    record_stage(module['Name'],module['Input_Hash'],module['Params'],'running',[])
+    start_time = time.time()
+    try:
+        result = module['Function'](*module['Args'],threads=threads)
+    except BaseException:
+        record_stage(module['Name'],module['Input_Hash'],module['Params'],'failed',[])
+        raise
+    print(f'Annotation module {module["Name"]} finished in {time.time() - start_time:.1f} seconds using {threads} threads')
+    record_stage(module['Name'],module['Input_Hash'],module['Params'],'complete',result_paths(result),result)
+    return result
+
+def result_paths(result):
+    #File paths returned by a stage, which are tracked as its outputs
+    return [value for value in (result if isinstance(result,(list,tuple)) else [result]) if ((isinstance(value,str)) and (value != 'NA'))]
+
+def run_command(stage,command,input_files,output_files):
+    #Run an external command as a stage of the manifest. With --resume it is skipped if it completed before with the same inputs and its outputs are unchanged. The number of threads is not part of the key
+    params = re.sub(' --?(num_)?(threads|cpu) \\d+','',command)
+    (is_valid,input_hash) = check_stage(stage,input_files,params)
+    if (is_valid):
+        print(f'Skipping {stage}: {command} completed in a previous run with the same inputs')
+        return 0
+    record_stage(stage,input_hash,params,'running',output_files)
+    return_code = subprocess.call(command, shell=True)
+    record_stage(stage,input_hash,params,'complete' if (return_code == 0) else 'failed',output_files)
+    return return_code
+
+def check_stage(stage,input_files,params):
+    #Without --resume the key of a stage only uses the size and modification time of its inputs, so input files are not read just to hash them. With --resume the content of the inputs is hashed, and stages recorded by a run without --resume are still valid if their inputs were not modified since
+    input_files = [input_file for input_file in input_files if ((input_file) and (input_file != 'NA'))]
+    if (args.resume == False):
+        return (False,hash_files(input_files,f'{stage}\t{params}',content=False))
+    input_hash = hash_files(input_files,f'{stage}\t{params}')
+    record = run_manifest['Stages'].get(stage)
+    is_valid = False
+    if ((record is not None) and (record['Status'] == 'complete')):
+        if ((record.get('Key_Type') == 'Fingerprint') and (record['Input_Hash'] == hash_files(input_files,f'{stage}\t{params}',content=False))):
+            #The following stages were keyed on this fingerprint hash
+            input_hash = record['Input_Hash']
+        if (record['Input_Hash'] == input_hash):
+            is_valid = all(file_fingerprint(output_file) == fingerprint for output_file,fingerprint in record['Outputs'].items())
+    return (is_valid,input_hash)
+
+def record_stage(stage,input_hash,params,status,output_files,result=None):
+    outputs = {output_file: file_fingerprint(output_file) for output_file in output_files if (os.path.exists(output_file))}
+    with manifest_lock:
+        run_manifest['Stages'][stage] = {'Status': status, 'Input_Hash': input_hash, 'Key_Type': 'Content' if (args.resume == True) else 'Fingerprint', 'Parameters': params, 'Outputs': outputs, 'Result': result, 'Updated': time.strftime('%Y-%m-%d %H:%M:%S')}
+        save_manifest()
+
+def stage_params(*arg_names):
+    return {arg_name: getattr(args,arg_name) for arg_name in arg_names}
+
+def file_fingerprint(file_path):
+    file_stat = os.stat(file_path)
+    return [file_stat.st_size,file_stat.st_mtime_ns]
+
+def read_file_fingerprints(raw_read_table):
+    #Sizes and modification times of the read files listed in raw_read_table. They are added to the parameters of the stages that read them, so replacing the reads invalidates those stages
+    if ((not raw_read_table) or (not os.path.exists(raw_read_table))):
+        return {}
+    raw_read_info_df = pd.read_csv(raw_read_table,sep='\t',header=0)
+    read_files = [read_file for column in ['R1','R2'] if (column in raw_read_info_df) for read_file in raw_read_info_df[column].dropna()]
+    return {read_file: file_fingerprint(read_file) if (os.path.exists(read_file)) else 'Missing' for read_file in read_files}
+
+def hash_files(input_files,header='',content=True):
+    #Hash of the content of the input files. The hash of each file is kept in the manifest along with its size and modification time, so unchanged files are only read once. With content=False only the sizes and modification times are hashed
+    #Directories are hashed by the names, sizes and modification times of their files
+    hasher = hashlib.blake2b(digest_size=20)
+    hasher.update(header.encode())
+    for input_file in input_files:
+        hasher.update(b'\n')
+        if (os.path.isdir(input_file)):
+            for (root,dirs,files) in sorted(os.walk(input_file)):
+                for file_name in sorted(files):
+                    hasher.update(f'{os.path.relpath(f"{root}/{file_name}",input_file)}\t{file_fingerprint(f"{root}/{file_name}")}\n'.encode())
+        elif ((os.path.exists(input_file)) and (content == False)):
+            hasher.update(f'{file_fingerprint(input_file)}'.encode())
+        elif (os.path.exists(input_file)):
+            hasher.update(file_content_hash(input_file).encode())
+        else:
+            hasher.update(f'Missing\t{input_file}'.encode())
+    return hasher.hexdigest()
+
+def file_content_hash(input_file,remember=True):
+    #remember=False skips the manifest, for callers that keep the hashes of many files themselves
+    fingerprint = file_fingerprint(input_file)
+    known_hash = run_manifest['File_Hashes'].get(os.path.abspath(input_file))
+    if ((remember == True) and (known_hash is not None) and (known_hash[0] == fingerprint)):
+        return known_hash[1]
+    hasher = hashlib.blake2b(digest_size=20)
+    with open(input_file,'rb') as IN:
+        while True:
+            block = IN.read(args.io_buffer_size)
+            if (not block):
+                break
+            hasher.update(block)
+    if (remember == True):
+        with manifest_lock:
+            run_manifest['File_Hashes'][os.path.abspath(input_file)] = [fingerprint,hasher.hexdigest()]
+    return hasher.hexdigest()
+
+def load_manifest():
+    if (os.path.exists(args.manifest_file)):
+        with open(args.manifest_file,'r') as IN:
+            run_manifest.update(json.load(IN))
+    run_manifest['Arguments'] = vars(args)
+
+def save_manifest():
+    #Written to a temporary file first so an interrupted run never leaves a truncated manifest. Annotation modules record their stages from several threads
+    with manifest_lock:
+        with open(f'{args.manifest_file}.tmp','w') as OUT:
+            json.dump(run_manifest,OUT,indent=1,default=str)
+        os.replace(f'{args.manifest_file}.tmp',args.manifest_file)
+
 def index_seqs(in_seq_files=[],seq_type=None,rename_seqs=False,out_seq_file=None):
     print("Running indexing module")
     seq_counter = 0
     filtered_seqs = 0
-    seen_ids= dict()
-    if (out_seq_file):
-        OUT = open(out_seq_file,'w', newline='')
-    #with open(out_seq_file, 'w', newline='') as OUT:
-    for seq_file in in_seq_files:
-        print ("Indexing sequences from",seq_file)
-        #Iterate over sequences in the file. Collect basic Info
-        for seqobj in SeqIO.parse(seq_file, args.in_format):
-            #The seq_counter value is incremented regardless of teh sequence passing any filters, to it is easier to backtrack to the original file, even if the sequence is renamed later
-            seq_passed = True
-            seq_counter += 1
-            if (seq_counter % 100000 == 0):
-                print(f"\tProcessed {seq_counter} sequences")
-            #Record description, length,  file source, and GC for genomic sequences only
-            if (seq_type == 'genomic'):
-                #Check sequence length  
-                seq_length = len(seqobj.seq)
-                if ((seq_length >= args.min_length) and (seq_length <= args.max_length)):
-                    #Rename genomic sequences if specified by the user. Only sequences that pass the length filter will be in the seq_info dict and listed in the output table.  
-                    if (rename_seqs == True):
-                        new_id = args.string_rename+str(seq_counter)
-                        seq_info['Original_ID'][new_id] = seqobj.id
-                        seqobj.id = new_id
-                    #Collect info for the passed sequences
-                    seq_info['Description'][seqobj.id] = seqobj.description
-                    seq_info['GC'][seqobj.id] = round(GC(seqobj.seq),2)
-                    seq_info['Length'][seqobj.id] = seq_length
-                    seq_info['Original_File'][seqobj.id] = seq_file
-                else:
-                    #Skip genomic sequences outside the length range
-                    filtered_seqs += 1
-                    seq_passed = False
-                    #print(f"FILTERED OUT: {seqobj.id} LEN: {seq_length} PASS: {seq_passed}")
-            elif (seq_type == 'cds'):
-                [scaffold_id,cds_num] = seqobj.id.rsplit('_',1)
-                if (scaffold_id not in seq_info['CDS_Count']):
-                    seq_info['CDS_Count'][scaffold_id] = 0
-                #Increment cds count of the scaffold
-                seq_info['CDS_Count'][scaffold_id] += 1
-            elif (seq_type == 'gene'):
-                [scaffold_id,cds_num] = seqobj.id.rsplit('_',1)
-                if (scaffold_id not in seq_info['Gene_Count']):
-                    seq_info['Gene_Count'][scaffold_id] = 0
-                #Increment gene count of the scaffold
-                seq_info['Gene_Count'][scaffold_id] += 1
-            #Do not allow duplicated sequence IDs
-            if (seqobj.id in seen_ids):
-                raise Exception(f'Duplicated ID: {seqobj.id} in {seq_file}')
-            seen_ids[seqobj.id] = True
-            if ((seq_passed == True) and (out_seq_file)):
-                #print(f"{seqobj.id} LEN: {seq_length} PASS: {seq_passed}")
-                SeqIO.write(seqobj, OUT, "fasta")
-    if (out_seq_file):
-        OUT.close()
+    seen_ids = set()
+    #Each file is indexed by index_seq_file, in parallel when more than one thread and file are available. Renamed IDs depend on the position of each sequence across all files, so the number of sequences in each file is counted first to find the offset of its counter
+    counter_offsets = [0] * len(in_seq_files)
+    processes = min(args.threads,len(in_seq_files))
+    if ((seq_type == 'genomic') and (rename_seqs == True) and (len(in_seq_files) > 1)):
+        if (processes > 1):
+            with multiprocessing.Pool(processes=processes) as pool:
+                file_seq_counts = pool.starmap(count_seq_records,[(seq_file,args.in_format,args.io_buffer_size) for seq_file in in_seq_files])
+        else:
+            file_seq_counts = [count_seq_records(seq_file,args.in_format,args.io_buffer_size) for seq_file in in_seq_files]
+        for i in range(1,len(in_seq_files)):
+            counter_offsets[i] = counter_offsets[i-1] + file_seq_counts[i-1]
+    #Workers write passing sequences to one part file per input file, which are concatenated in the input order afterwards. A serial run appends directly to the merged file
+    jobs = []
+    part_files = []
+    for i,seq_file in enumerate(in_seq_files):
+        out_part_file = None
+        out_mode = 'wb'
+        if ((out_seq_file) and (processes > 1)):
+            out_part_file = f'{out_seq_file}.part_{i}'
+            part_files.append(out_part_file)
+        elif (out_seq_file):
+            out_part_file = out_seq_file
+            if (i > 0):
+                out_mode = 'ab'
+        jobs.append((seq_file,seq_type,rename_seqs,counter_offsets[i],out_part_file,out_mode,args.min_length,args.max_length,args.string_rename,args.in_format,args.io_buffer_size))
+    if (processes > 1):
+        print(f"Indexing {len(in_seq_files)} files using {processes} processes")
+        with multiprocessing.Pool(processes=processes) as pool:
+            file_results = pool.starmap(index_seq_file,jobs)
+    else:
+        file_results = [index_seq_file(*job) for job in jobs]
+    #Merge the results from each file in the input order
+    for file_info in file_results:
+        seq_file = file_info['File']
+        seq_counter += file_info['Seq_Count']
+        filtered_seqs += file_info['Filtered_Count']
+        #Do not allow duplicated sequence IDs. Duplicates within a file are already caught by the worker
+        if (not seen_ids.isdisjoint(file_info['IDs'])):
+            duplicated_id = next(seq_id for seq_id in file_info['IDs'] if seq_id in seen_ids)
+            raise Exception(f'Duplicated ID: {duplicated_id} in {seq_file}')
+        seen_ids.update(file_info['IDs'])
+        if (seq_type == 'genomic'):
+            passed_ids = file_info['Passed_IDs']
+            if (rename_seqs == True):
+                seq_info['Original_ID'].assign(passed_ids,file_info['Original_IDs'])
+            seq_info['Description'].assign(passed_ids,file_info['Descriptions'])
+            seq_info['GC'].assign(passed_ids,np.frombuffer(file_info['GC'],dtype=np.float64))
+            seq_info['Length'].assign(passed_ids,np.frombuffer(file_info['Lengths'],dtype=np.int64))
+            seq_info['Original_File'].assign(passed_ids,seq_file)
+        elif (seq_type in ['cds','gene']):
+            count_column = 'CDS_Count' if (seq_type == 'cds') else 'Gene_Count'
+            seq_info[count_column].increment(list(file_info['Scaffold_Counts'].keys()),list(file_info['Scaffold_Counts'].values()))
+    if (part_files):
+        with open(out_seq_file,'wb') as OUT:
+            for out_part_file in part_files:
+                with open(out_part_file,'rb') as IN:
+                    shutil.copyfileobj(IN,OUT,args.io_buffer_size)
+                os.remove(out_part_file)
     
     print(f'Processed {seq_counter} {seq_type} sequences.')
     print(f"Merged {seq_type} file: {out_seq_file}")
     if (filtered_seqs > 0):
         print(f'Filtered {filtered_seqs} sequences with length outside the specified range.')
 
+def index_seq_file(seq_file,seq_type,rename_seqs,counter_offset,out_seq_file,out_mode,min_length,max_length,string_rename,in_format,block_size):
+    #Index the sequences of a single file. This runs in the worker processes of index_seqs, so it does not touch seq_info and returns compact per-file results instead
+    file_info = {'File': seq_file, 'Seq_Count': 0, 'Filtered_Count': 0, 'IDs': [], 'Passed_IDs': [], 'Original_IDs': [], 'Descriptions': [], 'Lengths': array('q'), 'GC': array('d'), 'Scaffold_Counts': defaultdict(int)}
+    seen_ids = set()
+    seq_counter = counter_offset
+    #Passing records are collected as raw bytes and written to the output file in large blocks
+    out_buffer = []
+    out_buffer_size = 0
+    if (out_seq_file):
+        OUT = open(out_seq_file,out_mode)
+    print ("Indexing sequences from",seq_file)
+    #Iterate over sequences in the file. Collect basic Info
+    for (seq_id,description,seq,body) in iter_seq_records(seq_file,in_format,block_size):
+        #The seq_counter value is incremented regardless of teh sequence passing any filters, to it is easier to backtrack to the original file, even if the sequence is renamed later
+        seq_passed = True
+        seq_counter += 1
+        file_info['Seq_Count'] += 1
+        if (file_info['Seq_Count'] % 100000 == 0):
+            print(f"\tProcessed {file_info['Seq_Count']} sequences from {seq_file}")
+        #Record description, length,  file source, and GC for genomic sequences only
+        if (seq_type == 'genomic'):
+            #Check sequence length  
+            seq_length = len(seq)
+            if ((seq_length >= min_length) and (seq_length <= max_length)):
+                #Rename genomic sequences if specified by the user. Only sequences that pass the length filter will be in the seq_info dict and listed in the output table.  
+                if (rename_seqs == True):
+                    file_info['Original_IDs'].append(seq_id)
+                    seq_id = string_rename+str(seq_counter)
+                #Collect info for the passed sequences
+                file_info['Passed_IDs'].append(seq_id)
+                file_info['Descriptions'].append(description)
+                file_info['GC'].append(calc_gc(seq))
+                file_info['Lengths'].append(seq_length)
+            else:
+                #Skip genomic sequences outside the length range
+                file_info['Filtered_Count'] += 1
+                seq_passed = False
+        elif (seq_type in ['cds','gene']):
+            [scaffold_id,cds_num] = seq_id.rsplit('_',1)
+            #Increment cds or gene count of the scaffold
+            file_info['Scaffold_Counts'][scaffold_id] += 1
+        #Do not allow duplicated sequence IDs
+        if (seq_id in seen_ids):
+            raise Exception(f'Duplicated ID: {seq_id} in {seq_file}')
+        seen_ids.add(seq_id)
+        file_info['IDs'].append(seq_id)
+        if ((seq_passed == True) and (out_seq_file)):
+            record = format_fasta_record(seq_id,description,body)
+            out_buffer.append(record)
+            out_buffer_size += len(record)
+            if (out_buffer_size >= block_size):
+                OUT.write(b''.join(out_buffer))
+                out_buffer = []
+                out_buffer_size = 0
+    if (out_seq_file):
+        OUT.write(b''.join(out_buffer))
+        OUT.close()
+    file_info['Scaffold_Counts'] = dict(file_info['Scaffold_Counts'])
+    return file_info
+
+def count_seq_records(seq_file,in_format="fasta",block_size=16777216):
+    #Count the records of a sequence file. For FASTA this is a bulk count of the lines starting with > 
+    if (in_format != 'fasta'):
+        return sum(1 for seqobj in SeqIO.parse(seq_file, in_format))
+    seq_count = 0
+    last_byte = b'\n'
+    with open(seq_file,'rb') as IN:
+        while True:
+            block = IN.read(block_size)
+            if (not block):
+                break
+            seq_count += (last_byte + block).count(b'\n>')
+            last_byte = block[-1:]
+    return seq_count
+
+def scan_fasta(seq_file,block_size=16777216):
+    #Stream the records of a FASTA file as raw (header,body) byte strings. The file is read in large blocks that are only split at record boundaries (a newline followed by >), so no SeqRecord objects are built
+    pending = [b'\n']
+    pending_size = 1
+    with open(seq_file,'rb') as IN:
+        while True:
+            block = IN.read(block_size)
+            if (not block):
+                break
+            #Look for the last record boundary in the new block, including one that starts at the last byte of the previous block
+            boundary = (pending[-1][-1:] + block).rfind(b'\n>')
+            if (boundary < 0):
+                #Records longer than a block are accumulated and joined only once
+                pending.append(block)
+                pending_size += len(block)
+                continue
+            data = b''.join(pending) + block
+            cut = pending_size - 1 + boundary
+            #The first element is either empty or holds any text preceding the first record, which SeqIO also ignores
+            for record in data[:cut].split(b'\n>')[1:]:
+                yield split_fasta_record(record)
+            pending = [data[cut:]]
+            pending_size = len(pending[0])
+    for record in b''.join(pending).split(b'\n>')[1:]:
+        yield split_fasta_record(record)
+
+def split_fasta_record(record):
+    (header,sep,body) = record.partition(b'\n')
+    return (header.rstrip(),body)
+
+def iter_seq_records(seq_file,in_format="fasta",block_size=16777216):
+    #Yield (id,description,sequence,body) for each record, where body holds the sequence lines to be copied to merged files. FASTA files go through the byte level scanner and any other format is read with SeqIO
+    if (in_format == 'fasta'):
+        for (header,body) in scan_fasta(seq_file,block_size):
+            description = header.decode()
+            seq_id = description.split(None,1)[0] if description else ''
+            yield (seq_id,description,body.translate(None,b' \t\r\n'),body)
+    else:
+        for seqobj in SeqIO.parse(seq_file, in_format):
+            seq = bytes(seqobj.seq)
+            yield (seqobj.id,seqobj.description,seq,wrap_sequence(seq))
+
+def wrap_sequence(seq,width=60):
+    return b'\n'.join(seq[i:i+width] for i in range(0,len(seq),width))
+
+def format_fasta_record(seq_id,description,body):
+    #Build the header the same way SeqIO does: the description is used as is when it starts with the ID, otherwise the ID is prepended to it
+    if ((description) and (description.split(None,1)[0] == seq_id)):
+        title = description
+    elif (description):
+        title = f'{seq_id} {description}'
+    else:
+        title = seq_id
+    body = body.rstrip(b'\r\n')
+    if (body):
+        return b'>' + title.encode() + b'\n' + body + b'\n'
+    return b'>' + title.encode() + b'\n'
+
+def calc_gc(seq):
+    #GC content (%) of a sequence in bytes, counting G, C and S in either case like Bio.SeqUtils.GC
+    if (len(seq) == 0):
+        return 0.0
+    gc = len(seq) - len(seq.translate(None,b'GCgcSs'))
+    return round((gc * 100.0 / len(seq)),2)
+
 def print_results(info_dict,og_table_out_file,og_score_table_out_file,vibrant_out_quality_file,vibrant_out_amg_file,checkv_out_summary_file,vhmnet_out_dir,output_dataframe_file,merged_genomes_file,metabat_out_file,rafah_out_file):
-    #Convert the 2d dictionary info_dict into a pandas dataframe and print it to output_dataframe_file in .tsv format
-    info_dataframe = pd.DataFrame.from_dict(info_dict)
+    #Convert the SeqInfoTable info_dict into a pandas dataframe and print it to output_dataframe_file in .tsv format
+    info_dataframe = info_dict.to_dataframe()
     info_dataframe.index.name = 'Sequence'
+    annotator_frames = []
     #If VIBRANT was run the results should be indexed and merged to the final seq_info data frame. Do it first for the quality table
     #Notice that VIBRANT indexes the sequences by ID and Desc and appends _fragment_# to the scaffolds found as lysogens as part of longer contigs. This means that a discrepancy is created between the identifiers in Seq_Info and the VIBRANT tables
     if ((args.call_vibrant_module == True) and (vibrant_out_quality_file != 'NA')):
         vibrant_info_data_frame = index_info(vibrant_out_quality_file,'scaffold')
-        lysogen_count = 0
-        compiled_obj = re.compile('_fragment_(\\d)+$')
-        for i,row in vibrant_info_data_frame.iterrows():
-            frag_match = re.search(compiled_obj,i)
-            clean_name = i.split(' ')[0]
-            #print('Match:',frag_match)
-            if (frag_match):
-                clean_name = clean_name+frag_match[0]
-                lysogen_count += 1
-                #print('Matched a fragment!',i,frag_match,'Updated Clean Name:',clean_name)
-            vibrant_info_data_frame = vibrant_info_data_frame.rename(index={i:clean_name})
+        lysogen_count = int(pd.Series(vibrant_info_data_frame.index,dtype=object).str.contains('_fragment_\\d+$',regex=True).sum())
+        vibrant_info_data_frame.index = normalize_vibrant_ids(vibrant_info_data_frame.index)
         vibrant_info_data_frame = vibrant_info_data_frame[vibrant_info_data_frame.Quality != 'complete circular']
         vibrant_info_data_frame['VIBRANT_Is_Virus'] = True
-        #print('Filtered Quality Shape Is',vibrant_info_data_frame.shape,'Unique', vibrant_info_data_frame.index.is_unique)
-        frames = [info_dataframe,vibrant_info_data_frame]
-        info_dataframe = pd.concat(frames,axis=1)
+        annotator_frames.append(vibrant_info_data_frame)
         if (lysogen_count > 0):
             print(f'Warning! {lysogen_count} Lysogenic fragments found as part of longer scaffolds. If you are also running the index module there will be additional rows in the Seq Info file to accomodate these fragments.')
     #Now do the same but with the AMG table
     if ((args.call_vibrant_module == True) and (vibrant_out_amg_file != 'NA')):
         vibrant_info_data_frame = index_info(vibrant_out_amg_file,'protein')
-        vibrant_amg_dict = defaultdict(dict)
-        compiled_obj = re.compile('_fragment_(\\d)+$')
-        for i,row in vibrant_info_data_frame.iterrows():
-            scaffold = row['scaffold']
-            clean_name = scaffold.split(' ')[0]
-            frag_match = re.search(compiled_obj,scaffold)
-            if (frag_match):
-                clean_name = clean_name+frag_match[0]
-            amg_ko = row['AMG KO']
-            #print(clean_name,amg_ko)
-            if (clean_name not in vibrant_amg_dict['AMG_Count']):
-                vibrant_amg_dict['AMG_Count'][clean_name] = 1
-                vibrant_amg_dict['AMG_List'][clean_name] = [amg_ko]
-            else:
-                vibrant_amg_dict['AMG_Count'][clean_name]+= 1
-                vibrant_amg_dict['AMG_List'][clean_name].append(amg_ko)
-        
-        amg_data_frame = pd.DataFrame.from_dict(vibrant_amg_dict)
-        #print('AMG Shape Is',amg_data_frame.shape,'Unique', amg_data_frame.index.is_unique)
-        frames = [info_dataframe,amg_data_frame]
-        info_dataframe = pd.concat(frames,axis=1)
+        #Count and list the AMG KOs of each scaffold, in the order they are reported
+        amg_groups = pd.Series(vibrant_info_data_frame['AMG KO'].to_numpy(),dtype=object).groupby(normalize_vibrant_ids(vibrant_info_data_frame['scaffold']).to_numpy(),sort=False)
+        amg_data_frame = pd.DataFrame({'AMG_Count': amg_groups.size(), 'AMG_List': amg_groups.agg(list)})
+        annotator_frames.append(amg_data_frame)
         
     #If checkV was run the results should be indexed and merged to the final seq_info data frame
     if ((args.call_checkv_module == True) and (checkv_out_summary_file != 'NA')):
         checkv_info_data_frame = index_info(checkv_out_summary_file,'contig_id')
-        frames = [info_dataframe,checkv_info_data_frame]
-        info_dataframe = pd.concat(frames,axis=1)
+        annotator_frames.append(checkv_info_data_frame)
     
     #If Metabat2 was run the results should be indexed and merged to the final seq_info data frame
     if ((args.metabat2 == True)  and (metabat_out_file != 'NA')):
@@ -301,82 +659,168 @@ def print_results(info_dict,og_table_out_file,og_score_table_out_file,vibrant_ou
         metabat_info_data_frame = metabat_info_data_frame.rename(columns={0: "Contig", 1: "Bin"})
         metabat_info_data_frame = metabat_info_data_frame.set_index('Contig')
         #print(metabat_info_data_frame.columns)
-        frames = [info_dataframe,metabat_info_data_frame]
-        info_dataframe = pd.concat(frames,axis=1)
+        annotator_frames.append(metabat_info_data_frame)
 
     #If RaFAH was run the results should be indexed and merged to the final seq_info data frame
     if ((args.call_rafah == True)  and (rafah_out_file != 'NA')):
         #table_file,index_col_name,sep_var='\t',header='infer'
         rafah_info_data_frame = index_info(rafah_out_file,'Variable','\t',0)
-        frames = [info_dataframe,rafah_info_data_frame]
-        info_dataframe = pd.concat(frames,axis=1)
+        annotator_frames.append(rafah_info_data_frame)
     
     #If VHMNet was run the results should be indexed and merged to the final seq_info data frame
     if ((args.call_vhmnet_module == True) and (vhmnet_out_dir != 'NA')):
-        vhmnet_out_pred_files = glob.glob(f'{vhmnet_out_dir}/predictions/*csv')
-        vhmnet_info_dict = defaultdict(dict)
-        for pred_file in vhmnet_out_pred_files:
-            scaffold = re.sub("(.)*/predictions/","",pred_file)
-            scaffold = re.sub("_prediction.csv","",scaffold)
-            vhmnet_info_data_frame = index_info(pred_file,'hostNCBIName',',',header=0)
-            #print(pred_file,scaffold)
-            for column in vhmnet_info_data_frame.columns:    
-                #print(pred_file,scaffold,column,vhmnet_info_data_frame[column][0])
-                if (vhmnet_info_data_frame[column][0] != 'NAmissing'):
-                    vhmnet_info_dict[f'VHMNet_{column}'][scaffold] = vhmnet_info_data_frame[column][0]
-        vhmnet_info_data_frame = pd.DataFrame.from_dict(vhmnet_info_dict)
-        frames = [info_dataframe,vhmnet_info_data_frame]
-        info_dataframe = pd.concat(frames,axis=1)
+        vhmnet_info_data_frame = read_vhmnet_predictions(vhmnet_out_dir)
+        annotator_frames.append(vhmnet_info_data_frame)
+    
+    #Join all the annotator tables to the sequence information at once
+    if (len(annotator_frames) > 0):
+        info_dataframe = pd.concat([info_dataframe]+annotator_frames,axis=1)
         
     #Print the dataframe with the complete seqinfo to specified file
     info_dataframe.index.name = 'Sequence'
-    info_dataframe.to_csv(output_dataframe_file,sep="\t",na_rep='NA')
+    output_dataframe_file = write_table(info_dataframe,output_dataframe_file)
+    print(f'Printing sequence info to {output_dataframe_file}')
     
     #If specified by the user generate plots with the info collected
     if (args.make_plots_module == True):
         make_plots(info_dataframe,merged_genomes_file,args.plots_output,og_table_out_file,og_score_table_out_file,args.plots_group_var)
 
-def explode_fasta(genome_file,split_genomes_dir):
-    os.makedirs(f"{split_genomes_dir}")
-    for seqobj in SeqIO.parse(genome_file, args.in_format):
-        seqid = seqobj.id
-        SeqIO.write(seqobj, f'{split_genomes_dir}/{seqobj.id}.fasta', "fasta")
+def read_vhmnet_predictions(vhmnet_out_dir):
+    #Collect the top ranked host of each scaffold from the VirHostMatcher-Net prediction files (one per scaffold) as VHMNet_* columns, leaving out NAmissing values and the columns that only have those
+    #Only the header and first row of each file are read, by a pool of workers, and all the rows are then parsed into a single DataFrame
+    vhmnet_out_pred_files = glob.glob(f'{vhmnet_out_dir}/predictions/*csv')
+    print(f'Reading {len(vhmnet_out_pred_files)} VirHostMatcher-Net prediction files from {vhmnet_out_dir}')
+    with multiprocessing.Pool(args.threads) as pool:
+        top_rows = pool.map(read_csv_top_row,vhmnet_out_pred_files,chunksize=max(1,len(vhmnet_out_pred_files) // (args.threads * 4)))
+    #Files are grouped by header, which is normally the same for all of them
+    header_rows = defaultdict(list)
+    for pred_file,(header,row) in zip(vhmnet_out_pred_files,top_rows):
+        if (row is not None):
+            scaffold = re.sub("_prediction.csv","",os.path.basename(pred_file))
+            header_rows[header].append((scaffold,row))
+    frames = []
+    missing_frames = []
+    for header,rows in header_rows.items():
+        csv_buffer = io.StringIO()
+        csv_writer = csv.writer(csv_buffer)
+        csv_writer.writerow(header)
+        csv_writer.writerows(row for scaffold,row in rows)
+        csv_buffer.seek(0)
+        #NAmissing is read as NaN so that numeric columns keep their types, and the missing values are found from the raw rows
+        frame = pd.read_csv(csv_buffer,sep=',',header=0,index_col='hostNCBIName',na_values=['NAmissing'])
+        frame.index = pd.Index([scaffold for scaffold,row in rows])
+        frames.append(frame)
+        missing_frames.append(pd.DataFrame([[value == 'NAmissing' for value in row] for scaffold,row in rows],index=frame.index,columns=header).drop(columns='hostNCBIName'))
+    if (len(frames) == 0):
+        return pd.DataFrame()
+    vhmnet_info_data_frame = pd.concat(frames)
+    #Columns missing from the header of a file are treated as NAmissing in its row
+    is_missing = pd.concat(missing_frames).reindex(columns=vhmnet_info_data_frame.columns).fillna(True).to_numpy(dtype=bool)
+    #Columns are ordered by the first file with a value in them, as they were when added one file at a time
+    first_valid_file = (~is_missing).argmax(axis=0)
+    column_order = sorted([column_pos for column_pos in range(len(vhmnet_info_data_frame.columns)) if ((~is_missing[:,column_pos]).any())],key=lambda column_pos: first_valid_file[column_pos])
+    vhmnet_info_data_frame = vhmnet_info_data_frame.mask(is_missing).iloc[:,column_order]
+    vhmnet_info_data_frame.columns = [f'VHMNet_{column}' for column in vhmnet_info_data_frame.columns]
+    return vhmnet_info_data_frame
+
+def read_csv_top_row(csv_file):
+    #Header and first row of a csv file. The row is None if the file has no rows
+    with open(csv_file,newline='') as IN:
+        csv_reader = csv.reader(IN)
+        header = next(csv_reader,[])
+        row = next(csv_reader,None)
+    return (tuple(header),row)
+
+def split_genomes(genome_file,split_genomes_dir,batch_size=0,threads=1):
+    #Write each sequence of genome_file to its own fasta file in split_genomes_dir, as expected by PHIST and VirHostMatcher-Net. With batch_size above 0 the files are spread over the subdirectories Batch_1, Batch_2, ... of up to batch_size files each. Returns the directories holding the files
+    #The split is reused while the content of genome_file and batch_size do not change, as recorded in {split_genomes_dir}.Split_Info.tsv
+    split_info_file = f'{split_genomes_dir}.Split_Info.tsv'
+    split_info = {'Input_Hash': file_content_hash(genome_file), 'Batch_Size': str(batch_size)}
+    if ((os.path.exists(split_info_file)) and (os.path.isdir(split_genomes_dir))):
+        with open(split_info_file) as IN:
+            previous_split_info = dict(line.rstrip('\n').split('\t',1) for line in IN if line.strip())
+        if ((all(previous_split_info.get(key) == value for key,value in split_info.items())) and (str(count_split_files(split_genomes_dir)) == previous_split_info.get('File_Count'))):
+            print(f'Reusing the split sequences of {genome_file} in {split_genomes_dir}')
+            return list_split_dirs(split_genomes_dir,batch_size)
+        os.remove(split_info_file)
+    #Files left from another split would be taken as queries, so the directory is written from scratch
+    if (os.path.exists(split_genomes_dir)):
+        shutil.rmtree(split_genomes_dir)
+    os.makedirs(split_genomes_dir)
+    print(f'Splitting {genome_file} into one file per sequence in {split_genomes_dir}')
+    #Records are read by a single reader and written in chunks by a pool of threads, with at most two chunks per thread waiting
+    seq_count = 0
+    out_dir = split_genomes_dir
+    chunk = []
+    pending_writes = set()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1,threads)) as executor:
+        for (seq_id,description,seq,body) in iter_seq_records(genome_file,args.in_format,args.io_buffer_size):
+            if ((batch_size > 0) and (seq_count % batch_size == 0)):
+                out_dir = f'{split_genomes_dir}/Batch_{(seq_count // batch_size) + 1}'
+                os.makedirs(out_dir)
+            chunk.append((f'{out_dir}/{seq_id}.fasta',format_fasta_record(seq_id,description,wrap_sequence(seq))))
+            seq_count += 1
+            if (len(chunk) >= 1000):
+                if (len(pending_writes) >= 2 * max(1,threads)):
+                    (finished_writes,pending_writes) = concurrent.futures.wait(pending_writes,return_when=concurrent.futures.FIRST_COMPLETED)
+                    for finished_write in finished_writes:
+                        finished_write.result()
+                pending_writes.add(executor.submit(write_split_files,chunk))
+                chunk = []
+        pending_writes.add(executor.submit(write_split_files,chunk))
+        for finished_write in concurrent.futures.as_completed(pending_writes):
+            finished_write.result()
+    split_info['File_Count'] = str(count_split_files(split_genomes_dir))
+    with open(split_info_file,'w') as OUT:
+        for key,value in split_info.items():
+            OUT.write(f'{key}\t{value}\n')
+    print(f'Wrote {seq_count} sequences to {split_genomes_dir}')
+    return list_split_dirs(split_genomes_dir,batch_size)
 
-def call_phist(genome_file="",remove_exact_matches=False,putative_host_genomes_directory="",extension_putative_host_genomes="fasta"):
+def write_split_files(records):
+    for (out_file,record) in records:
+        with open(out_file,'wb') as OUT:
+            OUT.write(record)
+
+def count_split_files(split_genomes_dir):
+    return sum(len(files) for (root,dirs,files) in os.walk(split_genomes_dir))
+
+def list_split_dirs(split_genomes_dir,batch_size):
+    if (batch_size > 0):
+        return sorted(glob.glob(f'{split_genomes_dir}/Batch_*'),key=lambda batch_dir: int(batch_dir.rsplit('_',1)[1]))
+    return [split_genomes_dir]
+
+def call_phist(genome_file="",remove_exact_matches=False,putative_host_genomes_directory="",extension_putative_host_genomes="fasta",threads=None):
+    if (threads is None):
+        threads = args.threads
     print("Running PHIST host prediction module")
     #If specified run the module to remove exact matches from putative hosts genomes
     if (remove_exact_matches == True):
         hostg_files = glob.glob(f"{putative_host_genomes_directory}/*{extension_putative_host_genomes}")
         hostg_count = len(hostg_files)
-        print(f"Merging and indexing sequences from {hostg_count} host genome files")
-        #Merge all host genome sequences in All_Host_Seqs.fasta. Iterate over each sequence and collect basic info
-        host_seq_info = defaultdict(dict)
         host_genome_info = defaultdict(lambda: defaultdict(int))
-        if (args.parse_only == False):
-            OUT = open("All_Host_Seqs.fasta",'w', newline='')
-        file_counter = 0
-        for hostg in hostg_files:
-            file_counter += 1
-            if (file_counter % 1000 == 0):
-                print(f"\tProcessed {file_counter} host genome files")
-            for seqobj in SeqIO.parse(hostg, 'fasta'):
-                host_genome_info['Sequence_Count'][hostg] += 1
-                host_genome_info['Bp_Count'][hostg] += len(seqobj.seq)
+        if (args.host_catalogue != 'NA'):
+            #Reuse the sequence table and BLAST database of the host catalogue, which are only updated for new or modified files
+            (host_files,host_seqs,host_blast_db_name) = update_host_catalogue(args.host_catalogue,hostg_files)
+        else:
+            print(f"Merging and indexing sequences from {hostg_count} host genome files")
+            #Merge all host genome sequences in All_Host_Seqs.fasta. Iterate over each sequence and collect basic info
+            (host_files,host_seqs) = merge_host_genomes(hostg_files,"All_Host_Seqs.fasta" if (args.parse_only == False) else None)
+            if (args.parse_only == False):
+                print(f"Merged Host genome sequences written to All_Host_Seqs.fasta")
+            #Query viral genomes against putative host genomes using BLASTN
+            print(f"Building BLASTN database of host sequences")
+            host_blast_db_name = build_blast_db(input_file="All_Host_Seqs.fasta")
+        for hostg,file_stats in host_files.set_index('Host_Genome').reindex(hostg_files).iterrows():
+            if (file_stats['Sequence_Count'] > 0):
+                host_genome_info['Sequence_Count'][hostg] = int(file_stats['Sequence_Count'])
+                host_genome_info['Bp_Count'][hostg] = int(file_stats['Bp_Count'])
                 host_genome_info['Virus_List'][hostg] = set()
                 host_genome_info['Virus_Regions'][hostg] = []
-                host_seq_info["Source"][seqobj.id] = "Host"
-                host_seq_info["Genome"][seqobj.id] = hostg
-                host_seq_info["Length"][seqobj.id] = len(seqobj.seq)
-                if (args.parse_only == False):
-                    SeqIO.write(seqobj, OUT, "fasta")
-        if (args.parse_only == False):
-            OUT.close()
-            print(f"Merged Host genome sequences written to All_Host_Seqs.fasta")
-        #Query viral genomes against putative host genomes using BLASTN
-        print(f"Building BLASTN database of host sequences")
-        host_blast_db_name = build_blast_db(input_file="All_Host_Seqs.fasta")
+        #Sequence IDs repeated in different files are assigned to the last one
+        host_seqs = host_seqs[~host_seqs.index.duplicated(keep='last')]
         print(f"Querying viral sequences against host sequences using BLASTN")
-        blast_result = call_blast(query=genome_file,ref_db=host_blast_db_name)
+        blast_result = call_blast(query=genome_file,ref_db=host_blast_db_name,threads=threads)
         #Iterate over BLASTN output and index results
         coord_info = defaultdict(dict)
         seen_pairs = defaultdict(dict)
@@ -390,8 +834,9 @@ def call_phist(genome_file="",remove_exact_matches=False,putative_host_genomes_d
                     #Check if the HSP passes established blast cutoffs
                     viral_genome = qresult.id
                     host_seq = hit.id
-                    hostg = host_seq_info["Genome"][hit.id]
                     is_valid = check_match_cutoff(hsp,0.00001,500,100,seq_info["Length"][viral_genome])
+                    if (is_valid == True):
+                        hostg = host_seqs.at[host_seq,'Host_Genome']
                     if ((is_valid == True) and (viral_genome not in seen_pairs[hostg].keys())):
                         host_genome_info['Prophage_Count'][hostg] += 1
                         host_genome_info['Prophage_Base_Pairs'][hostg] += seq_info["Length"][viral_genome]
@@ -406,164 +851,399 @@ def call_phist(genome_file="",remove_exact_matches=False,putative_host_genomes_d
                         coord_info["Start_Host_Sequence"][valid_count] = int(hsp.hit_start) + 1
                         coord_info["End_Host_Sequence"][valid_count] = hsp.hit_end
                         full_sequence = False
-                        if (hsp.aln_span >= host_seq_info["Length"][host_seq]):
+                        if (hsp.aln_span >= host_seqs.at[host_seq,'Length']):
                             full_sequence = True
                         coord_info["Full_Viral_Sequence"][valid_count] = full_sequence
 
-        print("Printing host genome info to Host_Genomes_Info.tsv")
+        print(f"Printing host genome info to {table_file_name('Host_Genomes_Info.tsv')}")
         hostg_info_df = pd.DataFrame.from_dict(host_genome_info)
         hostg_info_df.index.name = 'Host_Genome'
-        hostg_info_df.to_csv("Host_Genomes_Info.tsv",sep="\t",na_rep=0)
+        write_table(hostg_info_df,"Host_Genomes_Info.tsv",na_rep=0)
 
-        print("Printing virus exact match info to Coord_Info.tsv")
+        print(f"Printing virus exact match info to {table_file_name('Coord_Info.tsv')}")
         coord_info_df = pd.DataFrame.from_dict(coord_info)
         coord_info_df.index.name = 'Match_Num'
-        coord_info_df.to_csv("Coord_Info.tsv",sep="\t",na_rep=0)
+        write_table(coord_info_df,"Coord_Info.tsv",na_rep=0)
         
         #Iterate over the host genome sequences removing viral sequences
         print(f"Removing viral Sequences from host genomes")
         putative_host_genomes_directory = "No_Vir_Host_Genomes/"
         os.makedirs(putative_host_genomes_directory,exist_ok=True)
-        for hostg in hostg_files:
-            #print('Processing',hostg)
-            hostg_nid = putative_host_genomes_directory +"No_Vir_"+get_prefix(hostg,"DUMMY")
-            with open(hostg_nid, 'w', newline='') as OUT:
-                for seqobj in SeqIO.parse(hostg, 'fasta'):
-                    original_seq = seqobj.seq
-                    full_length = len(seqobj.seq)
-                    index_length = full_length - 1
-                    if ("Host_Sequence" in coord_info_df):
-                        sub_coord = coord_info_df[coord_info_df["Host_Sequence"] == seqobj.id]
-                    if (len(sub_coord) >= 1):
-                        for i,coord in sub_coord.iterrows():
-                            #print(coord)
-                            start_index = int(coord["Start_Host_Sequence"]) - 1
-                            stop_index = int(coord["End_Host_Sequence"]) - 1
-                            full_range = list(range(0,index_length))
-                            trim_range = list(range(start_index,stop_index))
-                            blacklist = {posit : True for posit in trim_range}
-                            trimmed_seq_nucs = []
-                            for nuc_posit in full_range:
-                                if nuc_posit in blacklist:
-                                    trimmed_seq_nucs.append("X")
-                                else:
-                                    trimmed_seq_nucs.append(original_seq[nuc_posit])
-                            original_seq = "".join(trimmed_seq_nucs)
-                        split_seqs = re.split("(X)+",original_seq)
-                        frag_count = 0 
-                        for split in split_seqs:
-                            frag_count += 1
-                            if (len(split) > 1):
-                                split_seq = SeqRecord(seq=Seq(split), id=seqobj.id+f"_Split_{frag_count}", name = seqobj.name, description=seqobj.description)
-                                SeqIO.write(split_seq, OUT, "fasta")
-                    else:
-                        SeqIO.write(seqobj, OUT, "fasta")
+        #Index the matches once by host genome file and host sequence, as 0 based (start,end) intervals of the bases to be masked
+        host_masked_regions = defaultdict(lambda: defaultdict(list))
+        for match_num,hostg in coord_info["Host_Genome"].items():
+            host_masked_regions[hostg][coord_info["Host_Sequence"][match_num]].append((coord_info["Start_Host_Sequence"][match_num] - 1,coord_info["End_Host_Sequence"][match_num] - 1))
+        if (args.host_catalogue != 'NA'):
+            link_masked_host_genomes(args.host_catalogue,host_files,host_masked_regions,putative_host_genomes_directory,threads)
+        else:
+            #PHIST runs in a thread of run_annotation_modules next to other modules, and forking a process with several threads may deadlock on locks held by the other threads, so workers are spawned instead
+            with multiprocessing.get_context('spawn').Pool(threads) as pool:
+                pool.starmap(mask_host_genome_file,[(hostg,putative_host_genomes_directory+"No_Vir_"+get_prefix(hostg,"DUMMY"),host_masked_regions.get(hostg,{})) for hostg in hostg_files])
     #Run PHIST
     if (args.parse_only == False):
         #Explode the fasta file of viral sequence genomes
         cwd = os.getcwd()
-        explode_fasta(genome_file,split_genomes_dir=f"{cwd}/Viral_Genomes_PHIST")
-        command=f"phist.py -t {args.threads} Viral_Genomes_PHIST/ {putative_host_genomes_directory} PHIST_Output/"
+        #PHIST takes all the viral genomes from a single directory
+        split_genomes(genome_file,f"{cwd}/Viral_Genomes_PHIST",0,threads)
+        command=f"phist.py -t {threads} Viral_Genomes_PHIST/ {putative_host_genomes_directory} PHIST_Output/"
         print(f"Running PHIST with command {command}")
         subprocess.call(command,shell=True)
     #Return results file
     return("/PHIST_Output/predictions.csv")
 
+def merge_host_genomes(hostg_files,out_seq_file=None):
+    #Copy the sequences of the host genome files to out_seq_file (if given). Returns the number of sequences and base pairs of each file and a table of the genome file and length of each sequence
+    file_rows = []
+    seq_ids = []
+    seq_genomes = []
+    seq_lengths = []
+    OUT = open(out_seq_file,'wb') if (out_seq_file != None) else None
+    for file_counter,hostg in enumerate(hostg_files,start=1):
+        if (file_counter % 1000 == 0):
+            print(f"\tProcessed {file_counter} host genome files")
+        file_seq_count = len(seq_ids)
+        file_bp_count = 0
+        for (seq_id,description,seq,body) in iter_seq_records(hostg,'fasta',args.io_buffer_size):
+            seq_ids.append(seq_id)
+            seq_genomes.append(hostg)
+            seq_lengths.append(len(seq))
+            file_bp_count += len(seq)
+            if (OUT != None):
+                OUT.write(format_fasta_record(seq_id,description,wrap_sequence(seq)))
+        file_rows.append((hostg,len(seq_ids) - file_seq_count,file_bp_count))
+    if (OUT != None):
+        OUT.close()
+    host_files = pd.DataFrame(file_rows,columns=['Host_Genome','Sequence_Count','Bp_Count'])
+    host_seqs = pd.DataFrame({'Host_Genome': pd.Categorical(seq_genomes), 'Length': np.array(seq_lengths,dtype=np.int64)},index=pd.Index(seq_ids,name='Sequence'))
+    return (host_files,host_seqs)
+
+def update_host_catalogue(catalogue_dir,hostg_files):
+    #Persistent index of a host genome directory, so later runs with --remove_exact_matches go straight to the BLASTN search. Host_Files.tsv holds the size, modification time, content hash, sequence counts and volume of each file, and each volume has a table of the genome file and length of its sequences (Host_Sequences_{volume}.tsv) and a BLAST database (DB_{volume}). DB_Host_Seqs is a BLAST alias of all the volumes
+    #Files are compared by size and modification time, and by content hash only if those changed. Volumes that hold modified or removed files are rebuilt and new files are added as new volumes, so the others are never read again
+    print(f'Updating host genome catalogue in {catalogue_dir}')
+    os.makedirs(catalogue_dir,exist_ok=True)
+    host_files = read_host_catalogue(catalogue_dir)
+    current_files = {os.path.basename(hostg): hostg for hostg in hostg_files}
+    dirty_volumes = set(host_files.loc[~host_files.index.isin(list(current_files.keys())),'Volume'])
+    next_volume = max([int(volume.replace('Volume_','')) for volume in host_files['Volume']] + [0]) + 1
+    new_files = []
+    for file_name,hostg in current_files.items():
+        if (file_name not in host_files.index):
+            new_files.append(file_name)
+            continue
+        (file_size,file_mtime) = file_fingerprint(hostg)
+        if ((file_size == host_files.at[file_name,'Size']) and (file_mtime == host_files.at[file_name,'Mtime_ns'])):
+            continue
+        if (file_content_hash(hostg,remember=False) == host_files.at[file_name,'Hash']):
+            #Only the modification time changed, e.g. the file was copied or touched
+            host_files.loc[file_name,['Size','Mtime_ns']] = [file_size,file_mtime]
+        else:
+            dirty_volumes.add(host_files.at[file_name,'Volume'])
+    host_files = host_files[host_files.index.isin(list(current_files.keys()))]
+    print(f'Found {len(new_files)} new host genome files and {len(dirty_volumes)} catalogue volumes with modified or removed files')
+    volume_jobs = [(volume,list(host_files.index[host_files['Volume'] == volume])) for volume in sorted(dirty_volumes)]
+    for first_file in range(0,len(new_files),host_catalogue_volume_size):
+        volume_jobs.append((f'Volume_{next_volume}',new_files[first_file:first_file+host_catalogue_volume_size]))
+        next_volume += 1
+    for (volume,file_names) in volume_jobs:
+        volume_files = build_host_volume(catalogue_dir,volume,[current_files[file_name] for file_name in file_names])
+        host_files = pd.concat([host_files[~host_files.index.isin(file_names)],volume_files])
+        #The table is saved after each volume, so an interrupted update keeps the volumes that were finished
+        write_host_catalogue(catalogue_dir,host_files)
+    volumes = sorted(set(host_files['Volume']),key=lambda volume: int(volume.replace('Volume_','')))
+    host_blast_db_name = f'{catalogue_dir}/DB_Host_Seqs'
+    if (((len(volume_jobs) > 0) or (not os.path.exists(f'{host_blast_db_name}.nal'))) and (len(volumes) > 0) and (args.parse_only == False)):
+        #Paths in the alias are relative to its directory
+        subprocess.call(f"blastdb_aliastool -dblist \"{' '.join('DB_'+volume for volume in volumes)}\" -dbtype nucl -out DB_Host_Seqs -title DB_Host_Seqs", shell=True, cwd=catalogue_dir)
+    write_host_catalogue(catalogue_dir,host_files)
+    host_seqs = pd.concat([pd.read_csv(f'{catalogue_dir}/Host_Sequences_{volume}.tsv',sep='\t',index_col='Sequence',dtype={'Sequence': str, 'File': str, 'Length': np.int64}) for volume in volumes]) if (volumes) else pd.DataFrame({'File': pd.Series(dtype=str), 'Length': pd.Series(dtype=np.int64)},index=pd.Index([],name='Sequence'))
+    #Sequences are sorted in the order of the files in this run, as they would be if the files were merged again
+    file_ranks = {os.path.basename(hostg): rank for rank,hostg in enumerate(hostg_files)}
+    host_seqs = host_seqs.iloc[np.argsort(host_seqs['File'].map(file_ranks).to_numpy(),kind='stable')]
+    host_seqs.insert(0,'Host_Genome',pd.Categorical(host_seqs['File'].map(current_files)))
+    host_seqs = host_seqs.drop(columns='File')
+    host_files['Host_Genome'] = host_files.index.map(current_files)
+    return (host_files,host_seqs,host_blast_db_name)
+
+def read_host_catalogue(catalogue_dir):
+    catalogue_file = f'{catalogue_dir}/Host_Files.tsv'
+    if (not os.path.exists(catalogue_file)):
+        return pd.DataFrame({'Size': pd.Series(dtype=np.int64), 'Mtime_ns': pd.Series(dtype=np.int64), 'Hash': pd.Series(dtype=str), 'Volume': pd.Series(dtype=str), 'Sequence_Count': pd.Series(dtype=np.int64), 'Bp_Count': pd.Series(dtype=np.int64), 'Masked_Regions': pd.Series(dtype=str)},index=pd.Index([],name='File',dtype=str))
+    return pd.read_csv(catalogue_file,sep='\t',index_col='File',dtype={'File': str, 'Hash': str, 'Volume': str, 'Masked_Regions': str},keep_default_na=False)
+
+def write_host_catalogue(catalogue_dir,host_files):
+    #Write to a temporary file first, so an interrupted run does not leave a truncated catalogue behind
+    catalogue_file = f'{catalogue_dir}/Host_Files.tsv'
+    host_files.drop(columns='Host_Genome',errors='ignore').to_csv(catalogue_file+'.tmp',sep='\t')
+    os.replace(catalogue_file+'.tmp',catalogue_file)
+
+def build_host_volume(catalogue_dir,volume,hostg_files):
+    #(Re)build a volume of the host catalogue from its files. Fingerprints and hashes are taken before reading the files, so a file modified in the meantime is read again in the next update
+    for old_file in glob.glob(f'{catalogue_dir}/DB_{volume}.*'):
+        os.remove(old_file)
+    fingerprints = [file_fingerprint(hostg) for hostg in hostg_files]
+    hashes = [file_content_hash(hostg,remember=False) for hostg in hostg_files]
+    volume_seq_file = f'{catalogue_dir}/{volume}.fasta'
+    (volume_files,volume_seqs) = merge_host_genomes(hostg_files,volume_seq_file)
+    if (len(hostg_files) > 0):
+        build_blast_db(input_file=volume_seq_file,out_db=f'{catalogue_dir}/DB_{volume}',use_cache=False)
+    os.remove(volume_seq_file)
+    volume_seqs = volume_seqs.rename(columns={'Host_Genome': 'File'})
+    volume_seqs['File'] = volume_seqs['File'].map(os.path.basename)
+    if (len(hostg_files) > 0):
+        volume_seqs.to_csv(f'{catalogue_dir}/Host_Sequences_{volume}.tsv',sep='\t')
+    elif (os.path.exists(f'{catalogue_dir}/Host_Sequences_{volume}.tsv')):
+        os.remove(f'{catalogue_dir}/Host_Sequences_{volume}.tsv')
+    print(f'Indexed {len(volume_seqs)} sequences from {len(hostg_files)} host genome files in catalogue volume {volume}')
+    volume_files = volume_files.drop(columns='Host_Genome')
+    volume_files.index = pd.Index([os.path.basename(hostg) for hostg in hostg_files],name='File')
+    volume_files.insert(0,'Size',[fingerprint[0] for fingerprint in fingerprints])
+    volume_files.insert(1,'Mtime_ns',[fingerprint[1] for fingerprint in fingerprints])
+    volume_files.insert(2,'Hash',hashes)
+    volume_files.insert(3,'Volume',volume)
+    volume_files['Masked_Regions'] = ''
+    return volume_files
+
+def link_masked_host_genomes(catalogue_dir,host_files,host_masked_regions,out_dir,threads):
+    #Masked copies of the host genome files with viral matches are kept in the catalogue and only written again when the file or its matched regions change. out_dir gets a link to the masked copy of each of those files and to the original file for all the others, which do not need to be copied
+    masked_dir = f'{catalogue_dir}/No_Vir_Host_Genomes'
+    os.makedirs(masked_dir,exist_ok=True)
+    mask_jobs = []
+    reused_count = 0
+    for file_name,hostg in host_files['Host_Genome'].items():
+        out_name = "No_Vir_"+get_prefix(hostg,"DUMMY")
+        masked_regions = host_masked_regions.get(hostg,{})
+        if (len(masked_regions) > 0):
+            regions_hash = hashlib.blake2b(json.dumps(sorted([seq_id,merge_intervals(intervals)] for seq_id,intervals in masked_regions.items())).encode(),digest_size=20).hexdigest()
+            regions_key = f"{host_files.at[file_name,'Hash']}:{regions_hash}"
+            link_target = os.path.abspath(f'{masked_dir}/{out_name}')
+            if ((host_files.at[file_name,'Masked_Regions'] != regions_key) or (not os.path.exists(link_target))):
+                mask_jobs.append((hostg,link_target,masked_regions))
+                host_files.at[file_name,'Masked_Regions'] = regions_key
+            else:
+                reused_count += 1
+        else:
+            link_target = os.path.abspath(hostg)
+        link_name = f'{out_dir}/{out_name}'
+        if (os.path.lexists(link_name)):
+            os.remove(link_name)
+        os.symlink(link_target,link_name)
+    print(f'Masking {len(mask_jobs)} host genome files. The masked copies of {reused_count} files were reused from the catalogue')
+    #Workers are spawned rather than forked, as this runs in a thread of run_annotation_modules. Spawning a pool is only worth it when there are files to mask
+    if (len(mask_jobs) > 0):
+        with multiprocessing.get_context('spawn').Pool(min(threads,len(mask_jobs))) as pool:
+            pool.starmap(mask_host_genome_file,mask_jobs)
+    write_host_catalogue(catalogue_dir,host_files)
+
+def mask_host_genome_file(host_genome_file,out_file,masked_regions):
+    #Print the sequences of a host genome file to out_file, replacing those with viral matches by the fragments left after removing the matched regions
+    #As in previous versions the last base of each sequence with matches and the last base of each match are kept out of the masking, existing runs of X also split sequences and fragments are numbered as _Split_1, _Split_3, ... with those of 1 base skipped
+    with open(out_file,'wb') as OUT:
+        for (seq_id,description,seq,body) in iter_seq_records(host_genome_file,'fasta',args.io_buffer_size):
+            if (seq_id not in masked_regions):
+                OUT.write(format_fasta_record(seq_id,description,wrap_sequence(seq)))
+                continue
+            masked_seq = bytearray(seq[:-1])
+            for (start,end) in merge_intervals(masked_regions[seq_id]):
+                start = max(start,0)
+                end = min(end,len(masked_seq))
+                if (end > start):
+                    masked_seq[start:end] = b'X' * (end - start)
+            for frag_num,fragment in enumerate(re.split(b'X+',bytes(masked_seq))):
+                if (len(fragment) > 1):
+                    OUT.write(format_fasta_record(f'{seq_id}_Split_{(2 * frag_num) + 1}',description,wrap_sequence(fragment)))
+
+def merge_intervals(intervals):
+    #Merge overlapping or adjacent (start,end) intervals
+    merged = []
+    for (start,end) in sorted(intervals):
+        if ((merged) and (start <= merged[-1][1])):
+            merged[-1][1] = max(merged[-1][1],end)
+        else:
+            merged.append([start,end])
+    return merged
+
 def get_prefix(file,extension):
     prefix_file = re.sub(f'(\\.)+{extension}$','',file)
     prefix_file = re.sub('(.)+/','',prefix_file)
     return prefix_file
 
-def build_blast_db(input_file="NA"):
+def build_blast_db(input_file="NA",out_db=None,use_cache=True):
     prefix_input_file = get_prefix(input_file,"(fasta)|(fa)|(fna)")
+    if (not out_db):
+        out_db = f"DB_{prefix_input_file}"
     if (args.parse_only == False):
         print('Building BLAST Nucleotide DB')
-        command = f'makeblastdb -in {input_file} -dbtype nucl -title DB_{prefix_input_file} -out DB_{prefix_input_file}'
-        subprocess.call(command, shell=True)
-    return(f"DB_{prefix_input_file}")
+        if (use_cache == True):
+            out_db = build_cached_db('makeblastdb',[input_file],f'-dbtype nucl -title DB_{prefix_input_file}',out_db,lambda db_name: f'makeblastdb -in {input_file} -dbtype nucl -title DB_{prefix_input_file} -out {db_name}')
+        else:
+            subprocess.call(f'makeblastdb -in {input_file} -dbtype nucl -title DB_{prefix_input_file} -out {out_db}', shell=True)
+    return(out_db)
+
+def build_cached_db(builder,input_files,build_params,out_db,build_command,copy_input=False):
+    #Run build_command(db_name) to build a database, or reuse one built before from the same input files and parameters if --db_cache_dir is set. Returns the path (prefix) of the database to use
+    #copy_input places a copy of the (single) input file at db_name before building, for builders such as hmmpress that write their index next to the input file
+    if (args.db_cache_dir == 'NA'):
+        subprocess.call(build_command(out_db), shell=True)
+        return out_db
+    #Entries are named by the hash of the builder, its parameters and the content of the input files
+    entry_hash = hash_files(input_files,f'{builder}\t{build_params}')
+    entry_dir = f'{args.db_cache_dir}/{builder}_{entry_hash}'
+    db_name = f'{entry_dir}/{os.path.basename(out_db)}'
+    if (os.path.exists(f'{entry_dir}/Cache_Entry.tsv')):
+        print(f'Database cache hit: reusing {builder} database of {",".join(input_files)} from {entry_dir}')
+        #The modification time of the entry marks when it was last used
+        os.utime(entry_dir)
+        return db_name
+    print(f'Database cache miss: building {builder} database of {",".join(input_files)} into {entry_dir}')
+    os.makedirs(args.db_cache_dir,exist_ok=True)
+    #Build in a temporary directory and rename it, so an entry is either complete or missing even if the run is interrupted
+    tmp_dir = tempfile.mkdtemp(prefix=f'Tmp_{builder}_',dir=args.db_cache_dir)
+    tmp_db_name = f'{tmp_dir}/{os.path.basename(out_db)}'
+    if (copy_input == True):
+        shutil.copyfile(input_files[0],tmp_db_name)
+    return_code = subprocess.call(build_command(tmp_db_name), shell=True)
+    if (return_code != 0):
+        shutil.rmtree(tmp_dir)
+        print(f'Warning: {builder} exited with code {return_code}. The database was not cached')
+        subprocess.call(build_command(out_db), shell=True)
+        return out_db
+    with open(f'{tmp_dir}/Cache_Entry.tsv','w') as OUT:
+        OUT.write(f'Builder\t{builder}\nParameters\t{build_params}\nInput_Files\t{",".join(os.path.abspath(input_file) for input_file in input_files)}\n')
+    try:
+        os.rename(tmp_dir,entry_dir)
+    except OSError:
+        #Another run stored the same entry in the meantime
+        shutil.rmtree(tmp_dir)
+    evict_db_cache(entry_dir)
+    return db_name
+
+def evict_db_cache(keep_entry):
+    #Remove the least recently used entries of the database cache until it fits in --db_cache_max_size
+    max_size = args.db_cache_max_size * (1024 ** 3)
+    entries = []
+    total_size = 0
+    for entry_dir in glob.glob(f'{args.db_cache_dir}/*/Cache_Entry.tsv'):
+        entry_dir = os.path.dirname(entry_dir)
+        entry_size = sum(os.path.getsize(f'{root}/{file_name}') for (root,dirs,files) in os.walk(entry_dir) for file_name in files)
+        entries.append((os.path.getmtime(entry_dir),entry_size,entry_dir))
+        total_size += entry_size
+    for (last_used,entry_size,entry_dir) in sorted(entries):
+        if (total_size <= max_size):
+            break
+        if (os.path.abspath(entry_dir) == os.path.abspath(keep_entry)):
+            continue
+        print(f'Removing least recently used database {entry_dir} from the cache ({entry_size / (1024 ** 3):.2f} GB)')
+        shutil.rmtree(entry_dir)
+        total_size -= entry_size
     
-def call_blast(query="NA",ref_db="NA"):
+def call_blast(query="NA",ref_db="NA",threads=None):
+    if (threads is None):
+        threads = args.threads
     prefix_query = get_prefix(query,"(fasta)|(fa)|(fna)")
     prefix_ref_db = get_prefix(ref_db,"")
     outfile = prefix_query+"x"+prefix_ref_db+".blastn"
     #Call blastn 
     if (args.parse_only == False):
         print('Performing BLASTN search')
-        command = f"blastn -db {ref_db} -query {query} -out {outfile} -outfmt 6 -evalue 0.00001 -perc_identity 30 -max_target_seqs 100 -num_threads {args.threads}"
+        command = f"blastn -db {ref_db} -query {query} -out {outfile} -outfmt 6 -evalue 0.00001 -perc_identity 30 -max_target_seqs 100 -num_threads {threads}"
         subprocess.call(command, shell=True)
     return(outfile)
 
-def call_virsorter2(genome_file):
+def call_virsorter2(genome_file,threads=None):
+    if (threads is None):
+        threads = args.threads
     prefix_genome_file = get_prefix(genome_file,args.in_format)
     if (args.parse_only == False):
         print('Running VirSorter2')
-        command = f'virsorter run --seqfile {genome_file} --jobs {args.threads} --prep-for-dramv --rm-tmpdir'
+        command = f'virsorter run --seqfile {genome_file} --jobs {threads} --prep-for-dramv --rm-tmpdir'
         subprocess.call(command, shell=True)
     virsorter_out_file = "final-viral-score.tsv"
+    return virsorter_out_file
+
+def parse_virsorter2(virsorter_out_file):
     virsorter_df = index_info(virsorter_out_file,"seqname",'\t',0)
-    virsorter_df_columns = virsorter_df.columns
-    compiled_obj = re.compile('\\|\\|full$')
-    for scaffold,row in virsorter_df.iterrows():
-        scaffold = re.sub(compiled_obj,'',scaffold)
-        seq_info["VirSorter_Is_Virus"][scaffold] = True
-        for col in virsorter_df_columns:
-            seq_info[f"VirSorter_{col}"][scaffold] = row[col]
+    virsorter_df.index = virsorter_df.index.astype(str).str.replace('\\|\\|full$','',regex=True)
+    assign_seq_info(virsorter_df,"VirSorter_",{"VirSorter_Is_Virus": True})
 
 
-def call_bacphlip(genome_file):
+def call_bacphlip(genome_file,threads=None):
     prefix_genome_file = get_prefix(genome_file,args.in_format)
     if (args.parse_only == False):
         print('Running Bacphlip')
         command = f'bacphlip -i {genome_file} --multi_fasta'
         subprocess.call(command, shell=True)
-    
     bacphlip_out_file = genome_file + '.bacphlip'
+    return bacphlip_out_file
+
+def parse_bacphlip(bacphlip_out_file):
     bacphlip_df = index_info(bacphlip_out_file,0,'\t',0)
     #print(bacphlip_df.columns)
     bacphlip_df = bacphlip_df.rename(columns={"Virulent" : "Lytic_Score", "Temperate": "Temperate_Score"})
     #print(bacphlip_df.columns)
     #bacphlip_df = bacphlip_df.set_index('Scaffold')
-    for scaffold,row in bacphlip_df.iterrows():
-        seq_info["Bacphlip_Lytic_Score"][scaffold] = row["Lytic_Score"]
-        seq_info["Bacphlip_Temperate_Score"][scaffold] = row["Temperate_Score"]
-        if (row["Lytic_Score"] >= row["Temperate_Score"]):
-            seq_info["Bacphlip_Classification"][scaffold] = "Lytic"
-        elif (row["Lytic_Score"] < row["Temperate_Score"]):
-            seq_info["Bacphlip_Classification"][scaffold] = "Lysogenic"
+    assign_seq_info(bacphlip_df[["Lytic_Score","Temperate_Score"]],"Bacphlip_")
+    #Sequences with missing scores are not classified
+    bacphlip_df = bacphlip_df[bacphlip_df["Lytic_Score"].notna() & bacphlip_df["Temperate_Score"].notna()]
+    seq_info["Bacphlip_Classification"].assign(bacphlip_df.index,np.where(bacphlip_df["Lytic_Score"] >= bacphlip_df["Temperate_Score"],"Lytic","Lysogenic"))
         
-def call_vpf_class(genome_file,yaml_file):
+def call_vpf_class(genome_file,yaml_file,threads=None):
+    if (threads is None):
+        threads = args.threads
     prefix_genome_file = get_prefix(genome_file,args.in_format)
+    vpf_out_dir = f'VPF_Class_{prefix_genome_file}'
     if (args.parse_only == False):
         print('Running vpf-class')
-        command = f'vpf-class --data-index {yaml_file} --input-seqs {genome_file} -o VPF_Class_{prefix_genome_file} --chunk-size 1000 --workers {args.threads}'
+        command = f'vpf-class --data-index {yaml_file} --input-seqs {genome_file} -o {vpf_out_dir} --chunk-size 1000 --workers {threads}'
         subprocess.call(command, shell=True)
-    
-    vpf_outfiles = glob.glob(f'VPF_Class_{prefix_genome_file}/*tsv')
+    return vpf_out_dir
+
+def parse_vpf_class(vpf_out_dir):
+    vpf_outfiles = glob.glob(f'{vpf_out_dir}/*tsv')
     for file in vpf_outfiles:
         var = file
-        var = re.sub(f'VPF_Class_{prefix_genome_file}/','',var)
+        var = re.sub(f'{vpf_out_dir}/','',var)
         var = re.sub('.tsv','',var)
         print ('Processing',file,var)
         vpfclass_info_data_frame = index_info(file,'virus_name','\t',0)
-        for scaffold,row in vpfclass_info_data_frame.iterrows():
-            mem_ratio = row['membership_ratio']
-            vh_score = row['virus_hit_score']
-            conf_score = row['confidence_score']
-            taxon = row['class_name']
-            if (scaffold not in seq_info['VPF_'+var]):
-                seq_info['VPF_'+var][scaffold] = taxon
-                seq_info['VPF_Membership_Ratio_'+var][scaffold] = mem_ratio
-                seq_info['VPF_Confidende_Score_'+var][scaffold] = conf_score
-                seq_info['VPF_Virus_Hit_Score_'+var][scaffold] = vh_score
-            elif (seq_info['VPF_Membership_Ratio_'+var][scaffold] < mem_ratio):
-                seq_info['VPF_'+var][scaffold] = taxon
-                seq_info['VPF_Membership_Ratio_'+var][scaffold] = mem_ratio
-                seq_info['VPF_Confidende_Score_'+var][scaffold] = conf_score
-                seq_info['VPF_Virus_Hit_Score_'+var][scaffold] = vh_score
-                
+        #Keep the class with the highest membership ratio of each scaffold, the first one in case of ties
+        best_classes = best_row_per_id(vpfclass_info_data_frame,'membership_ratio')
+        best_classes = best_classes[['class_name','membership_ratio','confidence_score','virus_hit_score']]
+        best_classes.columns = ['VPF_'+var,'VPF_Membership_Ratio_'+var,'VPF_Confidende_Score_'+var,'VPF_Virus_Hit_Score_'+var]
+        assign_seq_info(best_classes)
     return 0
 
-def call_rafah(genome_file,cds_file,min_score):
+def normalize_vibrant_ids(scaffolds):
+    #VIBRANT names scaffolds by ID and description and appends _fragment_# to the lysogens found as part of longer contigs. Keep the ID and the fragment suffix so that the names match Seq_Info
+    scaffolds = pd.Series(scaffolds,dtype=object)
+    fragment_suffixes = scaffolds.str.extract('(_fragment_(\\d)+)$',expand=True)[0].fillna('')
+    return pd.Index(scaffolds.str.split(' ',n=1).str[0] + fragment_suffixes,dtype=object)
+
+def best_row_per_id(info_data_frame,score_column):
+    #Row with the highest score_column for each index value, keeping the first row in case of ties. As when rows were compared one at a time, a missing score in the first row of an index value is kept
+    is_first_row = ~info_data_frame.index.duplicated(keep='first')
+    scores = info_data_frame[score_column].to_numpy(dtype=np.float64,copy=True)
+    scores[np.isnan(scores) & is_first_row] = np.inf
+    scores[np.isnan(scores)] = -np.inf
+    group_order = pd.Series(info_data_frame.index).groupby(info_data_frame.index.to_numpy(),sort=False).ngroup().to_numpy()
+    #Sort by score within each index value, keep the first row of each and restore the order in which index values first appear
+    order = np.lexsort((np.arange(len(scores)),-scores,group_order))
+    best_rows = order[np.r_[True,group_order[order][1:] != group_order[order][:-1]]] if (len(order) > 0) else order
+    return info_data_frame.iloc[best_rows]
+
+def assign_seq_info(info_data_frame,prefix='',constant_columns=None):
+    #Store every column of info_data_frame (indexed by sequence ID) in seq_info as {prefix}{column}, after the constant_columns. Rows with repeated IDs are stored in order, so the last one is kept
+    seq_ids = list(info_data_frame.index)
+    if (constant_columns == None):
+        constant_columns = {}
+    for column,value in constant_columns.items():
+        seq_info[column].assign(seq_ids,value)
+    for column in info_data_frame.columns:
+        seq_info[f'{prefix}{column}'].assign(seq_ids,info_data_frame[column].to_numpy())
+
+def call_rafah(genome_file,cds_file,min_score,threads=None):
+    if (threads is None):
+        threads = args.threads
     if (not cds_file):
         print('No cds file identified')
         (cds_file,gene_file,gff_file) = call_prodigal(genome_file)
@@ -572,7 +1252,7 @@ def call_rafah(genome_file,cds_file,min_score):
     prefix_cds_file = get_prefix(cds_file,'(faa)|(fasta)|(fa)')
     if (args.parse_only == False):
         print(f'Running RaFAH')
-        command = f'RaFAH_v0.2.pl --predict --merged_cds_file_name {cds_file} --min_cutoff {min_score} --threads {args.threads} --file_prefix RaFAH_{prefix_cds_file}'
+        command = f'RaFAH_v0.2.pl --predict --merged_cds_file_name {cds_file} --min_cutoff {min_score} --threads {threads} --file_prefix RaFAH_{prefix_cds_file}'
         print(command)
         subprocess.call(command, shell=True)
     
@@ -583,8 +1263,7 @@ def call_rafah(genome_file,cds_file,min_score):
 def align_protein_to_hmm(cds_file,db_file,out_file,threads):
     #Align proteins against the generated hmm 
     print(f'Querying {cds_file} against {db_file}')
-    command = f'hmmsearch -o {out_file} --noali --cpu {threads} {db_file} {cds_file}'
-    subprocess.call(command, shell=True)                
+    run_hmmer('hmmsearch',db_file,cds_file,out_file,threads)
     return(1)
     
 def call_hmmer (cds_file,db_file,program):
@@ -595,19 +1274,124 @@ def call_hmmer (cds_file,db_file,program):
         outfile = cds_file_prefix+'x'+db_file_prefix+'.hmmscan'
         if (args.parse_only == False):
             print(f'Querying {db_file} against {cds_file}')
-            command = f'hmmscan -o {outfile} --noali --cpu {args.threads} {db_file} {cds_file}'
-            subprocess.call(command, shell=True)
+            run_hmmer('hmmscan',db_file,cds_file,outfile,args.threads)
     elif (program == 'hmmsearch'):
         outfile = cds_file_prefix+'x'+db_file_prefix+'.hmmsearch'
         if (args.parse_only == False):
             print(f'Querying {cds_file} against {db_file}')
-            command = f'hmmsearch -o {outfile} --noali --cpu {args.threads} {db_file} {cds_file}'
-            subprocess.call(command, shell=True)    
+            run_hmmer('hmmsearch',db_file,cds_file,outfile,args.threads)
     else:
         print('Not a valid Hmmer program!')
         
     return outfile
 
+def hmmer_command(program,db_file,cds_file,out_file,threads):
+    return f'{program} -o {out_file} --tblout {out_file}.tblout --domtblout {out_file}.domtblout --noali --cpu {threads} {db_file} {cds_file}'
+
+def run_hmmer(program,db_file,cds_file,out_file,threads):
+    #Run hmmsearch or hmmscan of cds_file against db_file. With --hmmer_shards above 1 the queries are split into shards searched by concurrent processes and their outputs are merged in the order of the queries, which gives the same hits in the same order as a single process
+    #The merged outputs keep the banner and column headers of the first shard and end with a single [ok], but the trailing summaries of the tables are replaced by a note of the number of shards, as each shard has its own query file and run time
+    #Each query is searched against the whole database in every shard, so the database size used for E-values (-Z and --domZ) is the same as in a single run
+    output_files = [out_file,f'{out_file}.tblout',f'{out_file}.domtblout']
+    command = hmmer_command(program,db_file,cds_file,out_file,threads)
+    if (args.hmmer_shards <= 1):
+        return run_command(f'{program}_{out_file}',command,[cds_file,db_file],output_files)
+    #Sharded and single runs share the same manifest key, as they produce the same hits
+    params = re.sub(' --?(num_)?(threads|cpu) \\d+','',command)
+    (is_valid,input_hash) = check_stage(f'{program}_{out_file}',[cds_file,db_file],params)
+    if (is_valid):
+        print(f'Skipping {program}_{out_file}: {command} completed in a previous run with the same inputs')
+        return 0
+    record_stage(f'{program}_{out_file}',input_hash,params,'running',output_files)
+    shard_dir = tempfile.mkdtemp(prefix=f'Shards_{os.path.basename(out_file)}_',dir='.')
+    return_code = 0
+    status = 'failed'
+    #The stage is recorded as failed and the shard files removed even if merging raises
+    try:
+        if (program == 'hmmsearch'):
+            shard_files = split_hmmer_queries(db_file,args.hmmer_shards,shard_dir,'hmm')
+        else:
+            shard_files = split_hmmer_queries(cds_file,args.hmmer_shards,shard_dir,'faa')
+        shard_threads = max(1,threads // len(shard_files))
+        print(f'Running {program} on {len(shard_files)} shards with {shard_threads} threads each')
+        shard_commands = []
+        for shard_file in shard_files:
+            shard_out_file = os.path.splitext(shard_file)[0]
+            if (program == 'hmmsearch'):
+                shard_commands.append((shard_out_file,hmmer_command(program,shard_file,cds_file,shard_out_file,shard_threads)))
+            else:
+                shard_commands.append((shard_out_file,hmmer_command(program,db_file,shard_file,shard_out_file,shard_threads)))
+        start_time = time.time()
+        #Shards are merged as soon as they and all the shards before them finish. Once a shard fails the merged outputs can not be complete, so no more shards are merged
+        with open(out_file,'wb') as TEXT, open(f'{out_file}.tblout','wb') as TBL, open(f'{out_file}.domtblout','wb') as DOMTBL:
+            finished_shards = set()
+            next_shard = 0
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(shard_commands)) as executor:
+                future_shards = {executor.submit(subprocess.call,shard_command,shell=True): shard for shard,(shard_out_file,shard_command) in enumerate(shard_commands)}
+                for future in concurrent.futures.as_completed(future_shards):
+                    shard = future_shards[future]
+                    if (future.result() != 0):
+                        print(f'{shard_commands[shard][1]} failed with exit code {future.result()}')
+                        return_code = future.result()
+                    print(f'\tFinished shard {shard+1} of {len(shard_commands)} in {time.time() - start_time:.1f} seconds')
+                    finished_shards.add(shard)
+                    while ((return_code == 0) and (next_shard in finished_shards)):
+                        shard_out_file = shard_commands[next_shard][0]
+                        merge_hmmer_shard(shard_out_file,TEXT,TBL,DOMTBL,next_shard == 0)
+                        next_shard += 1
+            if (return_code == 0):
+                TEXT.write(b'[ok]\n')
+                for TABLE in (TBL,DOMTBL):
+                    TABLE.write(f'#\n# Merged from {len(shard_commands)} shards of {program}\n# [ok]\n'.encode())
+        if (return_code == 0):
+            status = 'complete'
+        else:
+            #Partially merged outputs are removed so they are not parsed as the results of the search
+            remove_files(output_files)
+    finally:
+        shutil.rmtree(shard_dir,ignore_errors=True)
+        record_stage(f'{program}_{out_file}',input_hash,params,status,output_files)
+    return return_code
+
+def split_hmmer_queries(query_file,shard_count,shard_dir,extension):
+    #Split the HMMs (extension hmm) or proteins (extension faa) of query_file into up to shard_count files of similar size, keeping their order. The size of a record grows with the length of the model or protein, and so does the time taken to search it
+    record_start = b'HMMER' if (extension == 'hmm') else b'>'
+    total_size = os.path.getsize(query_file)
+    shard_files = []
+    written_size = 0
+    OUT = None
+    with open(query_file,'rb') as IN:
+        for line in IN:
+            if ((OUT is None) or ((line.startswith(record_start)) and (len(shard_files) < shard_count) and (written_size >= total_size * len(shard_files) / shard_count))):
+                if (OUT is not None):
+                    OUT.close()
+                shard_files.append(f'{shard_dir}/Shard_{len(shard_files)}.{extension}')
+                OUT = open(shard_files[-1],'wb')
+            OUT.write(line)
+            written_size += len(line)
+    if (OUT is not None):
+        OUT.close()
+    return shard_files
+
+def merge_hmmer_shard(shard_out_file,TEXT,TBL,DOMTBL,is_first_shard):
+    #Append the outputs of a shard to the merged files and remove them. The program banner of the text output and the column headers of the tables are only kept from the first shard. The [ok] line that ends the text output and the trailing summaries of the tables, which start with a line holding only #, are dropped
+    with open(shard_out_file,'rb') as IN:
+        in_header = not is_first_shard
+        for line in IN:
+            if ((in_header) and (line.startswith(b'Query:'))):
+                in_header = False
+            if ((not in_header) and (line.rstrip() != b'[ok]')):
+                TEXT.write(line)
+    os.remove(shard_out_file)
+    for (extension,TABLE) in (('tblout',TBL),('domtblout',DOMTBL)):
+        with open(f'{shard_out_file}.{extension}','rb') as IN:
+            for line in IN:
+                if (line.rstrip() == b'#'):
+                    break
+                if ((is_first_shard) or (not line.startswith(b'#'))):
+                    TABLE.write(line)
+        os.remove(f'{shard_out_file}.{extension}')
+
 def calc_pps(genome_file,cds,pps_subject_fasta,pps_subject_db,precomp_hits_table):
     prefix_genome_file = get_prefix(genome_file,args.in_format)
     prefix_subject_fasta_file = get_prefix(pps_subject_fasta,'(faa)|(fasta)|(fa)')
@@ -620,66 +1404,49 @@ def calc_pps(genome_file,cds,pps_subject_fasta,pps_subject_db,precomp_hits_table
     else:
         if (pps_subject_db == 'NA'):
             outfile = f'{prefix_cds_file}x{prefix_subject_fasta_file}.m8'
-            command = f'mmseqs easy-search {cds} {pps_subject_fasta} {outfile} tmp --threads {args.threads} --max-seqs 1000 --min-seq-id 0.3 --min-aln-len 30'
-            subprocess.call(command, shell=True)
+            #With a database cache the subject sequences are converted to an indexed MMseqs2 database only once
+            subject_target = pps_subject_fasta
+            if (args.db_cache_dir != 'NA'):
+                subject_target = build_cached_db('mmseqs_createindex',[pps_subject_fasta],'createdb;createindex',f'DB_{prefix_subject_fasta_file}',lambda db_name: f'mmseqs createdb {pps_subject_fasta} {db_name} && mmseqs createindex {db_name} {db_name}_tmp --threads {args.threads} && rm -rf {db_name}_tmp')
+            command = f'mmseqs easy-search {cds} {subject_target} {outfile} tmp --threads {args.threads} --max-seqs 1000 --min-seq-id 0.3 --min-aln-len 30'
+            run_command('pps_mmseqs_search',command,[cds,pps_subject_fasta],[outfile])
         else:
             outfile = f'{prefix_cds_file}x{prefix_subject_DB_file}.m8'
             command = f'mmseqs easy-search {cds} {pps_subject_db} {outfile} tmp --threads {args.threads} --max-seqs 1000 --min-seq-id 0.3 --min-aln-len 30'
-            subprocess.call(command, shell=True)
-    recip_scores = calc_recip_scores(outfile)
+            run_command('pps_mmseqs_search',command,[cds],[outfile])
     recip_scores_file = outfile+'.Pairwise_Protein_Scores.tsv'
-    print_scores(recip_scores,recip_scores_file,args.pps_min_aai,args.pps_min_matched,args.pps_min_perc_matched)
+    print_scores(calc_recip_scores(outfile),recip_scores_file,args.pps_min_aai,args.pps_min_matched,args.pps_min_perc_matched)
+    return recip_scores_file
 
 def print_scores(recip_scores,recip_scores_file,min_aai,min_matched,min_perc_matched):
+    #recip_scores is an iterable of pair score tables, which are filtered and written as they arrive. A compressed Parquet copy of the table is written alongside the .tsv
+    parquet_file = re.sub('\\.tsv$','',recip_scores_file)+'.parquet'
+    parquet_writer = None
+    if (pyarrow is None):
+        print(f'pyarrow is not installed. Skipping {parquet_file}')
+    else:
+        #The schema is fixed up front, as the types inferred from an empty table (e.g. null for the names) would not match those of the following tables
+        scores_schema = pyarrow.schema([('Query_Scaffold',pyarrow.string()),('Subject_Scaffold',pyarrow.string()),('AAI',pyarrow.float64()),('Matched_CDS',pyarrow.int64()),('Perc_Matched_CDS',pyarrow.float64())])
+        parquet_writer = pyarrow.parquet.ParquetWriter(parquet_file,scores_schema,compression='zstd')
     print(f'Printing Pairwise Protein Scores to {recip_scores_file}')
     with open(recip_scores_file, 'w', newline='') as OUT:
         OUT.write('Query_Scaffold\tSubject_Scaffold\tAAI\tMatched_CDS\tPerc_Matched_CDS\n')
-        for genomeA in recip_scores['Matched_CDS'].keys():
-            for genomeB in recip_scores['Matched_CDS'][genomeA].keys():
-                #check_vp_cutoff(pair_ani,pair_matched,pair_perc_matched,cutoff_ani,cutoff_matched,cutoff_perc_matched)
-                is_valid = check_vp_cutoff(recip_scores['AAI'][genomeA][genomeB],recip_scores['Matched_CDS'][genomeA][genomeB],recip_scores['Perc_Matched_CDS'][genomeA][genomeB],min_aai,min_matched,min_perc_matched)
-                if (is_valid == True):
-                    line_list = [genomeA,genomeB,recip_scores['AAI'][genomeA][genomeB],recip_scores['Matched_CDS'][genomeA][genomeB],recip_scores['Perc_Matched_CDS'][genomeA][genomeB]]
-                    line = '\t'.join(str(field) for field in line_list)
-                    OUT.write(f'{line}\n')
-            
+        for scores in recip_scores:
+            is_valid = (scores['AAI'] >= min_aai) & (scores['Matched_CDS'] >= min_matched) & (scores['Perc_Matched_CDS'] >= min_perc_matched)
+            scores = scores[is_valid.to_numpy()]
+            scores.to_csv(OUT,sep='\t',header=False,index=False)
+            if (parquet_writer is not None):
+                parquet_writer.write_table(pyarrow.Table.from_pandas(scores,schema=scores_schema,preserve_index=False))
+    if (parquet_writer is not None):
+        parquet_writer.close()
+
 def calc_recip_scores(infile):
-    #Initialize 2D dictionary that will hold the reciprocal scores
-    recip_scores = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
-    #Parse the m8 file
+    #Yields tables of Query_Scaffold, Subject_Scaffold, AAI, Matched_CDS and Perc_Matched_CDS from the m8 file. Each CDS is counted at most once per subject scaffold
     print ('Parsing m8 output',infile)
-    #Seen hits will keep track of the seen CDS pairs so to not overestimate AAI and Perc matched genes
-    seen_hits = defaultdict(dict)
-    #Iterare over queries
-    for qresult in SearchIO.parse(infile, 'blast-tab'):
-        #Iterate over hits in the query
-        for hit in qresult.hits:
-            #Iterate over HSPs in the hits
-            for hsp in hit.hsps:
-                #Check if the HSP passes established blast cutoffs
-                is_valid = check_match_cutoff(hsp,0.001,30,0.3,30)
-                if (is_valid):
-                    #Derive the original scaffold name from the CDS id
-                    genomeA = re.sub('_(\\d)+$','',qresult.id)
-                    genomeB = re.sub('_(\\d)+$','',hit.id)
-                    #Only go on if matches are between two different scaffolds and two different CDS
-                    if ((genomeA != genomeB) and (qresult.id != hit.id)):
-                        #Only go on if the query/hit pair has not been processed before
-                        if (genomeB not in seen_hits[qresult.id].keys()):
-                            seen_hits[qresult.id][genomeB] = 1
-                            recip_scores['Matched_CDS'][genomeA][genomeB] += 1
-                            recip_scores['Perc_Matched_CDS'][genomeA][genomeB] += ((1 / seq_info['CDS_Count'][genomeA]) * 100)
-                            recip_scores['ID_Sum'][genomeA][genomeB] += (hsp.ident_pct * 100)
-    
-    #Calculate AAI between genome pairs
-    print('Calculating AAI')
-    for genomeA in recip_scores['Matched_CDS'].keys():
-        for genomeB in recip_scores['Matched_CDS'][genomeA].keys():
-            recip_scores['AAI'][genomeA][genomeB] = recip_scores['ID_Sum'][genomeA][genomeB] / recip_scores['Matched_CDS'][genomeA][genomeB]
-    
-    return (recip_scores)
-                            
-    
+    for pair_scores in iter_blast_pair_scores(infile,seq_info['CDS_Count'].to_series(),0.001,30,0.3,30,ident_scale=100,chunk_size=args.chunk_size,max_pairs_in_memory=args.max_pairs_in_memory):
+        pair_scores['AAI'] = pair_scores.pop('ID_Sum') / pair_scores['Matched_CDS']
+        pair_scores = pair_scores.rename(columns={'Genome_A': 'Query_Scaffold', 'Genome_B': 'Subject_Scaffold'})
+        yield pair_scores[['Query_Scaffold','Subject_Scaffold','AAI','Matched_CDS','Perc_Matched_CDS']]
 
 
 def call_spades(raw_read_table="",spades_memory=250):
@@ -708,85 +1475,180 @@ def call_spades(raw_read_table="",spades_memory=250):
 
 def calc_abundance(genome_file,db_file,metagenomes_dir,metagenomes_extension,max_reads,bowtie_mode,min_count,raw_read_table):
     prefix_genome_file = get_prefix(genome_file,args.in_format)
-    raw_abund_matrix = pd.DataFrame()
     
     db_file_prefix = 'NA'
     if (db_file == 'NA'):
         print(f'Building Bowtie2 database from {genome_file}')
-        command = f'bowtie2-build --threads {args.threads} {genome_file} {prefix_genome_file}'
-        db_file = prefix_genome_file
+        db_file = build_cached_db('bowtie2-build',[genome_file],'',prefix_genome_file,lambda db_name: f'bowtie2-build --threads {args.threads} {genome_file} {db_name}')
         db_file_prefix = prefix_genome_file
-        subprocess.call(command, shell=True)
     else:
         db_file_prefix = get_prefix(db_file,"DUMMY")
     
 
     raw_read_info_df = index_info(raw_read_table,"Sample",'\t',header=0)
-    
+    #Counts of each sample group are kept as the integer codes of the sequences with at least one (or min_count) mapped reads and their counts, then assembled into a sparse sequence x sample matrix at once
+    contig_codes = dict()
+    last_seqs = None
+    sample_names = []
+    count_rows = [np.zeros(0,dtype=np.int64)]
+    count_cols = [np.zeros(0,dtype=np.int64)]
+    count_values = [np.zeros(0,dtype=np.int64)]
     if (not raw_read_info_df.empty):
-        for group in set(raw_read_info_df['Group']):
-            print(f"Processing samples from group {group}")
+        #Sample groups are mapped concurrently, sharing the threads and RAM given by --threads and --max_ram
+        groups = list(raw_read_info_df['Group'].unique())
+        index_files = glob.glob(f'{db_file}*.bt2') + glob.glob(f'{db_file}*.bt2l')
+        index_size = sum(os.path.getsize(index_file) for index_file in index_files)
+        max_ram_bytes = args.max_ram * (1024 ** 3)
+        groups_at_once = max(1,min(len(groups),args.threads // max(1,args.mapping_threads_per_group),max_ram_bytes // max(1,index_size)))
+        group_threads = max(1,args.threads // groups_at_once)
+        #Memory per thread given to samtools sort, from whatever is left of the RAM share of each group after loading the index
+        sort_memory = min(768,max(64,int(((max_ram_bytes / groups_at_once) - index_size) / group_threads / (1024 ** 2))))
+        jobs = []
+        group_inputs = dict()
+        for group in groups:
             group_df = raw_read_info_df[raw_read_info_df['Group'] == group]
             samples_list = group_df.index
-            print(f"Aligning reads from sample(s): "+str(",".join(set(samples_list))))
             r1_files = list(group_df['R1'])
             r1_files = ' -1 '.join(r1_files)
             r2_files = list(group_df['R2'])
             r2_files = ' -2 '.join(r2_files)
             outfile = group+'x'+db_file_prefix
-            command = f"bowtie2 -x {db_file} -q -1 {r1_files} -2 {r2_files} -S {outfile}.sam --{bowtie_mode} --no-discordant --no-mixed --no-unal --threads {args.threads}"
+            command = f"bowtie2 -x {db_file} -q -1 {r1_files} -2 {r2_files} --{bowtie_mode} --no-discordant --no-mixed --no-unal --threads {group_threads}"
             if (max_reads > 0):
                 command = command + f" -u {max_reads}"
             if (args.bowtie_k > 0):
                 command = command + f" -k {args.bowtie_k}"
-            if (args.parse_only == False):
-                print(f"Running: {command}")
-                subprocess.call(command, shell=True)
-            if (args.parse_only == False):
-                command = f'samtools view -bS {outfile}.sam > {outfile}.bam'
-                subprocess.call(command, shell=True)
-                command = f'samtools sort {outfile}.bam -o {outfile}.sorted.bam'
-                subprocess.call(command, shell=True)
-                command = f'rm -f {outfile}.sam {outfile}.bam'
-                subprocess.call(command, shell=True)
-                command = f'samtools index {outfile}.sorted.bam'
-                subprocess.call(command, shell=True)
-                command = f'samtools idxstats {outfile}.sorted.bam > {outfile}.Counts.tsv'
-                subprocess.call(command, shell=True)
-            sample_abund = index_info(f'{outfile}.Counts.tsv',None,'\t',header=None)
-            sample_abund = sample_abund.rename(columns={0: "Sequence", 1: "Length",2: group, 3: "Unmapped"})
-            sample_abund = sample_abund.set_index('Sequence')
-            sample_abund.drop(sample_abund.tail(1).index,inplace=True)
-            if (min_count > 0):
-                sample_abund.loc[sample_abund[group] < min_count, group] = 0
-            frames = [raw_abund_matrix,sample_abund[group]]
-            raw_abund_matrix = pd.concat(frames,axis=1)
-        #print(raw_abund_matrix.shape)
+            print(f"Aligning reads from sample(s) of group {group}: "+str(",".join(set(samples_list))))
+            jobs.append((group,command,outfile,group_threads,sort_memory,args.abundance_keep_bam))
+            group_inputs[group] = list(group_df['R1']) + list(group_df['R2']) + index_files
+        if (args.parse_only == False):
+            #Groups mapped in a previous run with the same reads, index and parameters are skipped with --resume
+            pending_jobs = []
+            for job in jobs:
+                (is_valid,input_hash) = check_stage(f'mapping_{job[0]}',group_inputs[job[0]],re.sub(' --threads \\d+','',job[1]))
+                if (is_valid):
+                    print(f'Skipping mapping of group {job[0]}: completed in a previous run with the same inputs')
+                else:
+                    pending_jobs.append((job,input_hash))
+            if (groups_at_once > 1):
+                print(f"Mapping {len(pending_jobs)} sample groups, {groups_at_once} at a time with {group_threads} threads each")
+                with multiprocessing.Pool(processes=groups_at_once) as pool:
+                    pool.starmap(map_sample_group,[job for (job,input_hash) in pending_jobs])
+            else:
+                for (job,input_hash) in pending_jobs:
+                    map_sample_group(*job)
+            for (job,input_hash) in pending_jobs:
+                record_stage(f'mapping_{job[0]}',input_hash,re.sub(' --threads \\d+','',job[1]),'complete' if (os.path.exists(f'{job[2]}.Counts.tsv')) else 'failed',[f'{job[2]}.Counts.tsv'])
+        #Partial counts of failed groups are never used, so the abundance tables are not written and the stage fails
+        failed_groups = [group for (group,command,outfile,group_threads,sort_memory,keep_bam) in jobs if (not os.path.exists(f'{outfile}.Counts.tsv'))]
+        if (failed_groups):
+            raise Exception(f'Mapping failed for sample groups: {",".join(failed_groups)}')
+        for (group,command,outfile,group_threads,sort_memory,keep_bam) in jobs:
+            (group_rows,group_counts,last_seqs) = read_group_counts(f'{outfile}.Counts.tsv',contig_codes,last_seqs,min_count)
+            count_rows.append(group_rows)
+            count_cols.append(np.full(len(group_rows),len(sample_names),dtype=np.int64))
+            count_values.append(group_counts)
+            sample_names.append(group)
     
+    contig_names = np.array(list(contig_codes),dtype=object)
+    #Counts are halved as both reads of each pair are counted
+    raw_abund_matrix = scipy.sparse.csc_matrix((np.concatenate(count_values) / 2,(np.concatenate(count_rows),np.concatenate(count_cols))),shape=(len(contig_names),len(sample_names)))
     raw_abund_matrix_file = 'Raw_Abundance_'+f'{prefix_genome_file}.tsv'
-    raw_abund_matrix.index.name = 'Sequence'
-    raw_abund_matrix = raw_abund_matrix.div(2,axis=0)
-    raw_abund_matrix.to_csv(raw_abund_matrix_file,sep="\t",na_rep='NA')
+    raw_abund_matrix_file = write_abundance_tables(raw_abund_matrix,contig_names,sample_names,raw_abund_matrix_file)
     
     if (args.abundance_rpkm == True):
+        sample_totals = np.asarray(raw_abund_matrix.sum(axis=0),dtype=np.float64).ravel()
         #Calc perc abundance
         print("Calculating percentage abundance")
         perc_abund_matrix_file = 'Percentage_Abundance_'+f'{prefix_genome_file}.tsv'
-        #perc_abund_matrix = (raw_abund_matrix / raw_abund_matrix.sum(axis=1)) * 100
-        perc_abund_matrix = (raw_abund_matrix.div(raw_abund_matrix.sum(axis=0),axis=1)) * 100
-        perc_abund_matrix.to_csv(perc_abund_matrix_file,sep="\t",na_rep='NA')
+        write_abundance_tables(raw_abund_matrix,contig_names,sample_names,perc_abund_matrix_file,col_divisor=sample_totals,multiplier=100)
         #Calc RPKM
         print("Calculating RPKM abundance")
-        seq_info_matrix = pd.DataFrame.from_dict(seq_info)
-        #Reindex seq_info_matrix in case the orders of sequences differ between seq_info_matrix and raw_abund_matrix
-        seq_info_matrix = seq_info_matrix.reindex(raw_abund_matrix.index.values)
         rpkm_abund_matrix_file = 'RPKM_Abundance_'+f'{prefix_genome_file}.tsv'
         #Legnth is retrieved from seq_info to avoid having to get this value from each of the raw_abund_matrix. This means that RPKM can only be calculated in the sequences are passed at command line through the genome_files parameter
-        rpkm_abund_matrix = (raw_abund_matrix.div((seq_info_matrix['Length'] / 1000),axis=0)  / (raw_abund_matrix.sum(axis=0) / 1000000))
-        rpkm_abund_matrix.index.name = 'Sequence'
-        rpkm_abund_matrix.to_csv(rpkm_abund_matrix_file,sep="\t",na_rep='NA')
+        contig_lengths = seq_info['Length'].to_series().reindex(contig_names).to_numpy(dtype=np.float64,na_value=np.nan)
+        write_abundance_tables(raw_abund_matrix,contig_names,sample_names,rpkm_abund_matrix_file,row_divisor=(contig_lengths / 1000),col_divisor=(sample_totals / 1000000))
+    return raw_abund_matrix_file
+
+def read_group_counts(counts_file,contig_codes,last_seqs,min_count):
+    #Read the Counts.tsv (samtools idxstats format) of a sample group and return the integer codes and counts of the sequences with mapped reads
+    print(f'Reading counts from {counts_file}')
+    counts = pd.read_csv(counts_file,sep='\t',header=None,usecols=[0,2],names=['Sequence','Length','Mapped','Unmapped'],dtype={'Sequence': str, 'Mapped': np.int64},keep_default_na=False)
+    #The last line holds the reads not mapped to any sequence
+    counts = counts.iloc[:-1]
+    seq_names = counts['Sequence'].to_numpy(dtype=object)
+    #Groups mapped to the same database list the same sequences in the same order, so the codes only need to be looked up once
+    if ((last_seqs is not None) and (np.array_equal(seq_names,last_seqs[0]))):
+        (seq_names,seq_rows) = last_seqs
+    else:
+        seq_rows = encode_ids(seq_names,contig_codes)
+    mapped = counts['Mapped'].to_numpy()
+    is_counted = mapped >= max(min_count,1)
+    return (seq_rows[is_counted],mapped[is_counted],(seq_names,seq_rows))
+
+def scale_abundance(values,row_divisor,col_divisor,multiplier):
+    if (row_divisor is not None):
+        values = values / row_divisor
+    if (col_divisor is not None):
+        values = values / col_divisor
+    if (multiplier is not None):
+        values = values * multiplier
+    return values
+
+def write_abundance_tables(abund_matrix,row_labels,col_labels,out_file,row_divisor=None,col_divisor=None,multiplier=None):
+    #Write a sparse abundance matrix, with each value divided by the row_divisor of its sequence and the col_divisor of its sample, as a table in the --output_format, in Matrix Market format (.mtx, with the sequence and sample names in .rows.txt and .cols.txt) and as a long format Parquet table of non zero values
+    #The Sequence x Sample table is named {out_prefix}.Matrix.parquet/.feather in the columnar formats, as {out_prefix}.parquet is the long format table. Returns the name of the Sequence x Sample table
+    out_prefix = re.sub('\\.tsv$','',out_file)
+    if (args.output_format != 'tsv'):
+        out_file = f'{out_prefix}.Matrix.tsv'
+    abund_matrix = abund_matrix.tocsr()
+    #The table is written in blocks of rows, so only one block at a time is dense. Sequences without counts and samples with 0 total counts get the same NA / 0 values as a dense calculation would
+    rows_per_block = max(1,args.chunk_size // max(1,len(col_labels)))
+    with TableWriter(out_file) as writer:
+        print(f'Printing abundance matrix to {writer.out_file}')
+        with np.errstate(divide='ignore',invalid='ignore'):
+            for block_start in range(0,max(1,len(row_labels)),rows_per_block):
+                block_end = min(block_start + rows_per_block,len(row_labels))
+                block_row_divisor = None if (row_divisor is None) else row_divisor[block_start:block_end,np.newaxis]
+                block = scale_abundance(abund_matrix[block_start:block_end].toarray(),block_row_divisor,col_divisor,multiplier)
+                writer.write(pd.DataFrame(block,index=pd.Index(row_labels[block_start:block_end],name='Sequence'),columns=[str(label) for label in col_labels]))
+    #Only the stored (non zero) values are scaled for the sparse outputs
+    entry_rows = np.repeat(np.arange(len(row_labels),dtype=np.int64),np.diff(abund_matrix.indptr))
+    entry_cols = abund_matrix.indices.astype(np.int64)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        entry_values = scale_abundance(abund_matrix.data,None if (row_divisor is None) else row_divisor[entry_rows],None if (col_divisor is None) else col_divisor[entry_cols],multiplier)
+    write_matrix_market(scipy.sparse.coo_matrix((entry_values,(entry_rows,entry_cols)),shape=abund_matrix.shape),row_labels,col_labels,out_prefix)
+    if (pyarrow is None):
+        print(f'pyarrow is not installed. Skipping {out_prefix}.parquet')
+    else:
+        long_table = pyarrow.table({'Sequence': pyarrow.DictionaryArray.from_arrays(pyarrow.array(entry_rows),pyarrow.array(row_labels,type=pyarrow.string())), 'Sample': pyarrow.DictionaryArray.from_arrays(pyarrow.array(entry_cols),pyarrow.array([str(label) for label in col_labels],type=pyarrow.string())), 'Value': entry_values})
+        pyarrow.parquet.write_table(long_table,f'{out_prefix}.parquet',compression='zstd')
+    return writer.out_file
+
+def map_sample_group(group,command,outfile,threads,sort_memory,keep_bam):
+    #Map the reads of a sample group and write the number of reads mapped to each sequence to {outfile}.Counts.tsv, in the samtools idxstats format
+    #Alignments are streamed from bowtie2 and counted by samtools idxstats, or piped to samtools sort if the sorted BAM should be kept. No intermediate SAM files are written
+    #A failure of any command of the pipeline fails the group: its Counts.tsv is removed and mapped_reads is None
+    print(f"Running: {command}")
+    start_time = time.time()
+    with open(f'{outfile}.Bowtie2.log','w') as LOG:
+        if (keep_bam == True):
+            return_code = subprocess.call(f'set -o pipefail; {command} | samtools sort -@ {threads} -m {sort_memory}M -o {outfile}.sorted.bam - && samtools index {outfile}.sorted.bam && samtools idxstats {outfile}.sorted.bam > {outfile}.Counts.tsv', shell=True, executable='/bin/bash', stderr=LOG)
+        else:
+            return_code = subprocess.call(f'set -o pipefail; {command} | samtools view -u -@ {threads} - | samtools idxstats - > {outfile}.Counts.tsv', shell=True, executable='/bin/bash', stderr=LOG)
+    wall_time = time.time() - start_time
+    if (return_code != 0):
+        print(f'Warning: mapping of group {group} failed with exit code {return_code}. Bowtie2 log: {outfile}.Bowtie2.log')
+        if (os.path.exists(f'{outfile}.Counts.tsv')):
+            os.remove(f'{outfile}.Counts.tsv')
+        return (group,wall_time,None)
+    mapped_reads = 0
+    with open(f'{outfile}.Counts.tsv','r') as IN:
+        for line in IN:
+            mapped_reads += int(line.split('\t')[2])
+    print(f'Mapped {mapped_reads} reads from group {group} in {wall_time:.1f} seconds ({mapped_reads / max(wall_time,0.001):.0f} reads/second). Bowtie2 log: {outfile}.Bowtie2.log')
+    return (group,wall_time,mapped_reads)
 
-    
 def index_samples(metagenomes_dir,metagenomes_extension,count_reads):
     samples_index = defaultdict(dict)
     for directory in metagenomes_dir:
@@ -808,10 +1670,12 @@ def index_samples(metagenomes_dir,metagenomes_extension,count_reads):
         
     return(samples_index)
             
-def call_metabat(genome_file):
+def call_metabat(genome_file,threads=None):
+    if (threads is None):
+        threads = args.threads
     prefix_genome_file = get_prefix(genome_file,args.in_format)
     metabat_out_file = f'Binning_{prefix_genome_file}'
-    command = f'metabat2 -i {genome_file} -s 10000 -l --saveCls -o {metabat_out_file} -t {args.threads} --noBinOut'
+    command = f'metabat2 -i {genome_file} -s 10000 -l --saveCls -o {metabat_out_file} -t {threads} --noBinOut'
     subprocess.call(command, shell=True)
     return(metabat_out_file)
     
@@ -828,16 +1692,15 @@ def make_og_score_table_and_phylogeny(genome_file,cds_file,min_cluster_size,make
     (og_table,protein_info,cluster_info) = parse_mmseqs_cluster_file(out_mmseqs_cluster_file)
 
     #Print output to og_table_out_file
-    og_table_out_file = 'OG_Table_'+prefix_genome_file+'.tsv'
-    og_table_data_frame = pd.DataFrame.from_dict(og_table)
+    og_table_out_file = table_file_name('OG_Table_'+prefix_genome_file+'.tsv')
+    (og_matrix,genome_names,og_names) = og_table
     print(f'Printing OG table to {og_table_out_file}')
-    og_table_data_frame.to_csv(og_table_out_file,sep="\t",na_rep=0)
+    write_sparse_table(og_matrix,genome_names,og_names,og_table_out_file,index_name=None)
     
     
     #Split sequences by OG affiliation
     unaligned_cluster_dir = 'Unaligned_Clusters_'+prefix_genome_file
-    command = f'mkdir {unaligned_cluster_dir}'
-    subprocess.call(command, shell=True)
+    os.makedirs(unaligned_cluster_dir,exist_ok=True)
     #Create a directory to store aligned fasta file of clusters
     aligned_cluster_dir = 'Aligned_Clusters_'+prefix_genome_file
     command = f'mkdir {aligned_cluster_dir}'
@@ -853,89 +1716,355 @@ def make_og_score_table_and_phylogeny(genome_file,cds_file,min_cluster_size,make
         command = f'mkdir {phylo_cluster_dir}'
         subprocess.call(command, shell=True)
     
-    for seqobj in SeqIO.parse(cds_file, 'fasta'):
-        #Collect description and legth information and store it in protein_info
-        #protein_info['Description'][seqobj.id] = seqobj.description
-        #protein_info['Length'][seqobj.id] = len(seqobj.seq)
-        #print(seqobj.id, protein_info['OG'].keys())
-        prot_cluster = protein_info['OG'][seqobj.id]
-        #Print the sequence to its cluster file if the cluster meets the criteria for minimum number of members
-        if (cluster_info['Members'][prot_cluster] >= min_cluster_size):
-            fasta_cluster_name = f'{unaligned_cluster_dir}/Unaligned_Cluster_'+prot_cluster+'.faa'
-            fasta_handle = open(fasta_cluster_name, "a+")
-            SeqIO.write(seqobj,fasta_handle, "fasta")
-            fasta_handle.close()
-    
+    #Print the sequences of each cluster that meets the criteria for minimum number of members to its own file
+    og_names = cluster_info['OG']
+    og_sizes = cluster_info['Members']
+    is_valid_og = og_sizes >= min_cluster_size
+    valid_codes = np.flatnonzero(is_valid_og)
+    #Only the proteins of valid clusters are looked up while partitioning
+    is_valid_protein = is_valid_og[protein_info['OG']]
+    seq_clusters = dict(zip(protein_info['Protein'][is_valid_protein],og_names[protein_info['OG'][is_valid_protein]]))
+    partition_fasta_by_cluster(cds_file,unaligned_cluster_dir,seq_clusters,set(og_names[valid_codes]))
+    del seq_clusters
     
-    for prot_cluster in cluster_info['Members'].keys():
-        #Skip clusters that do not meet the criteria for minimum size
-        if (cluster_info['Members'][prot_cluster] >= min_cluster_size):
-            #Align cluster with muscle
-            command = f'muscle -in {unaligned_cluster_dir}/Unaligned_Cluster_{prot_cluster}.faa -out {aligned_cluster_dir}/Aligned_Cluster_{prot_cluster}.faa -quiet'
-            subprocess.call(command, shell=True)
-            if (make_score_table == True):
-                #Build HMM from alignment
-                command = f'hmmbuild -n {prot_cluster} {hmm_cluster_dir}/Aligned_Cluster_{prot_cluster}.hmm {aligned_cluster_dir}/Aligned_Cluster_{prot_cluster}.faa'
-                subprocess.call(command, shell=True)
-            if (make_phylogeny == True):
-                command = f"FastTreeMP -nosupport -out {phylo_cluster_dir}/Tree_Aligned_Cluster_{prot_cluster}.newick {aligned_cluster_dir}/Aligned_Cluster_{prot_cluster}.faa"
-                subprocess.call(command, shell=True)
+    #Align, build HMMs and infer trees of each cluster that meets the criteria for minimum size. Clusters are independent, so they are processed in parallel, one thread each, starting from the largest ones so a few large clusters do not delay the end of the run
+    valid_codes = valid_codes[np.argsort(-og_sizes[valid_codes],kind='stable')]
+    valid_clusters = list(og_names[valid_codes])
+    cluster_jobs = []
+    for prot_cluster in valid_clusters:
+        hmm_file = f'{hmm_cluster_dir}/Aligned_Cluster_{prot_cluster}.hmm' if (make_score_table == True) else None
+        tree_file = f'{phylo_cluster_dir}/Tree_Aligned_Cluster_{prot_cluster}.newick' if (make_phylogeny == True) else None
+        cluster_jobs.append((prot_cluster,f'{unaligned_cluster_dir}/Unaligned_Cluster_{prot_cluster}.faa',f'{aligned_cluster_dir}/Aligned_Cluster_{prot_cluster}.faa',hmm_file,tree_file))
+    print(f'Processing {len(cluster_jobs)} clusters with {args.threads} threads')
+    start_time = time.time()
+    finished_count = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1,args.threads)) as executor:
+        for future in concurrent.futures.as_completed([executor.submit(process_og_cluster,*cluster_job) for cluster_job in cluster_jobs]):
+            future.result()
+            finished_count += 1
+            if (finished_count % 1000 == 0):
+                print(f'\tProcessed {finished_count} of {len(cluster_jobs)} clusters in {time.time() - start_time:.1f} seconds')
+    print(f'Processed {finished_count} clusters in {time.time() - start_time:.1f} seconds')
+    #Outputs of clusters that are no longer valid (e.g. after raising --min_cluster_size) are removed
+    current_files = set(file for cluster_job in cluster_jobs for file in cluster_job[2:] if (file))
+    for (cluster_dir,file_pattern,is_made) in [(aligned_cluster_dir,'Aligned_Cluster_*.faa',True),(hmm_cluster_dir,'Aligned_Cluster_*.hmm',make_score_table),(phylo_cluster_dir,'Tree_Aligned_Cluster_*.newick',make_phylogeny)]:
+        if (is_made == True):
+            remove_files([stale_file for stale_file in glob.glob(f'{cluster_dir}/{file_pattern}') if (stale_file not in current_files)])
 
-    og_score_table_out_file = 'OG_Score_Table_'+prefix_genome_file+'.tsv'
+    og_score_table_out_file = table_file_name('OG_Score_Table_'+prefix_genome_file+'.tsv')
     
     if (make_score_table == True):
-        #Merge all HMMs into a single file
+        #Merge the HMMs of the current valid clusters into a single file, sorted by file name
         concat_hmmer_file = 'All_Clusters_'+prefix_genome_file+'.hmm'
-        command = f'cat {hmm_cluster_dir}/*.hmm > {concat_hmmer_file}'
-        subprocess.call(command, shell=True)
+        with open(concat_hmmer_file,'wb') as OUT:
+            for hmm_file in sorted(cluster_job[3] for cluster_job in cluster_jobs if (os.path.exists(cluster_job[3]))):
+                with open(hmm_file,'rb') as IN:
+                    shutil.copyfileobj(IN,OUT,args.io_buffer_size)
         #Run HMMpress on the merged hmm file
         print('Building HMM database')
-        command = f'hmmpress {concat_hmmer_file}'
-        subprocess.call(command, shell=True)
+        concat_hmmer_file = build_cached_db('hmmpress',[concat_hmmer_file],'',concat_hmmer_file,lambda db_name: f'hmmpress {db_name}',copy_input=True)
         hmmer_out_file = prefix_genome_file+'xAll_Clusters'
         align_protein_to_hmm(cds_file,concat_hmmer_file,hmmer_out_file,args.threads)
-        (genome_hmm_scores,pairwise_scores) = parse_hmmer_output(hmmer_out_file)
-        
-        #Print genome_hmm_scores to og_score_table_out_file
-        og_score_table_data_frame = pd.DataFrame.from_dict(genome_hmm_scores)
-        og_score_table_data_frame.index.name = 'Sequence'
-        print(f'Printing OG x Genome score table to {og_score_table_out_file}')
-        og_score_table_data_frame.to_csv(og_score_table_out_file,sep="\t",na_rep=0)
         
-        #Print pairwise_scores to og_score_table_out_file
-        pairwise_score_table_out_file = 'OG_Pairwise_Score_Table_'+prefix_genome_file+'.tsv'
-        pairwise_score_table_data_frame = pd.DataFrame.from_dict(pairwise_scores)
-        print(f'Printing OG x CDS pairwise scores table to {pairwise_score_table_out_file}')
-        pairwise_score_table_data_frame.to_csv(pairwise_score_table_out_file,sep="\t",na_rep='NA')
+        #Print the best score of each OG in each genome to og_score_table_out_file and all the valid matches to pairwise_score_table_out_file
+        pairwise_score_table_out_file = table_file_name('OG_Pairwise_Score_Table_'+prefix_genome_file+'.tsv')
+        og_score_table_out_file = write_hmmer_tables(hmmer_out_file,concat_hmmer_file,0.001,50,pairwise_score_table_out_file,og_score_table_out_file)
     
     return(og_score_table_out_file)
 
+def partition_fasta_by_cluster(seq_file,out_dir,seq_clusters,valid_clusters,file_prefix='Unaligned_Cluster_'):
+    #Write the sequences of each cluster in valid_clusters to {out_dir}/{file_prefix}{cluster}.faa in a single pass over seq_file
+    #Records are kept in per cluster buffers that are only flushed when they exceed --og_partition_memory, so unless the sequences do not fit in memory each file is opened and written only once
+    #Files are written to .tmp files first, so re-runs never append to the files of a previous run. Files whose content did not change are kept with their modification time, so the alignments, HMMs and trees made from them are still up to date, and files of clusters that are no longer valid are removed
+    for stale_file in glob.glob(f'{out_dir}/{file_prefix}*.faa.tmp'):
+        os.remove(stale_file)
+    buffers = defaultdict(list)
+    buffered_size = 0
+    max_buffered_size = args.og_partition_memory * (1024 ** 2)
+    handles = OrderedDict()
+    written_clusters = set()
+    for (seq_id,description,seq,body) in iter_seq_records(seq_file,'fasta',args.io_buffer_size):
+        prot_cluster = seq_clusters.get(seq_id)
+        if (prot_cluster in valid_clusters):
+            #Sequences are wrapped as SeqIO.write would
+            record = format_fasta_record(seq_id,description,wrap_sequence(seq))
+            buffers[prot_cluster].append(record)
+            buffered_size += len(record)
+            if (buffered_size > max_buffered_size):
+                flush_cluster_buffers(buffers,handles,written_clusters,out_dir,file_prefix)
+                buffered_size = 0
+    flush_cluster_buffers(buffers,handles,written_clusters,out_dir,file_prefix)
+    for handle in handles.values():
+        handle.close()
+    changed_count = 0
+    for prot_cluster in written_clusters:
+        out_file = f'{out_dir}/{file_prefix}{prot_cluster}.faa'
+        if ((os.path.exists(out_file)) and (filecmp.cmp(f'{out_file}.tmp',out_file,shallow=False))):
+            os.remove(f'{out_file}.tmp')
+        else:
+            os.replace(f'{out_file}.tmp',out_file)
+            changed_count += 1
+    written_files = set(f'{out_dir}/{file_prefix}{prot_cluster}.faa' for prot_cluster in written_clusters)
+    for stale_file in glob.glob(f'{out_dir}/{file_prefix}*.faa'):
+        if (stale_file not in written_files):
+            os.remove(stale_file)
+    print(f'Wrote the sequences of {len(written_clusters)} clusters to {out_dir} ({changed_count} new or changed)')
+
+def flush_cluster_buffers(buffers,handles,written_clusters,out_dir,file_prefix):
+    #handles is kept in least recently used order and capped at og_partition_max_open_files. A .tmp file is truncated the first time it is opened and appended to afterwards
+    for prot_cluster,records in buffers.items():
+        handle = handles.pop(prot_cluster,None)
+        if (handle is None):
+            if (len(handles) >= og_partition_max_open_files):
+                (oldest_cluster,oldest_handle) = handles.popitem(last=False)
+                oldest_handle.close()
+            handle = open(f'{out_dir}/{file_prefix}{prot_cluster}.faa.tmp','ab' if (prot_cluster in written_clusters) else 'wb')
+            written_clusters.add(prot_cluster)
+        handles[prot_cluster] = handle
+        handle.writelines(records)
+    buffers.clear()
+
+def process_og_cluster(prot_cluster,unaligned_file,aligned_file,hmm_file=None,tree_file=None):
+    #Run the muscle -> hmmbuild -> FastTreeMP chain of a single cluster, each program with a single thread
+    #Every output is written to a temporary file and renamed once complete. Steps whose output is newer than their input were finished by a previous run and are skipped, and outputs of a failed step are removed so they are not mistaken for those of the current members
+    single_thread_env = dict(os.environ,OMP_NUM_THREADS='1')
+    if (not is_up_to_date(aligned_file,unaligned_file)):
+        command = f'muscle -in {unaligned_file} -out {aligned_file}.tmp -quiet'
+        if (subprocess.call(command, shell=True) == 0):
+            os.replace(f'{aligned_file}.tmp',aligned_file)
+        else:
+            print(f'Warning: failed to align cluster {prot_cluster}')
+            remove_files([aligned_file,hmm_file,tree_file])
+            return False
+    if ((hmm_file) and (not is_up_to_date(hmm_file,aligned_file))):
+        #Build HMM from alignment
+        command = f'hmmbuild --cpu 1 -n {prot_cluster} {hmm_file}.tmp {aligned_file} > /dev/null'
+        if (subprocess.call(command, shell=True) == 0):
+            os.replace(f'{hmm_file}.tmp',hmm_file)
+        else:
+            print(f'Warning: failed to build the HMM of cluster {prot_cluster}')
+            remove_files([hmm_file])
+    if ((tree_file) and (not is_up_to_date(tree_file,aligned_file))):
+        command = f"FastTreeMP -nosupport -out {tree_file}.tmp {aligned_file}"
+        if (subprocess.call(command, shell=True, env=single_thread_env) == 0):
+            os.replace(f'{tree_file}.tmp',tree_file)
+        else:
+            print(f'Warning: failed to infer the phylogeny of cluster {prot_cluster}')
+            remove_files([tree_file])
+    return True
+
+def is_up_to_date(out_file,in_file):
+    return (os.path.exists(out_file)) and (os.stat(out_file).st_mtime_ns >= os.stat(in_file).st_mtime_ns)
+
+def remove_files(files):
+    for file in files:
+        if ((file) and (os.path.exists(file))):
+            os.remove(file)
+
 def parse_mmseqs_cluster_file(out_mmseqs_cluster_file):
+    #Stream the cluster file of mmseqs (a .tsv where OG is the first column and cds is the second) in chunks of --chunk_size lines. OG names (non word characters replaced by _) and genomes (cds IDs without the _# suffix) are derived with vectorized string operations and coded as integers in the order they are first found
+    #Returns og_table as a sparse Genome x OG count matrix with the genome and OG names of its rows and columns, protein_info with the ID and OG code of each protein and cluster_info with the name and number of members of each OG
     print(f'Parsing {out_mmseqs_cluster_file}')
-    og_table = defaultdict(lambda: defaultdict(int))
-    protein_info = defaultdict(dict)
-    cluster_info = defaultdict(dict)
-    #Output file is a .tsv where OG is the first column and cds is the scond
-    lines = open(out_mmseqs_cluster_file,"r").readlines()
-    compiled_obj = re.compile('\\W')
-    for line in lines:
-        (og,cds) = line.split('\t')
-        og = re.sub(compiled_obj,'_',og)
-        protein_info['OG'][cds.rstrip()] = og
-        genome = re.sub('_(\\d)+$','',cds)
-        genome = genome.rstrip()
-        og_table[og][genome]+= 1
-        #Create OG_Count field in seq info for the genome if it is not already there
-        if (genome not in seq_info['OG_Count'].keys()):
-            seq_info['OG_Count'][genome] = 0
-        seq_info['OG_Count'][genome] += 1
-        #print(og,genome)
-        if (og not in cluster_info['Members'].keys()):
-            cluster_info['Members'][og] = 0
-        cluster_info['Members'][og] += 1
-    
+    genome_codes = dict()
+    og_codes = dict()
+    protein_ids = []
+    protein_genomes = []
+    protein_ogs = []
+    for chunk in pd.read_csv(out_mmseqs_cluster_file,sep='\t',header=None,names=['OG','CDS'],usecols=[0,1],dtype=str,keep_default_na=False,quoting=csv.QUOTE_NONE,chunksize=args.chunk_size):
+        cds_ids = chunk['CDS'].str.rstrip()
+        og_names = chunk['OG'].str.replace('\\W','_',regex=True)
+        genomes = cds_ids.str.replace('_(\\d)+$','',regex=True)
+        #Names are repeated within a chunk, so only the distinct names of each chunk are looked up in the code dictionaries
+        (og_labels,og_uniques) = pd.factorize(og_names)
+        (genome_labels,genome_uniques) = pd.factorize(genomes)
+        protein_ogs.append(encode_ids(og_uniques,og_codes).astype(np.int32)[og_labels])
+        protein_genomes.append(encode_ids(genome_uniques,genome_codes).astype(np.int32)[genome_labels])
+        protein_ids.append(cds_ids.to_numpy(dtype=object))
+    protein_ogs = np.concatenate(protein_ogs) if (len(protein_ogs) > 0) else np.zeros(0,dtype=np.int32)
+    protein_genomes = np.concatenate(protein_genomes) if (len(protein_genomes) > 0) else np.zeros(0,dtype=np.int32)
+    protein_ids = np.concatenate(protein_ids) if (len(protein_ids) > 0) else np.zeros(0,dtype=object)
+    genome_names = np.array(list(genome_codes),dtype=object)
+    og_names = np.array(list(og_codes),dtype=object)
+    print(f'Found {len(protein_ids)} proteins of {len(genome_names)} genomes in {len(og_names)} OGs')
+    #The OG_Count of each genome is its number of clustered proteins
+    seq_info['OG_Count'].assign(genome_names,np.bincount(protein_genomes,minlength=len(genome_names)).astype(np.int64))
+    protein_info = {'Protein': protein_ids, 'OG': protein_ogs}
+    cluster_info = {'OG': og_names, 'Members': np.bincount(protein_ogs,minlength=len(og_names))}
+    og_table = make_og_count_matrix(protein_genomes,protein_ogs,genome_names,list(og_names))
     return(og_table,protein_info,cluster_info)
 
+def make_og_count_matrix(genome_rows,og_cols,genome_names,og_names):
+    #Count the proteins of each genome (row code) in each OG (column code), given in the order of the cluster file. Rows are ordered as in the dense tables built from {OG: {Genome: count}} dictionaries
+    new_codes = nested_dict_row_order(genome_rows.astype(np.int64),og_cols.astype(np.int64),len(genome_names))
+    genome_names = np.array(genome_names,dtype=object)[np.argsort(new_codes)]
+    og_matrix = scipy.sparse.csr_matrix((np.ones(len(genome_rows),dtype=np.int64),(new_codes[genome_rows],og_cols)),shape=(len(genome_names),len(og_names)))
+    return (og_matrix,genome_names,og_names)
+
+def nested_dict_row_order(rows,cols,row_count):
+    #New code of each row (given as row and column codes of the values in the order they were added) so that rows are ordered as pd.DataFrame.from_dict orders the rows of a {column: {row: value}} dictionary: in the order they are found going through the columns
+    if (len(rows) == 0):
+        return np.zeros(row_count,dtype=np.int64)
+    pair_keys = cols.astype(np.int64) * row_count + rows
+    (pair_keys,first_positions) = np.unique(pair_keys,return_index=True)
+    traversal_rows = (pair_keys % row_count)[np.lexsort((first_positions,pair_keys // row_count))]
+    (found_rows,first_found) = np.unique(traversal_rows,return_index=True)
+    new_codes = np.zeros(row_count,dtype=np.int64)
+    new_codes[traversal_rows[np.sort(first_found)]] = np.arange(len(found_rows))
+    return new_codes
+
+def sparse_from_nested_dict(nested_dict):
+    #Convert a {column: {row: value}} dictionary into a sparse matrix with the rows and columns in the order of pd.DataFrame.from_dict. Returns the matrix and the row and column names
+    row_codes = dict()
+    rows = array('q')
+    cols = array('q')
+    values = []
+    for (col,col_values) in enumerate(nested_dict.values()):
+        for (row_name,value) in col_values.items():
+            rows.append(row_codes.setdefault(row_name,len(row_codes)))
+            cols.append(col)
+            values.append(value)
+    matrix = scipy.sparse.csr_matrix((np.array(values,dtype=np.float64),(np.frombuffer(rows,dtype=np.int64),np.frombuffer(cols,dtype=np.int64))),shape=(len(row_codes),len(nested_dict)))
+    return (matrix,np.array(list(row_codes),dtype=object),list(nested_dict))
+
+def write_sparse_table(matrix,row_labels,col_labels,out_file,index_name='Sequence'):
+    #Write a sparse matrix (e.g. Sequence x OG counts or scores) in Matrix Market format (.mtx, with the row and column names in .rows.txt and .cols.txt) and, if it has at most --dense_table_max_cells cells, as a dense table in the --output_format
+    #Absent values are written as 0 and the columns with absent values as floats, as in the tables built from dictionaries. Returns the name of the dense table, or of the .mtx file if the dense table was not written
+    out_prefix = re.sub('\\.(tsv|parquet|feather)$','',out_file)
+    matrix = scipy.sparse.csr_matrix(matrix)
+    write_matrix_market(matrix,row_labels,col_labels,out_prefix)
+    cell_count = matrix.shape[0] * matrix.shape[1]
+    if (cell_count > args.dense_table_max_cells):
+        print(f'Writing only {out_prefix}.mtx, as the {matrix.shape[0]} x {matrix.shape[1]} table has more than --dense_table_max_cells {args.dense_table_max_cells} cells')
+        return f'{out_prefix}.mtx'
+    row_labels = np.array(row_labels,dtype=object)
+    col_labels = list(col_labels)
+    is_full_column = np.bincount(matrix.indices,minlength=matrix.shape[1]) == matrix.shape[0]
+    full_columns = {col_labels[col]: matrix.dtype for col in np.flatnonzero(is_full_column)}
+    #Only one block of rows at a time is dense
+    rows_per_block = max(1,args.chunk_size // max(1,len(col_labels)))
+    with TableWriter(out_file,na_rep=0) as writer:
+        for block_start in range(0,max(1,matrix.shape[0]),rows_per_block):
+            block = matrix[block_start:block_start+rows_per_block].toarray()
+            block_values = block.astype(np.float64)
+            block_values[block == 0] = np.nan
+            block_frame = pd.DataFrame(block_values,index=pd.Index(row_labels[block_start:block_start+rows_per_block],dtype=object,name=index_name),columns=col_labels)
+            if (len(full_columns) > 0):
+                block_frame = block_frame.astype(full_columns)
+            writer.write(block_frame)
+    return writer.out_file
+
+def write_matrix_market(matrix,row_labels,col_labels,out_prefix):
+    #Write matrix to {out_prefix}.mtx and its row and column names, one per line, to {out_prefix}.rows.txt and {out_prefix}.cols.txt
+    scipy.io.mmwrite(f'{out_prefix}.mtx',matrix)
+    with open(f'{out_prefix}.rows.txt','w') as OUT:
+        OUT.writelines(f'{label}\n' for label in row_labels)
+    with open(f'{out_prefix}.cols.txt','w') as OUT:
+        OUT.writelines(f'{label}\n' for label in col_labels)
+
+def write_hmmer_tables(hmmer_out_file,query_file,max_evalue,min_score,pairwise_table_out_file,score_table_out_file=None):
+    #Print the domain matches of hmmer_out_file that pass max_evalue and min_score to pairwise_table_out_file and, if score_table_out_file is given, the best score of each query in each genome as a sparse table (see write_sparse_table). Returns the name of the score table written
+    #Matches are read from the --domtblout file of the search in chunks and filtered and reduced as DataFrames. Searches without one (e.g. --parse_only on the output of older versions) are parsed from the hmmer3-text output with SearchIO
+    domtbl_file = f'{hmmer_out_file}.domtblout'
+    if (not os.path.exists(domtbl_file)):
+        (genome_hmm_scores,pairwise_scores) = parse_hmmer_output(hmmer_out_file,max_evalue,min_score)
+        if (score_table_out_file != None):
+            (score_matrix,genome_names,query_names) = sparse_from_nested_dict(genome_hmm_scores)
+            print(f'Printing OG x Genome score table to {score_table_out_file}')
+            score_table_out_file = write_sparse_table(score_matrix,genome_names,query_names,score_table_out_file)
+        pairwise_score_table_data_frame = pd.DataFrame.from_dict(pairwise_scores)
+        print(f'Printing OG x CDS pairwise scores table to {pairwise_table_out_file}')
+        write_table(pairwise_score_table_data_frame,pairwise_table_out_file)
+        return score_table_out_file
+    print(f'Parsing {domtbl_file}')
+    query_descriptions = read_hmmer_query_descriptions(query_file)
+    pairwise_columns = ['Genome','Query','Subject','Score','e-value','Subject_Description','Query_Description']
+    best_scores = pd.DataFrame(columns=['Query','Genome','Score'])
+    hit_count = 0
+    print(f'Printing OG x CDS pairwise scores table to {pairwise_table_out_file}')
+    with TableWriter(pairwise_table_out_file) as writer:
+        #The header is written even if there are no valid matches
+        writer.write(pd.DataFrame({column: pd.Series(dtype=(np.float64 if (column in ['Score','e-value']) else object)) for column in pairwise_columns}))
+        for hits in iter_hmmer_domain_table(domtbl_file):
+            hits = hits[(hits['Score'] >= min_score) & (hits['e-value'] <= max_evalue)].copy()
+            hits['Genome'] = hits['Subject'].str.replace('_(\\d)+$','',regex=True)
+            hits['Query_Description'] = hits['Query'].map(query_descriptions).fillna('')
+            #Matches are numbered from 1 in the order they are reported, as in the tables built from SearchIO
+            hits.index = np.arange(hit_count+1,hit_count+len(hits)+1)
+            writer.write(hits[pairwise_columns])
+            hit_count += len(hits)
+            #Only positive scores are kept, as 0 is the score of genomes without matches
+            chunk_best = hits.loc[hits['Score'] > 0,['Query','Genome','Score']]
+            if (len(best_scores) > 0):
+                chunk_best = pd.concat([best_scores,chunk_best],ignore_index=True)
+            best_scores = chunk_best.groupby(['Query','Genome'],sort=False)['Score'].max().reset_index()
+    print(f'Found {hit_count} valid matches')
+    if (score_table_out_file != None):
+        #Queries are columns in the order of their first match and genomes are rows grouped by the first query they matched
+        query_order = pd.unique(best_scores['Query'])
+        best_scores['Query_Rank'] = pd.Categorical(best_scores['Query'],categories=query_order).codes
+        genome_order = pd.unique(best_scores.sort_values('Query_Rank',kind='stable')['Genome'])
+        genome_rows = pd.Categorical(best_scores['Genome'],categories=genome_order).codes
+        score_matrix = scipy.sparse.csr_matrix((best_scores['Score'].to_numpy(dtype=np.float64),(genome_rows,best_scores['Query_Rank'].to_numpy())),shape=(len(genome_order),len(query_order)))
+        print(f'Printing OG x Genome score table to {score_table_out_file}')
+        score_table_out_file = write_sparse_table(score_matrix,genome_order,query_order,score_table_out_file)
+    return score_table_out_file
+
+def iter_hmmer_domain_table(domtbl_file,chunk_size=1000000):
+    #Yield the target, query, independent e-value, domain score and target description of each line of a HMMER --domtblout file as DataFrames of up to chunk_size rows
+    #The first 22 columns are separated by spaces and the description of the target, which may contain spaces, takes the rest of the line
+    rows = []
+    with open(domtbl_file) as IN:
+        for line in IN:
+            if (line.startswith('#')):
+                continue
+            fields = line.rstrip('\n').split(None,22)
+            rows.append((fields[0],fields[3],fields[12],fields[13],fields[22] if (len(fields) > 22) else '-'))
+            if (len(rows) >= chunk_size):
+                yield make_hmmer_domain_frame(rows)
+                rows = []
+    if (rows):
+        yield make_hmmer_domain_frame(rows)
+
+def make_hmmer_domain_frame(rows):
+    hits = pd.DataFrame(rows,columns=['Subject','Query','e-value','Score','Subject_Description'])
+    hits['e-value'] = hits['e-value'].astype(float)
+    hits['Score'] = hits['Score'].astype(float)
+    #HMMER prints - for targets without a description
+    hits['Subject_Description'] = hits['Subject_Description'].mask(hits['Subject_Description'] == '-','')
+    return hits
+
+def read_hmmer_query_descriptions(query_file,block_size=16777216):
+    #Descriptions of the queries of a HMMER search, which are not included in its tables: the DESC lines of a HMM file (hmmsearch) or the fasta headers of the CDS file (hmmscan)
+    query_descriptions = {}
+    if (not os.path.isfile(query_file)):
+        return query_descriptions
+    with open(query_file,'rb') as IN:
+        is_hmm_file = IN.read(5) == b'HMMER'
+    if (is_hmm_file == False):
+        for (header,body) in scan_fasta(query_file,block_size):
+            header_fields = header.decode().split(None,1)
+            if (len(header_fields) > 1):
+                query_descriptions[header_fields[0]] = header_fields[1].strip()
+        return query_descriptions
+    #Only the NAME and DESC lines of the HMM file are needed, so it is searched in large blocks split at line ends
+    hmm_name = None
+    pending = b''
+    with open(query_file,'rb') as IN:
+        while True:
+            block = IN.read(block_size)
+            is_last_block = (not block)
+            block = pending + block
+            line_end = len(block) if (is_last_block) else block.rfind(b'\n') + 1
+            pending = block[line_end:]
+            for match in re.finditer(rb'^(NAME|DESC) +(.*?)\s*$',block[:line_end],re.M):
+                if (match.group(1) == b'NAME'):
+                    hmm_name = match.group(2).decode()
+                else:
+                    query_descriptions[hmm_name] = match.group(2).decode()
+            if (is_last_block):
+                break
+    return query_descriptions
+
 def parse_hmmer_output(hmmer_out_file,max_evalue=0.001,min_score=50):
     genome_hmm_scores = defaultdict(dict)
     pairwise_scores = defaultdict(dict)
@@ -978,18 +2107,17 @@ def make_og_table(genome_file,cds_file):
     out_mmseqs_cluster_file = call_mmseqs_cluster(cds_file,prefix_genome_file,args.threads)
     #Parse the output of mmseqs and store Genome x OG count info in og_table
     (og_table,protein_info,cluster_info) = parse_mmseqs_cluster_file(out_mmseqs_cluster_file)
-    og_table_out_file = 'OG_Count_Table_'+prefix_genome_file+'.tsv'
-    og_table_data_frame = pd.DataFrame.from_dict(og_table)
-    og_table_data_frame.index.name = 'Sequence'
+    og_table_out_file = table_file_name('OG_Count_Table_'+prefix_genome_file+'.tsv')
+    (og_matrix,genome_names,og_names) = og_table
     print(f'Printing OG table to {og_table_out_file}')
-    og_table_data_frame.to_csv(og_table_out_file,sep="\t",na_rep=0)
+    og_table_out_file = write_sparse_table(og_matrix,genome_names,og_names,og_table_out_file)
     return(og_table_out_file)
     
 def call_mmseqs_cluster(cds_file,prefix_genome_file,threads):
     print('Running mmseqs easy-cluster')
     command = f'mmseqs easy-cluster {cds_file} {prefix_genome_file} tmp --threads {threads} -c 0.3 -s 7.5 --min-seq-id 0.25 --cov-mode 0'
-    subprocess.call(command, shell=True)
     out_mmseqs_cluster_file = prefix_genome_file+'_cluster.tsv'
+    run_command('mmseqs_cluster',command,[cds_file],[out_mmseqs_cluster_file,prefix_genome_file+'_rep_seq.fasta'])
     return out_mmseqs_cluster_file
         
 def make_pops(genome_file,gene_file):
@@ -997,75 +2125,191 @@ def make_pops(genome_file,gene_file):
     #check if there is a genes file. Otherwise run prodigal
     if (not gene_file):
         exit('No gene file identified for viral population clustering. Either call prodigal or provide a gene file')
+    #If an existing viral population catalogue was provided only update it with the new genomes
+    if ((args.pops_catalogue != 'NA') and (os.path.exists(f'{args.pops_catalogue}/Population_Assignments.tsv'))):
+        return update_pops_catalogue(args.pops_catalogue,genome_file,gene_file)
     #Build blast db of the genes file
     prefix_genome_file = get_prefix(genome_file,args.in_format)
     blastn_out_file_name = prefix_genome_file+'xSelf.blastn'
     if (args.parse_only == False):
-        print('Building BLAST Nucleotide DB')
-        command = f'makeblastdb -in {gene_file} -dbtype nucl -title  DB_Genes_{prefix_genome_file} -out  DB_Genes_{prefix_genome_file}'
-        subprocess.call(command, shell=True)
+        genes_db = build_blast_db(input_file=gene_file,out_db=f'DB_Genes_{prefix_genome_file}')
         #Call blastn 
         print('Performing BLASTN search')
-        command = f"blastn -db  DB_Genes_{prefix_genome_file} -query {gene_file} -out {blastn_out_file_name} -outfmt 6 -evalue 0.001 -perc_identity 30 -max_target_seqs 999999 -num_threads {args.threads}"
-        subprocess.call(command, shell=True)
+        command = f"blastn -db {genes_db} -query {gene_file} -out {blastn_out_file_name} -outfmt 6 -evalue 0.001 -perc_identity 30 -max_target_seqs 999999 -num_threads {args.threads}"
+        run_command('make_pops_blastn',command,[gene_file],[blastn_out_file_name])
     
-    #Parse the output of BLASTN
+    #Parse the output of BLASTN in chunks and reduce it to the scores of each genome pair
     print ('Parsing BLASTN output',blastn_out_file_name)
-    #Seen hits will keep track of the seen CDS pairs so to not overestimate ANI and Perc matched genes
-    seen_hits = defaultdict(dict)
-    scores = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
-    #Iterare over queries
-    for qresult in SearchIO.parse(blastn_out_file_name, 'blast-tab'):
-        #Iterate over hits in the query
-        for hit in qresult.hits:
-            #Iterate over HSPs in the hits
-            for hsp in hit.hsps:
-                #Check if the HSP passes established blast cutoffs
-                is_valid = check_match_cutoff(hsp,0.001,30,30,30)
-                if (is_valid):
-                    #Derive the original scaffold name from the CDS id
-                    genomeA = re.sub('_(\\d)+$','',qresult.id)
-                    genomeB = re.sub('_(\\d)+$','',hit.id)
-                    #Only go on if matches are between two different scaffolds and two different CDS
-                    if ((genomeA != genomeB) and (qresult.id != hit.id)):
-                        #print(genomeA,genomeB,hsp)
-                        #Only go on if the query/hit pair has not been processed before
-                        if (genomeB not in seen_hits[qresult.id].keys()):
-                            seen_hits[qresult.id][genomeB] = 1
-                            scores['Matched_CDS'][genomeA][genomeB] += 1
-                            scores['Perc_Matched_CDS'][genomeA][genomeB] += ((1 / seq_info['Gene_Count'][genomeA]) * 100)
-                            scores['ID_Sum'][genomeA][genomeB] += hsp.ident_pct
-                            #initialize variables in the scores dictionary if they are not there already
-                            
-            
-    
-    #Now that the output of BLASTN has been parsed move forward to calculate the ANI by iterating through scores
-    pop_counter = 0
+    pair_scores = aggregate_blast_pairs(blastn_out_file_name,seq_info['Gene_Count'].to_series(),0.001,30,30,30,chunk_size=args.chunk_size,max_pairs_in_memory=args.max_pairs_in_memory)
+    pair_scores.insert(2,'ANI',pair_scores['ID_Sum'] / pair_scores['Matched_CDS'])
+    #Export the pairwise ANI edges so they do not need to be recomputed downstream
+    ani_edges_out_file = prefix_genome_file+'xSelf_ANI_Edges.tsv'
+    print(f'Printing pairwise ANI edges to {ani_edges_out_file}')
+    pair_scores[['Genome_A','Genome_B','ANI','Matched_CDS','Perc_Matched_CDS']].to_csv(ani_edges_out_file,sep="\t",index=False,na_rep='NA')
     print ('Calculating sequence match scores and assigning populations')
-    #iterate over genomes ordered by their Length
-    for genomeA in sorted(seq_info['Length'], key=seq_info['Length'].get, reverse=True):
-        #print(genomeA,seq_info['Length'][genomeA])
-        #If genomeA has not been assigned to a population yet, increment pop_counter and assign genome A to that population
-        if (genomeA not in seq_info['Population'].keys()):
-            pop_counter += 1
-            seq_info['Population'][genomeA] = 'VP_'+str(pop_counter)
-            seq_info['Population_Representative'][genomeA] = True
-        #Now iterate over all genomes that have matches to genomeA
-        for genomeB in scores['ID_Sum'][genomeA].keys():
-            #Only consider those pairs for which genomeB has not been assigned to a population and that have a defined Matched_CDS count in scores
-            if ((genomeB not in seq_info['Population'].keys()) and (scores['Matched_CDS'][genomeB][genomeA] > 0)  and (scores['Matched_CDS'][genomeA][genomeB] > 0)):
-                #Calculate ANI now that the ID_SUM and Matched CDS are complete
-                scores['ANI'][genomeB][genomeA] = scores['ID_Sum'][genomeB][genomeA] / scores['Matched_CDS'][genomeB][genomeA]
-                #print(genomeA,seq_info['Length'][genomeA],genomeB,scores['ANI'][genomeB][genomeA],scores['Perc_Matched_CDS'][genomeB][genomeA])
-                #Test if the scores of ANI and Perc matched CDS pass the cutoffs
-                is_same_vp = check_vp_cutoff(scores['ANI'][genomeB][genomeA],scores['Matched_CDS'][genomeB][genomeA],scores['Perc_Matched_CDS'][genomeB][genomeA],95,3,80)
-                if (is_same_vp):
-                    #print(genomeA,seq_info['Length'][genomeA],genomeB,scores['ANI'][genomeA][genomeB],scores['Perc_Matched_CDS'][genomeA][genomeB])
-                    #If is within the cutoff to assign to the same VP, assing genomeB to the same VP as genomeA
-                    seq_info['Population'][genomeB] = seq_info['Population'][genomeA]
-                    seq_info['Population_Representative'][genomeB] = False
+    (genome_ids,populations,representatives) = assign_populations(pair_scores,seq_info['Length'].to_series(),args.vp_min_ani,args.vp_min_matched,args.vp_min_perc_matched)
+    is_assigned = populations > 0
+    assigned_ids = genome_ids[is_assigned]
+    seq_info['Population'].assign(assigned_ids,['VP_'+str(population) for population in populations[is_assigned]])
+    seq_info['Population_Representative'].assign(assigned_ids,representatives[is_assigned])
+    print(f'Assigned {len(assigned_ids)} sequences to {int(representatives.sum())} viral populations')
+    if ((args.pops_catalogue != 'NA') and (args.parse_only == False)):
+        create_pops_catalogue(args.pops_catalogue,gene_file,assigned_ids,populations[is_assigned],representatives[is_assigned])
     return 1
 
+def create_pops_catalogue(catalogue_dir,gene_file,genome_ids,populations,representatives):
+    #Persist the viral populations so later runs only need to search new genomes: the population of each genome in Population_Assignments.tsv, and the genes of the representatives as BLAST databases listed in Representative_DB_Volumes.txt
+    print(f'Creating viral population catalogue in {catalogue_dir}')
+    os.makedirs(catalogue_dir,exist_ok=True)
+    catalogue = pd.DataFrame({'Length': seq_info['Length'].to_series().reindex(genome_ids).to_numpy(), 'Population': ['VP_'+str(population) for population in populations], 'Population_Representative': representatives},index=pd.Index(genome_ids,name='Sequence'))
+    write_pops_catalogue(catalogue_dir,catalogue)
+    add_catalogue_representatives(catalogue_dir,gene_file,set(genome_ids[representatives]))
+
+def update_pops_catalogue(catalogue_dir,genome_file,gene_file):
+    #Incremental viral population clustering. Genes of the genomes that are not in the catalogue yet are searched against the representatives of the catalogue and against each other, and the new genomes are assigned with the same greedy rules as make_pops.
+    #Representatives keep their populations, so VP identifiers are stable across updates
+    print(f'Updating viral population catalogue in {catalogue_dir}')
+    catalogue = pd.read_csv(f'{catalogue_dir}/Population_Assignments.tsv',sep='\t',index_col='Sequence',dtype={'Sequence': str, 'Population': str})
+    genome_lengths = seq_info['Length'].to_series()
+    new_lengths = genome_lengths[~genome_lengths.index.isin(catalogue.index)]
+    print(f'Found {len(new_lengths)} new sequences and {len(genome_lengths) - len(new_lengths)} sequences already in the catalogue')
+    if (len(new_lengths) > 0):
+        prefix_genome_file = get_prefix(genome_file,args.in_format)
+        new_gene_file = f'New_Genes_{prefix_genome_file}.fna'
+        blastn_out_file_name = prefix_genome_file+'xCatalogue.blastn'
+        new_genomes = set(new_lengths.index)
+        if (args.parse_only == False):
+            filter_fasta_by_genome(gene_file,new_gene_file,new_genomes)
+            new_genes_db = build_blast_db(input_file=new_gene_file)
+            search_dbs = [f'{catalogue_dir}/{volume}' for volume in read_catalogue_volumes(catalogue_dir)] + [new_genes_db]
+            print('Performing BLASTN search')
+            command = f"blastn -db \"{' '.join(search_dbs)}\" -query {new_gene_file} -out {blastn_out_file_name} -outfmt 6 -evalue 0.001 -perc_identity 30 -max_target_seqs 999999 -num_threads {args.threads}"
+            #The catalogue is only updated from a complete search
+            if (run_command('pops_catalogue_blastn',command,[new_gene_file,f'{catalogue_dir}/Population_Assignments.tsv'],[blastn_out_file_name]) != 0):
+                raise Exception(f'BLASTN search of the new genes against the viral population catalogue {catalogue_dir} failed')
+        print ('Parsing BLASTN output',blastn_out_file_name)
+        pair_scores = aggregate_blast_pairs(blastn_out_file_name,seq_info['Gene_Count'].to_series(),0.001,30,30,30,chunk_size=args.chunk_size,max_pairs_in_memory=args.max_pairs_in_memory)
+        pair_scores.insert(2,'ANI',pair_scores['ID_Sum'] / pair_scores['Matched_CDS'])
+        ani_edges_out_file = prefix_genome_file+'xCatalogue_ANI_Edges.tsv'
+        print(f'Printing pairwise ANI edges to {ani_edges_out_file}')
+        pair_scores[['Genome_A','Genome_B','ANI','Matched_CDS','Perc_Matched_CDS']].to_csv(ani_edges_out_file,sep="\t",index=False,na_rep='NA')
+        #Genes of the representatives were not used as queries. Their matches to new genomes are taken from the reverse direction, which is only used to require that both genomes matched each other
+        representative_pairs = pair_scores[~pair_scores['Genome_B'].isin(new_genomes)]
+        mirrored_pairs = representative_pairs.rename(columns={'Genome_A': 'Genome_B', 'Genome_B': 'Genome_A'})
+        pair_scores = pd.concat([pair_scores,mirrored_pairs],ignore_index=True)
+        representatives = catalogue[catalogue['Population_Representative'] == True]
+        lengths = pd.concat([representatives['Length'],new_lengths])
+        initial_populations = representatives['Population'].str.replace('VP_','',regex=False).astype(np.int64)
+        if (len(catalogue) > 0):
+            next_population = int(catalogue['Population'].str.replace('VP_','',regex=False).astype(np.int64).max()) + 1
+        else:
+            next_population = 1
+        (genome_ids,populations,new_representatives) = assign_populations(pair_scores,lengths,args.vp_min_ani,args.vp_min_matched,args.vp_min_perc_matched,initial_populations,next_population)
+        is_new = (populations > 0) & np.isin(genome_ids,new_lengths.index)
+        new_assignments = pd.DataFrame({'Length': new_lengths.reindex(genome_ids[is_new]).to_numpy(), 'Population': ['VP_'+str(population) for population in populations[is_new]], 'Population_Representative': new_representatives[is_new]},index=pd.Index(genome_ids[is_new],name='Sequence'))
+        print(f'Assigned {int(is_new.sum())} new sequences to viral populations, of which {int(new_representatives.sum())} are new viral populations')
+        catalogue = pd.concat([catalogue,new_assignments])
+        if (args.parse_only == False):
+            write_pops_catalogue(catalogue_dir,catalogue)
+            add_catalogue_representatives(catalogue_dir,new_gene_file,set(genome_ids[new_representatives]))
+    #Report the populations of all the sequences of this run
+    run_assignments = catalogue[catalogue.index.isin(genome_lengths.index)]
+    seq_info['Population'].assign(run_assignments.index,run_assignments['Population'].to_numpy())
+    seq_info['Population_Representative'].assign(run_assignments.index,run_assignments['Population_Representative'].to_numpy())
+    return 1
+
+def write_pops_catalogue(catalogue_dir,catalogue):
+    #Write to a temporary file first, so an interrupted run does not leave a truncated catalogue behind
+    catalogue_file = f'{catalogue_dir}/Population_Assignments.tsv'
+    catalogue.to_csv(catalogue_file+'.tmp',sep='\t',na_rep='NA')
+    os.replace(catalogue_file+'.tmp',catalogue_file)
+
+def read_catalogue_volumes(catalogue_dir):
+    volumes_file = f'{catalogue_dir}/Representative_DB_Volumes.txt'
+    if (not os.path.exists(volumes_file)):
+        return []
+    with open(volumes_file) as IN:
+        return [line.rstrip() for line in IN if line.strip()]
+
+def add_catalogue_representatives(catalogue_dir,gene_file,representative_genomes):
+    #Genes of new representatives are added as a new BLAST database volume, so the existing ones never need to be rebuilt
+    volumes = read_catalogue_volumes(catalogue_dir)
+    volume = f'Representative_Genes_{len(volumes) + 1}'
+    gene_count = filter_fasta_by_genome(gene_file,f'{catalogue_dir}/{volume}.fna',representative_genomes)
+    if (gene_count > 0):
+        build_blast_db(input_file=f'{catalogue_dir}/{volume}.fna',out_db=f'{catalogue_dir}/DB_{volume}',use_cache=False)
+        with open(f'{catalogue_dir}/Representative_DB_Volumes.txt','a') as OUT:
+            OUT.write(f'DB_{volume}\n')
+    print(f'Added {gene_count} genes from {len(representative_genomes)} representative sequences to the catalogue')
+
+def filter_fasta_by_genome(in_seq_file,out_seq_file,genomes):
+    #Copy the gene/CDS records of the given genomes (the gene ID without its trailing _<number>) to out_seq_file
+    gene_count = 0
+    out_buffer = []
+    out_buffer_size = 0
+    with open(out_seq_file,'wb') as OUT:
+        for (header,body) in scan_fasta(in_seq_file,args.io_buffer_size):
+            seq_id = header.decode().split(None,1)[0] if header else ''
+            if (seq_id.rsplit('_',1)[0] in genomes):
+                gene_count += 1
+                out_buffer.append(b'>' + header + b'\n' + body.rstrip(b'\r\n') + b'\n')
+                out_buffer_size += len(out_buffer[-1])
+                if (out_buffer_size >= args.io_buffer_size):
+                    OUT.write(b''.join(out_buffer))
+                    out_buffer = []
+                    out_buffer_size = 0
+        OUT.write(b''.join(out_buffer))
+    return gene_count
+
+def assign_populations(pair_scores,genome_lengths,min_ani,min_matched,min_perc_matched,initial_populations=None,next_population=1):
+    #Greedy viral population (VP) assignment. Genomes are visited from the longest to the shortest, each genome not yet in a VP becomes the representative of a new one (numbered from next_population), and then claims every unassigned genome that matches it.
+    #Genome A claims genome B when both directions were matched and the ANI, matched genes and percentage of matched genes of B against A pass the cutoffs. These tests are done on all pairs at once, and the claims are stored as a sparse row per genome
+    genome_codes = dict()
+    encode_ids(genome_lengths.index,genome_codes)
+    genome_a = encode_ids(pair_scores['Genome_A'].to_numpy(),genome_codes)
+    genome_b = encode_ids(pair_scores['Genome_B'].to_numpy(),genome_codes)
+    #Genomes can start already assigned to a population (e.g. the representatives of a catalogue). They are not reassigned but still claim other genomes
+    if (initial_populations is not None):
+        initial_genomes = encode_ids(initial_populations.index,genome_codes)
+    genome_count = len(genome_codes)
+    #Find the reverse pair (B,A) of every pair (A,B) through their sorted integer keys
+    pair_keys = genome_a * genome_count + genome_b
+    key_order = np.argsort(pair_keys,kind='stable')
+    sorted_keys = pair_keys[key_order]
+    reverse_keys = genome_b * genome_count + genome_a
+    reverse_pos = np.minimum(np.searchsorted(sorted_keys,reverse_keys),max(len(sorted_keys) - 1,0))
+    has_reverse = (sorted_keys[reverse_pos] == reverse_keys) if (len(sorted_keys) > 0) else np.zeros(0,dtype=bool)
+    reverse = key_order[reverse_pos]
+    matched = pair_scores['Matched_CDS'].to_numpy()
+    ani = pair_scores['ANI'].to_numpy()
+    perc_matched = pair_scores['Perc_Matched_CDS'].to_numpy()
+    is_claim = has_reverse & (matched > 0)
+    is_claim[is_claim] = (matched[reverse[is_claim]] > 0) & (ani[reverse[is_claim]] >= min_ani) & (matched[reverse[is_claim]] >= min_matched) & (perc_matched[reverse[is_claim]] >= min_perc_matched)
+    #Sparse rows (CSR layout) with the genomes claimed by each genome
+    claim_a = genome_a[is_claim]
+    claim_order = np.argsort(claim_a,kind='stable')
+    claimed = genome_b[is_claim][claim_order]
+    claim_ptr = np.zeros(genome_count + 1,dtype=np.int64)
+    np.cumsum(np.bincount(claim_a,minlength=genome_count),out=claim_ptr[1:])
+    #Visit genomes by decreasing length. Ties keep the order of seq_info
+    visit_order = np.argsort(-genome_lengths.to_numpy(dtype=np.int64),kind='stable')
+    populations = np.zeros(genome_count,dtype=np.int64)
+    representatives = np.zeros(genome_count,dtype=bool)
+    if (initial_populations is not None):
+        populations[initial_genomes] = initial_populations.to_numpy()
+    pop_counter = next_population - 1
+    for genome in visit_order:
+        if (populations[genome] == 0):
+            pop_counter += 1
+            populations[genome] = pop_counter
+            representatives[genome] = True
+        (row_start,row_end) = (claim_ptr[genome],claim_ptr[genome + 1])
+        if (row_end > row_start):
+            row = claimed[row_start:row_end]
+            populations[row[populations[row] == 0]] = populations[genome]
+    genome_ids = np.array(list(genome_codes),dtype=object)
+    return (genome_ids,populations,representatives)
+
 def check_vp_cutoff(pair_ani,pair_matched,pair_perc_matched,cutoff_ani,cutoff_matched,cutoff_perc_matched):    
     if ((pair_ani < cutoff_ani) or (pair_matched < cutoff_matched) or (pair_perc_matched < cutoff_perc_matched)):
         return False
@@ -1084,40 +2328,175 @@ def check_hmmer_match_cutoff(hsp,max_evalue,min_bitscore):
     else:
         return True
         
-def call_vhmnet(genome_file):
+def aggregate_blast_pairs(blast_file,gene_counts,max_evalue,min_bitscore,min_ident,min_ali,ident_scale=1,chunk_size=1000000,max_pairs_in_memory=20000000):
+    #Reduce a BLAST tabular (outfmt 6 / m8) file of gene x gene matches to per genome pair scores: Matched_CDS, Perc_Matched_CDS (relative to the gene counts of the query genome) and ID_Sum.
+    pair_scores = pd.concat(list(iter_blast_pair_scores(blast_file,gene_counts,max_evalue,min_bitscore,min_ident,min_ali,ident_scale,chunk_size,max_pairs_in_memory)),ignore_index=True)
+    print(f'Collected scores for {len(pair_scores)} genome pairs from {blast_file}')
+    return pair_scores
+
+def iter_blast_pair_scores(blast_file,gene_counts,max_evalue,min_bitscore,min_ident,min_ali,ident_scale=1,chunk_size=1000000,max_pairs_in_memory=20000000):
+    #The file is read in chunks of typed columns and only the partial sums per genome pair are kept, so memory depends on the number of genome pairs and not on the size of the file
+    #If the partial sums grow beyond max_pairs_in_memory they are spilled to disk in buckets of query genomes, and the scores are then yielded one bucket at a time
+    genome_codes = dict()
+    partials = []
+    partial_rows = 0
+    #Partial sums are only summed again once the pending rows reach twice the size of the last sum, so each row is summed a logarithmic number of times instead of once per chunk
+    sum_threshold = chunk_size
+    carry = None
+    spill_dir = None
+    spill_count = 0
+    if (os.path.getsize(blast_file) > 0):
+        reader = pd.read_csv(blast_file,sep='\t',header=None,names=blast_tab_columns,usecols=['qseqid','sseqid','pident','length','evalue','bitscore'],dtype=blast_tab_dtypes,chunksize=chunk_size)
+        for chunk in reader:
+            if (carry is not None):
+                chunk = pd.concat([carry,chunk],ignore_index=True)
+            #Matches of the last query in the chunk may continue in the next one, so they are held back until all of them have been read
+            is_last_query = (chunk['qseqid'] == chunk['qseqid'].iat[-1]).to_numpy()
+            carry = chunk[is_last_query]
+            partials.append(reduce_blast_chunk(chunk[~is_last_query],genome_codes,max_evalue,min_bitscore,min_ident,min_ali,ident_scale))
+            partial_rows += len(partials[-1])
+            if (partial_rows > sum_threshold):
+                partials = [sum_pair_partials(partials)]
+                partial_rows = len(partials[0])
+                sum_threshold = max(chunk_size,2 * partial_rows)
+                if (partial_rows > max_pairs_in_memory):
+                    if (spill_dir is None):
+                        spill_dir = tempfile.mkdtemp(prefix='Spill_Pair_Scores_',dir='.')
+                        print(f'Spilling partial genome pair scores of {blast_file} to {spill_dir}')
+                    spill_pair_partial(partials[0],spill_dir,spill_count)
+                    spill_count += 1
+                    partials = []
+                    partial_rows = 0
+                    sum_threshold = chunk_size
+        if (carry is not None):
+            partials.append(reduce_blast_chunk(carry,genome_codes,max_evalue,min_bitscore,min_ident,min_ali,ident_scale))
+    genome_names = np.array(list(genome_codes),dtype=object)
+    if (spill_dir is None):
+        yield finalize_pair_scores(sum_pair_partials(partials),genome_names,gene_counts)
+    else:
+        spill_pair_partial(sum_pair_partials(partials),spill_dir,spill_count)
+        spill_count += 1
+        partials = []
+        for bucket in range(pair_spill_buckets):
+            bucket_partials = [load_pair_partial(f'{spill_dir}/Bucket_{bucket}_Part_{part}.npz') for part in range(spill_count)]
+            yield finalize_pair_scores(sum_pair_partials(bucket_partials),genome_names,gene_counts)
+        shutil.rmtree(spill_dir)
+
+def finalize_pair_scores(pair_partial,genome_names,gene_counts):
+    #Translate the genome codes back to names and calculate the percentage of matched CDS
+    pair_scores = pair_partial.reset_index()
+    pair_scores.insert(0,'Genome_A',genome_names[pair_scores.pop('Genome_A_Code').to_numpy()])
+    pair_scores.insert(1,'Genome_B',genome_names[pair_scores.pop('Genome_B_Code').to_numpy()])
+    genome_gene_counts = gene_counts.reindex(pair_scores['Genome_A']).to_numpy(dtype=np.float64,na_value=np.nan)
+    pair_scores.insert(3,'Perc_Matched_CDS',(pair_scores['Matched_CDS'].to_numpy() * 100) / genome_gene_counts)
+    return pair_scores
+
+def spill_pair_partial(pair_partial,spill_dir,part):
+    #Write partial pair sums to disk, split in buckets by the query genome so each bucket can later be summed on its own
+    genome_a = pair_partial.index.get_level_values('Genome_A_Code').to_numpy(dtype=np.int64)
+    genome_b = pair_partial.index.get_level_values('Genome_B_Code').to_numpy(dtype=np.int64)
+    matched = pair_partial['Matched_CDS'].to_numpy(dtype=np.int64)
+    id_sum = pair_partial['ID_Sum'].to_numpy(dtype=np.float64)
+    buckets = genome_a % pair_spill_buckets
+    for bucket in range(pair_spill_buckets):
+        in_bucket = buckets == bucket
+        np.savez(f'{spill_dir}/Bucket_{bucket}_Part_{part}.npz',genome_a=genome_a[in_bucket],genome_b=genome_b[in_bucket],matched=matched[in_bucket],id_sum=id_sum[in_bucket])
+
+def load_pair_partial(spill_file):
+    with np.load(spill_file) as spilled:
+        pair_index = pd.MultiIndex.from_arrays([spilled['genome_a'],spilled['genome_b']],names=['Genome_A_Code','Genome_B_Code'])
+        return pd.DataFrame({'Matched_CDS': spilled['matched'], 'ID_Sum': spilled['id_sum']},index=pair_index)
+
+def reduce_blast_chunk(chunk,genome_codes,max_evalue,min_bitscore,min_ident,min_ali,ident_scale=1):
+    #BLAST lists the HSPs of each hit together, so the file order is the order in which SearchIO iterated over them
+    #Apply the same cutoffs as check_match_cutoff to the whole chunk
+    is_valid = ((chunk['bitscore'] >= min_bitscore) & (chunk['evalue'] <= max_evalue) & (chunk['pident'] >= min_ident) & (chunk['length'] >= min_ali)).to_numpy()
+    chunk = chunk[is_valid]
+    genome_a = gene_ids_to_genome_codes(chunk['qseqid'].to_numpy(),genome_codes)
+    genome_b = gene_ids_to_genome_codes(chunk['sseqid'].to_numpy(),genome_codes)
+    #Only matches between two different scaffolds are considered (which also rules out self matches of a CDS), and only the first valid match of each query CDS to each subject genome is counted
+    hits = pd.DataFrame({'Query': pd.factorize(chunk['qseqid'])[0], 'Genome_A_Code': genome_a, 'Genome_B_Code': genome_b, 'ID_Sum': chunk['pident'].to_numpy() * ident_scale})
+    hits = hits[genome_a != genome_b].drop_duplicates(['Query','Genome_B_Code'],keep='first')
+    partial = hits.groupby(['Genome_A_Code','Genome_B_Code'],sort=False).agg(Matched_CDS=('Query','size'),ID_Sum=('ID_Sum','sum'))
+    return partial
+
+def sum_pair_partials(partials):
+    #Add up the partial scores of the same genome pairs
+    if (len(partials) == 0):
+        empty_index = pd.MultiIndex.from_arrays([np.zeros(0,dtype=np.int64),np.zeros(0,dtype=np.int64)],names=['Genome_A_Code','Genome_B_Code'])
+        return pd.DataFrame({'Matched_CDS': np.zeros(0,dtype=np.int64), 'ID_Sum': np.zeros(0,dtype=np.float64)},index=empty_index)
+    return pd.concat(partials).groupby(level=['Genome_A_Code','Genome_B_Code'],sort=False).sum()
+
+def gene_ids_to_genome_codes(gene_ids,genome_codes):
+    #Derive the scaffold of each gene/CDS ID by removing its trailing _<number>, running the regular expression only once per distinct ID, and return it as an integer code from genome_codes
+    (codes,uniques) = pd.factorize(gene_ids)
+    genomes = pd.Series(uniques,dtype=object).str.replace('_(\\d)+$','',regex=True).to_numpy()
+    return encode_ids(genomes,genome_codes)[codes]
+
+def encode_ids(ids,id_codes):
+    #Return an integer code for each ID, adding unseen IDs to the id_codes dictionary
+    return np.fromiter((id_codes.setdefault(seq_id,len(id_codes)) for seq_id in ids),dtype=np.int64,count=len(ids))
+
+def call_vhmnet(genome_file,threads=None):
+    if (threads is None):
+        threads = args.threads
     print("Running viral host prediction with VirHostMatcher-Net")
     prefix_genome_file = get_prefix(genome_file,args.in_format)
     vhmnet_out_dir = 'VHMNet_Output_'+prefix_genome_file
     if (args.parse_only == False):
         split_genomes_dir = 'Split_Genomes_'+prefix_genome_file
-        explode_fasta(genome_file,split_genomes_dir)
+        #Predictions are written to one file per virus, so each batch of split genomes can be run separately into the same output directory
+        split_dirs = split_genomes(genome_file,split_genomes_dir,args.split_batch_size,threads)
         subprocess.call(f'mkdir {vhmnet_out_dir}', shell=True)
-        if (args.vhmnet_mode_short):
-            command = f'VirHostMatcher-Net.py -q {split_genomes_dir} -o {vhmnet_out_dir} -t {args.threads} -i tmp -n 10 --short-contig'
-        else:
-            command = f'VirHostMatcher-Net.py -q {split_genomes_dir} -o {vhmnet_out_dir} -t {args.threads} -i tmp -n 10'
-        subprocess.call(command, shell=True)
+        for split_dir in split_dirs:
+            if (args.vhmnet_mode_short):
+                command = f'VirHostMatcher-Net.py -q {split_dir} -o {vhmnet_out_dir} -t {threads} -i tmp -n 10 --short-contig'
+            else:
+                command = f'VirHostMatcher-Net.py -q {split_dir} -o {vhmnet_out_dir} -t {threads} -i tmp -n 10'
+            subprocess.call(command, shell=True)
     return(vhmnet_out_dir)
 
-def call_checkv(genome_file):
+def call_checkv(genome_file,threads=None):
+    if (threads is None):
+        threads = args.threads
     print("Running viral sequence quality checking with CheckV")
     prefix_genome_file = get_prefix(genome_file,args.in_format)
     checkv_out_dir = 'CheckV_'+prefix_genome_file
-    command = f'checkv end_to_end {genome_file} {checkv_out_dir} -t {args.threads}'
+    command = f'checkv end_to_end {genome_file} {checkv_out_dir} -t {threads}'
     subprocess.call(command, shell=True)
     checkv_out_summary_file = f'{checkv_out_dir}/quality_summary.tsv'
     return checkv_out_summary_file
 
 def index_info(table_file,index_col_name,sep_var='\t',header='infer'):
     print(f'Reading info from {table_file}')
+    #Output tables of Virathon may also be in the parquet or feather formats (see --output_format)
+    if (table_file.endswith('.parquet') or table_file.endswith('.feather')):
+        info_data_frame = pd.read_parquet(table_file) if (table_file.endswith('.parquet')) else pd.read_feather(table_file)
+        if (index_col_name != None):
+            info_data_frame = info_data_frame.set_index(index_col_name)
+        return info_data_frame
     info_data_frame = pd.read_csv(table_file, sep=sep_var,index_col=index_col_name,header=header)
     return info_data_frame
+
+def table_file_name(out_file):
+    #Name of an output table in the --output_format: the .tsv extension of out_file is replaced by .parquet or .feather
+    if ((args.output_format == 'tsv') or (not out_file.endswith('.tsv'))):
+        return out_file
+    return re.sub('\\.tsv$','',out_file)+'.'+args.output_format
+
+def write_table(data_frame,out_file,na_rep='NA'):
+    #Write data_frame and its index to out_file in the --output_format and return the name of the file written. Missing values are written as na_rep in .tsv tables, and filled with na_rep in the numeric columns of the columnar formats when it is not 'NA'
+    with TableWriter(out_file,na_rep) as writer:
+        writer.write(data_frame)
+    return writer.out_file
     
-def call_vibrant(genome_file):
+def call_vibrant(genome_file,threads=None):
+    if (threads is None):
+        threads = args.threads
     #Run VIBRANT with default parameters
     if (args.parse_only == False):
         print("Running virus identification with VIBRANT")
-        command = f'VIBRANT_run.py -i {genome_file} -t {args.threads}'
+        command = f'VIBRANT_run.py -i {genome_file} -t {threads}'
         subprocess.call(command, shell=True)
     prefix_genome_file = get_prefix(genome_file,args.in_format)
     vibrant_out_dir = 'VIBRANT_'+prefix_genome_file+'/VIBRANT_results_'+prefix_genome_file
@@ -1132,7 +2511,7 @@ def call_prodigal(genome_file="All_Genomic.fasta"):
     gff_file = 'All_Genomic.gff'
     if (args.parse_only == False):
         command = f'prodigal -q -p meta -a {cds_file} -d {gene_file} -f gff -i {genome_file} -o {gff_file}'
-        subprocess.call(command, shell=True)
+        run_command('prodigal_gene_calling',command,[genome_file],[cds_file,gene_file,gff_file])
 
 
 def make_plots(info_dataframe,merged_genomes_file,output_figure_file,og_table_out_file,og_score_table_out_file,group_var):
@@ -1204,7 +2583,8 @@ def make_plots(info_dataframe,merged_genomes_file,output_figure_file,og_table_ou
     composite_plot.savefig(output_figure_file)
     plt.close()
     
-    if (og_table_out_file != 'NA' ):
+    #Tables only written in the sparse format are too large for a heatmap
+    if ((og_table_out_file != 'NA') and (not og_table_out_file.endswith('.mtx'))):
         og_dataframe = index_info(og_table_out_file,'Sequence')
         filtered_og_dataframe = og_dataframe[og_dataframe.columns[og_dataframe.sum()>3]]
         (ideal_height,ideal_width) = filtered_og_dataframe.shape
@@ -1212,7 +2592,7 @@ def make_plots(info_dataframe,merged_genomes_file,output_figure_file,og_table_ou
         og_heatmap_plot = sns.heatmap(filtered_og_dataframe,ax=ax,xticklabels=False,center=1,cmap="viridis") 
         figure.savefig(f'Heatmap_{prefix_genome_file}_OG_Count.png')
     
-    if (og_score_table_out_file != 'NA' ):
+    if ((og_score_table_out_file != 'NA') and (not og_score_table_out_file.endswith('.mtx'))):
         og_score_dataframe = index_info(og_score_table_out_file,'Sequence')
         filtered_og_score_dataframe = og_score_dataframe
         (ideal_height,ideal_width) = filtered_og_score_dataframe.shape
@@ -1220,12 +2600,347 @@ def make_plots(info_dataframe,merged_genomes_file,output_figure_file,og_table_ou
         og_heatmap_plot = sns.heatmap(filtered_og_score_dataframe,ax=ax,xticklabels=False,cmap="viridis") 
         figure.savefig(f'Heatmap_{prefix_genome_file}_OG_Score.png')
         
-#2D dictionary to store all relevant information about sequences
-seq_info = defaultdict(dict)
+class SeqInfoTable:
+    #Columnar store for the information collected about each sequence. Every sequence ID is interned once to an integer row, numeric columns are kept in typed numpy arrays and all other columns as categorical codes.
+    #Columns are used exactly like the dictionaries of the former seq_info defaultdict(dict), e.g. seq_info['CDS_Count'][scaffold] += 1
+    numeric_columns = {'Length': 'int64', 'GC': 'float64', 'CDS_Count': 'int64', 'Gene_Count': 'int64', 'OG_Count': 'int64'}
+
+    def __init__(self):
+        self.row_index = dict()
+        self.row_ids = []
+        self.columns = dict()
+
+    def __getitem__(self,column):
+        #Columns are created on first access, like in a defaultdict
+        if (column not in self.columns):
+            self.columns[column] = SeqInfoColumn(self,self.numeric_columns.get(column))
+        return self.columns[column]
+
+    def __contains__(self,column):
+        return column in self.columns
+
+    def __iter__(self):
+        return iter(self.columns)
+
+    def __len__(self):
+        return len(self.row_ids)
+
+    def keys(self):
+        return self.columns.keys()
+
+    def intern(self,seq_id):
+        row = self.row_index.get(seq_id)
+        if (row is None):
+            row = len(self.row_ids)
+            self.row_index[seq_id] = row
+            self.row_ids.append(seq_id)
+        return row
+
+    def intern_many(self,seq_ids):
+        return np.fromiter((self.intern(seq_id) for seq_id in seq_ids),dtype=np.int64,count=len(seq_ids))
+
+    def save(self,checkpoint_file):
+        with open(f'{checkpoint_file}.tmp','wb') as OUT:
+            pickle.dump((self.row_ids,self.columns),OUT,protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f'{checkpoint_file}.tmp',checkpoint_file)
+
+    def load(self,checkpoint_file):
+        with open(checkpoint_file,'rb') as IN:
+            (self.row_ids,self.columns) = pickle.load(IN)
+        self.row_index = {seq_id: row for row,seq_id in enumerate(self.row_ids)}
+        for column in self.columns.values():
+            column.table = self
+
+    def to_dataframe(self):
+        #The numeric arrays are handed to pandas without copying. Rows follow the order in which sequences were first seen, as pd.DataFrame.from_dict did for the former dictionary
+        row_count = len(self.row_ids)
+        data = {column: self.columns[column].to_array(row_count) for column in self.columns}
+        info_dataframe = pd.DataFrame(data,index=pd.Index(self.row_ids,dtype=object,name='Sequence'),copy=False)
+        return info_dataframe
+
+class SeqInfoColumn:
+    #A single column of SeqInfoTable. dtype is int64, float64 or category, and is inferred from the first value for columns not listed in SeqInfoTable.numeric_columns
+    def __init__(self,table,dtype=None):
+        self.table = table
+        self.dtype = dtype
+        self.present = np.zeros(0,dtype=bool)
+        self.values = self.new_values(0)
+        self.categories = []
+        self.category_codes = dict()
+
+    def __getstate__(self):
+        #The parent table is not pickled with the column, SeqInfoTable.load sets it again
+        state = self.__dict__.copy()
+        state['table'] = None
+        return state
+
+    def new_values(self,size):
+        if (self.dtype == 'float64'):
+            return np.full(size,np.nan,dtype=np.float64)
+        elif (self.dtype == 'int64'):
+            return np.zeros(size,dtype=np.int64)
+        #Categorical columns store the code of each value, -1 for missing values
+        return np.full(size,-1,dtype=np.int32)
+
+    def ensure_capacity(self,size):
+        if (size > len(self.present)):
+            capacity = max(size,2 * len(self.present),1024)
+            extra = capacity - len(self.present)
+            self.present = np.concatenate([self.present,np.zeros(extra,dtype=bool)])
+            self.values = np.concatenate([self.values,self.new_values(extra)])
+
+    def infer_dtype(self,value):
+        if (isinstance(value,(bool,np.bool_))):
+            return 'category'
+        elif (isinstance(value,(int,np.integer))):
+            return 'int64'
+        elif (isinstance(value,(float,np.floating))):
+            return 'float64'
+        return 'category'
+
+    def convert(self,dtype):
+        #Change the column type when a value does not fit the current one: integers are widened to floats and anything else makes the column categorical. Categorical columns stay categorical and store numbers as categories too, as the former dictionaries accepted mixed values
+        if ((self.dtype == dtype) or (self.dtype == 'category') or ((self.dtype == 'float64') and (dtype == 'int64'))):
+            return
+        if (self.dtype is None):
+            self.dtype = dtype
+            self.values = self.new_values(len(self.present))
+        elif ((self.dtype == 'int64') and (dtype == 'float64')):
+            self.values = self.values.astype(np.float64)
+            self.values[~self.present] = np.nan
+            self.dtype = dtype
+        else:
+            old_values = self.values
+            self.dtype = 'category'
+            self.values = self.new_values(len(self.present))
+            rows = np.flatnonzero(self.present)
+            self.values[rows] = [self.category_code(value.item()) for value in old_values[rows]]
+
+    def category_code(self,value):
+        if ((value is None) or ((isinstance(value,float)) and (value != value))):
+            return -1
+        code = self.category_codes.get(value)
+        if (code is None):
+            code = len(self.categories)
+            self.category_codes[value] = code
+            self.categories.append(value)
+        return code
+
+    def row(self,seq_id):
+        row = self.table.row_index.get(seq_id)
+        if ((row is None) or (row >= len(self.present)) or (not self.present[row])):
+            return None
+        return row
+
+    def __getitem__(self,seq_id):
+        row = self.row(seq_id)
+        if (row is None):
+            raise KeyError(seq_id)
+        if (self.dtype == 'category'):
+            code = self.values[row]
+            return self.categories[code] if (code >= 0) else np.nan
+        return self.values[row].item()
+
+    def __setitem__(self,seq_id,value):
+        self.convert(self.infer_dtype(value))
+        row = self.table.intern(seq_id)
+        self.ensure_capacity(row + 1)
+        self.present[row] = True
+        if (self.dtype == 'category'):
+            self.values[row] = self.category_code(value)
+        else:
+            self.values[row] = value
+
+    def __contains__(self,seq_id):
+        return self.row(seq_id) is not None
+
+    def __iter__(self):
+        row_ids = self.table.row_ids
+        return (row_ids[row] for row in np.flatnonzero(self.present))
+
+    def __len__(self):
+        return int(self.present.sum())
+
+    def keys(self):
+        return self
+
+    def get(self,seq_id,default=None):
+        if (seq_id in self):
+            return self[seq_id]
+        return default
+
+    def update(self,other):
+        #Accepts a dictionary or an iterable of (seq_id,value) pairs
+        pairs = other.items() if isinstance(other,dict) else other
+        for (seq_id,value) in pairs:
+            self[seq_id] = value
+
+    def assign(self,seq_ids,values):
+        #Bulk version of __setitem__. values may be an array or list aligned to seq_ids, or a single value for all of them
+        if (len(seq_ids) == 0):
+            return
+        rows = self.table.intern_many(seq_ids)
+        if (np.ndim(values) == 0):
+            self.convert(self.infer_dtype(values))
+            values = [values] * len(rows)
+        else:
+            values = np.asarray(values)
+            kind = values.dtype.kind
+            self.convert('int64' if (kind in 'iu') else 'float64' if (kind == 'f') else 'category')
+        self.ensure_capacity(int(rows.max()) + 1)
+        self.present[rows] = True
+        if (self.dtype == 'category'):
+            (codes,uniques) = pd.factorize(pd.Series(values,dtype=object),use_na_sentinel=True)
+            unique_codes = np.array([self.category_code(value) for value in uniques],dtype=np.int32)
+            self.values[rows] = np.where(codes >= 0,unique_codes[codes] if (len(unique_codes) > 0) else -1,-1)
+        else:
+            self.values[rows] = values
+
+    def increment(self,seq_ids,counts):
+        #Bulk version of seq_info[column][seq_id] += count, starting from 0 for sequences without a value
+        if (len(seq_ids) == 0):
+            return
+        self.convert('int64')
+        rows = self.table.intern_many(seq_ids)
+        self.ensure_capacity(int(rows.max()) + 1)
+        self.values[rows[~self.present[rows]]] = 0
+        self.present[rows] = True
+        np.add.at(self.values,rows,np.asarray(counts,dtype=self.values.dtype))
+
+    def to_series(self):
+        #The values of the column indexed by sequence ID, leaving out sequences without a value
+        row_count = len(self.table)
+        self.ensure_capacity(row_count)
+        column_series = pd.Series(self.to_array(row_count),index=pd.Index(self.table.row_ids,dtype=object),copy=False)
+        return column_series[self.present[:row_count]]
+
+    def to_array(self,row_count):
+        #Return the column as an array aligned to the rows of the table. Values are not copied when the column is fully filled
+        self.ensure_capacity(row_count)
+        values = self.values[:row_count]
+        present = self.present[:row_count]
+        if (self.dtype is None):
+            return np.full(row_count,np.nan,dtype=object)
+        elif (self.dtype == 'int64'):
+            if (present.all()):
+                return values
+            return pd.arrays.IntegerArray(values,~present)
+        elif (self.dtype == 'float64'):
+            return values
+        return pd.Categorical.from_codes(values,categories=pd.Index(self.categories,dtype=object))
+
+class TableWriter:
+    #Write a table in blocks of rows (DataFrames with the same columns and index) in the --output_format. Blocks of the columnar formats are converted to Arrow and gathered into row groups (parquet) or record batches (feather) of --output_row_group_size rows
+    #Empty blocks are only written if no other block is, so that the header of an empty table is still written
+    def __init__(self,out_file,na_rep='NA'):
+        self.out_file = table_file_name(out_file)
+        self.na_rep = na_rep
+        self.handle = None
+        self.writer = None
+        self.schema = None
+        self.pending = []
+        self.pending_rows = 0
+        self.empty_block = None
+        self.compression = None if (args.output_compression == 'none') else args.output_compression
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.close()
+
+    def write(self,data_frame):
+        if (len(data_frame) == 0):
+            if (self.empty_block is None):
+                self.empty_block = data_frame
+            return
+        if (args.output_format == 'tsv'):
+            if (self.handle is None):
+                self.handle = open(self.out_file,'w',newline='')
+                data_frame.to_csv(self.handle,sep='\t',na_rep=self.na_rep)
+            else:
+                data_frame.to_csv(self.handle,sep='\t',na_rep=self.na_rep,header=False)
+            return
+        table = self.to_arrow(data_frame)
+        if (self.schema is None):
+            self.schema = table.schema
+        else:
+            table = table.cast(self.schema)
+        self.pending.append(table)
+        self.pending_rows += len(table)
+        if (self.pending_rows >= args.output_row_group_size):
+            self.flush()
+
+    def to_arrow(self,data_frame):
+        data_frame = data_frame.reset_index()
+        if (self.na_rep != 'NA'):
+            numeric_columns = data_frame.select_dtypes('number').columns
+            data_frame[numeric_columns] = data_frame[numeric_columns].fillna(self.na_rep)
+        arrays = []
+        for column in range(data_frame.shape[1]):
+            values = data_frame.iloc[:,column]
+            try:
+                arrays.append(pyarrow.Array.from_pandas(values))
+            except (pyarrow.ArrowInvalid,pyarrow.ArrowTypeError,pyarrow.ArrowNotImplementedError):
+                #Columns of mixed types or Python collections (e.g. lists of AMGs) are stored as the text written to the .tsv tables
+                arrays.append(pyarrow.Array.from_pandas(values.astype(str).where(values.notna(),None)))
+        return pyarrow.Table.from_arrays(arrays,names=[str(column) for column in data_frame.columns])
+
+    def open_writer(self):
+        if (args.output_format == 'parquet'):
+            self.writer = pyarrow.parquet.ParquetWriter(self.out_file,self.schema,compression=self.compression)
+        else:
+            self.writer = pyarrow.ipc.new_file(self.out_file,self.schema,options=pyarrow.ipc.IpcWriteOptions(compression=self.compression))
+
+    def flush(self,is_last=False):
+        #Write the pending rows in full row groups, and the remaining rows too once is_last
+        if (self.pending_rows == 0):
+            return
+        table = pyarrow.concat_tables(self.pending)
+        row_count = len(table) if (is_last) else (len(table) // args.output_row_group_size) * args.output_row_group_size
+        if (self.writer is None):
+            self.open_writer()
+        if (args.output_format == 'parquet'):
+            self.writer.write_table(table.slice(0,row_count),row_group_size=args.output_row_group_size)
+        else:
+            self.writer.write_table(table.slice(0,row_count),max_chunksize=args.output_row_group_size)
+        self.pending = [table.slice(row_count)]
+        self.pending_rows = len(table) - row_count
+
+    def close(self):
+        if ((self.handle is None) and (self.schema is None) and (self.empty_block is not None)):
+            #Only empty blocks were written, so the table is written with just its header
+            if (args.output_format == 'tsv'):
+                self.handle = open(self.out_file,'w',newline='')
+                self.empty_block.to_csv(self.handle,sep='\t',na_rep=self.na_rep)
+            else:
+                self.schema = self.to_arrow(self.empty_block).schema
+                self.open_writer()
+        if (self.handle is not None):
+            self.handle.close()
+            self.handle = None
+        if (self.schema is not None):
+            self.flush(is_last=True)
+            self.writer.close()
+            self.schema = None
+
+#Column names and types of BLAST tabular output (outfmt 6), also used for the MMSeqs2 m8 format
+blast_tab_columns = ['qseqid','sseqid','pident','length','mismatch','gapopen','qstart','qend','sstart','send','evalue','bitscore']
+pair_spill_buckets = 16
+og_partition_max_open_files = 256
+host_catalogue_volume_size = 1000
+blast_tab_dtypes = {'qseqid': str, 'sseqid': str, 'pident': np.float64, 'length': np.int64, 'evalue': np.float64, 'bitscore': np.float64}
+#Columnar table to store all relevant information about sequences
+seq_info = SeqInfoTable()
+run_manifest = {'Stages': {}, 'File_Hashes': {}}
+stage_chain = {'Key': ''}
+manifest_lock = threading.RLock()
+checkpoint_dir = 'Virathon_Checkpoints'
 #Global variables to be used by multiple modules
 merged_genomes_file = 'All_Genomic.fasta'
 merged_gff_file = 'All_Genomic.gff'
 merged_genes_file = 'All_Genes.fna'
 merged_cds_file = 'All_CDS.faa'
-#Central module to run all other modules
-central()
+#Central module to run all other modules. Only run when called as a script, so worker processes can import this module
+if __name__ == '__main__':
+    central()
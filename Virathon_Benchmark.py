@@ -0,0 +1,555 @@
+#! /usr/bin/env python3
+#Virathon_Benchmark: measure the time and memory used by the Python code of Virathon, separately from the external tools
+#Synthetic datasets of a given number of records are generated for each benchmark, stub executables that return the synthetic outputs are put on PATH in place of blastn, mmseqs, hmmsearch, bowtie2, samtools, prodigal, etc., and each Virathon function is run in its own process so its peak memory is not mixed with that of other runs
+#Results are appended as JSON lines to --out_file, so runs of different versions of Virathon can be compared with --baseline
+import argparse
+import subprocess
+import importlib.util
+import ast
+import resource
+import platform
+import hashlib
+import shutil
+import json
+import glob
+import time
+import sys
+import os
+import numpy as np
+import pandas as pd
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--benchmarks", help="Benchmarks to run. Available: index_seqs, make_pops, calc_recip_scores, parse_mmseqs_cluster_file, parse_hmmer_output, write_hmmer_tables, calc_abundance, print_results. Default: all", default=None, type=str, nargs="+")
+parser.add_argument("--scales", help="Number of records of the synthetic dataset of each benchmark (e.g. BLAST lines for make_pops, proteins for parse_mmseqs_cluster_file, sequences for index_seqs and print_results)", default=[1000,10000,100000], type=int, nargs="+")
+parser.add_argument("--repeats", help="Number of times each benchmark is run at each scale", default=1, type=int)
+parser.add_argument("--virathon", help="Virathon.py script to benchmark", default=os.path.join(os.path.dirname(os.path.abspath(__file__)),'Virathon.py'), type=str)
+parser.add_argument("--work_dir", help="Directory for the synthetic datasets, stub executables and benchmark runs. Datasets are reused across runs with the same scale and seed", default='Virathon_Benchmark', type=str)
+parser.add_argument("--out_file", help="JSON lines file to which the results are appended", default='Virathon_Benchmark.jsonl', type=str)
+parser.add_argument("--baseline", help="JSON lines file of a previous benchmark run (e.g. of another version of Virathon) to compare the results with", default='NA', type=str)
+parser.add_argument("--label", help="Label of this benchmark run stored with the results (e.g. a branch or version name)", default='NA', type=str)
+parser.add_argument("--threads", help="Value of --threads passed to Virathon", default=1, type=int)
+parser.add_argument("--chunk_size", help="Value of --chunk_size passed to Virathon", default=1000000, type=int)
+parser.add_argument("--genes_per_genome", help="Number of genes (and CDS) of each synthetic genome", default=10, type=int)
+parser.add_argument("--gene_length", help="Length (in bp) of each synthetic gene", default=300, type=int)
+parser.add_argument("--samples", help="Number of samples (each a group mapped on its own) of the calc_abundance benchmark. The bowtie2 stub streams the same synthetic SAM output for each of them", default=4, type=int)
+parser.add_argument("--seed", help="Seed of the synthetic datasets", default=1, type=int)
+parser.add_argument("--timeout", help="Maximum time (in seconds) of each benchmark run", default=86400, type=int)
+parser.add_argument("--keep_runs", help="Flag to keep the output files of each benchmark run", default=False, type=bool)
+#Used by the parent process to start each benchmark run in its own process
+parser.add_argument("--run_benchmark", help=argparse.SUPPRESS, default='NA', type=str)
+parser.add_argument("--scale", help=argparse.SUPPRESS, default=0, type=int)
+parser.add_argument("--data_dir", help=argparse.SUPPRESS, default='NA', type=str)
+parser.add_argument("--result_file", help=argparse.SUPPRESS, default='NA', type=str)
+args = parser.parse_args()
+
+#This is the main function that generates the datasets and runs every benchmark at every scale in its own process
+def central():
+    if (args.run_benchmark != 'NA'):
+        run_benchmark(args.run_benchmark,args.scale,args.data_dir,args.result_file)
+        return
+    benchmark_names = args.benchmarks if (args.benchmarks) else list(benchmarks.keys())
+    unknown_benchmarks = [benchmark for benchmark in benchmark_names if (benchmark not in benchmarks)]
+    if (unknown_benchmarks):
+        exit(f'Unknown benchmarks: {",".join(unknown_benchmarks)}. Available: {",".join(benchmarks.keys())}')
+    work_dir = os.path.abspath(args.work_dir)
+    bin_dir = install_stubs(f'{work_dir}/bin')
+    run_info = {'Samtools': shutil.which('samtools') or 'stub', 'Label': args.label, 'Virathon_Version': get_virathon_version(args.virathon), 'Virathon_Hash': file_hash(args.virathon), 'Python': platform.python_version(), 'Host': platform.node(), 'Threads': args.threads, 'Chunk_Size': args.chunk_size, 'Date': time.strftime('%Y-%m-%d %H:%M:%S')}
+    results = []
+    for scale in args.scales:
+        for benchmark in benchmark_names:
+            data_dir = make_dataset(benchmark,scale,f'{work_dir}/Data')
+            for repeat in range(args.repeats):
+                result = start_benchmark_run(benchmark,scale,data_dir,bin_dir,f'{work_dir}/Runs/{benchmark}_{scale}_{repeat}')
+                result.update(run_info)
+                result['Repeat'] = repeat
+                print(f'{benchmark}\t{scale}\t{result["Status"]}\t{result.get("Seconds","NA")} s\t{result.get("Max_RSS_KB","NA")} KB')
+                with open(args.out_file,'a') as OUT:
+                    OUT.write(json.dumps(result,sort_keys=True) + '\n')
+                results.append(result)
+    if (args.baseline != 'NA'):
+        compare_results(results,args.baseline)
+
+def start_benchmark_run(benchmark,scale,data_dir,bin_dir,run_dir):
+    #Run a benchmark in a new process, in an empty run_dir and with the stubs first on PATH. The output of Virathon is kept in run_dir/Benchmark.log
+    for stale_file in glob.glob(f'{run_dir}/*'):
+        if (os.path.isdir(stale_file) and (not os.path.islink(stale_file))):
+            subprocess.call(['rm','-rf',stale_file])
+        else:
+            os.remove(stale_file)
+    os.makedirs(run_dir,exist_ok=True)
+    result_file = f'{run_dir}/Benchmark_Result.json'
+    env = dict(os.environ,PATH=f'{bin_dir}{os.pathsep}{os.environ.get("PATH","")}',VIRATHON_BENCHMARK_DATA=data_dir)
+    command = [sys.executable,os.path.abspath(__file__),'--run_benchmark',benchmark,'--scale',str(scale),'--data_dir',data_dir,'--result_file',result_file,'--virathon',os.path.abspath(args.virathon),'--threads',str(args.threads),'--chunk_size',str(args.chunk_size),'--genes_per_genome',str(args.genes_per_genome),'--gene_length',str(args.gene_length),'--samples',str(args.samples)]
+    result = {'Benchmark': benchmark, 'Scale': scale}
+    with open(f'{run_dir}/Benchmark.log','w') as LOG:
+        try:
+            return_code = subprocess.call(command,cwd=run_dir,env=env,stdout=LOG,stderr=subprocess.STDOUT,timeout=args.timeout)
+        except subprocess.TimeoutExpired:
+            return_code = 'timeout'
+    if (os.path.exists(result_file)):
+        with open(result_file) as IN:
+            result = json.load(IN)
+    else:
+        result['Status'] = 'timeout' if (return_code == 'timeout') else f'failed (exit code {return_code}, see {run_dir}/Benchmark.log)'
+    if (args.keep_runs == False):
+        subprocess.call(['rm','-rf',run_dir])
+    return result
+
+def run_benchmark(benchmark,scale,data_dir,result_file):
+    #Load Virathon as a module with the arguments of the benchmark, set up its inputs and measure the function call. Setup is not included in the time, and the peak memory is reported after importing, after the setup and during the call
+    virathon_args = supported_args(args.virathon,['--threads',str(args.threads),'--chunk_size',str(args.chunk_size)] + benchmarks[benchmark]['Args'])
+    sys.argv = [args.virathon] + virathon_args
+    spec = importlib.util.spec_from_file_location('Virathon',args.virathon)
+    virathon = importlib.util.module_from_spec(spec)
+    #Worker processes of Virathon need to find the module by its name
+    sys.modules['Virathon'] = virathon
+    #Older versions of Virathon call central() when imported, so top level calls of central() are left out. Newer versions only call it under a __main__ guard, which is kept and skipped
+    with open(args.virathon) as IN:
+        virathon_tree = ast.parse(IN.read(),filename=args.virathon)
+    virathon_tree.body = [node for node in virathon_tree.body if (not is_central_call(node))]
+    exec(compile(virathon_tree,args.virathon,'exec'),virathon.__dict__)
+    import_max_rss = get_max_rss()
+    benchmark_call = benchmarks[benchmark]['Setup'](virathon,scale,data_dir)
+    setup_max_rss = get_max_rss()
+    is_reset = reset_max_rss()
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start_time = time.perf_counter()
+    status = 'complete'
+    error = None
+    try:
+        benchmark_call()
+    except BaseException as exception:
+        status = 'failed'
+        error = f'{type(exception).__name__}: {exception}'
+    seconds = time.perf_counter() - start_time
+    usage_after = resource.getrusage(resource.RUSAGE_SELF)
+    children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    result = {'Benchmark': benchmark, 'Scale': scale, 'Status': status, 'Seconds': round(seconds,4), 'CPU_Seconds': round((usage_after.ru_utime + usage_after.ru_stime) - (usage_before.ru_utime + usage_before.ru_stime),4), 'Children_CPU_Seconds': round((children_after.ru_utime + children_after.ru_stime) - (children_before.ru_utime + children_before.ru_stime),4), 'Max_RSS_KB': get_max_rss(), 'Max_RSS_Includes_Setup': (not is_reset), 'Import_Max_RSS_KB': import_max_rss, 'Setup_Max_RSS_KB': setup_max_rss, 'Children_Max_RSS_KB': children_after.ru_maxrss, 'Virathon_Args': ' '.join(virathon_args)}
+    if (error):
+        result['Error'] = error
+    with open(result_file,'w') as OUT:
+        json.dump(result,OUT)
+
+def get_max_rss():
+    #Peak resident memory (in KB) of this process. On Linux it is read from VmHWM, as ru_maxrss also counts the memory of the parent process before exec
+    try:
+        with open('/proc/self/status') as IN:
+            for line in IN:
+                if (line.startswith('VmHWM:')):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def reset_max_rss():
+    #Reset VmHWM to the current resident memory so the peak of the call is measured without that of the setup. Returns False where this is not supported
+    try:
+        with open('/proc/self/clear_refs','w') as OUT:
+            OUT.write('5')
+        return True
+    except OSError:
+        return False
+
+def compare_results(results,baseline_file):
+    #Print the ratio of the median time and peak memory of each benchmark and scale to those of the baseline
+    baseline = pd.read_json(baseline_file,lines=True)
+    baseline = baseline[baseline['Status'] == 'complete'].groupby(['Benchmark','Scale'])[['Seconds','Max_RSS_KB']].median()
+    current = pd.DataFrame(results)
+    current = current[current['Status'] == 'complete'].groupby(['Benchmark','Scale'])[['Seconds','Max_RSS_KB']].median()
+    comparison = current.join(baseline,rsuffix='_Baseline',how='inner')
+    comparison['Time_Ratio'] = comparison['Seconds'] / comparison['Seconds_Baseline']
+    comparison['Memory_Ratio'] = comparison['Max_RSS_KB'] / comparison['Max_RSS_KB_Baseline']
+    print(f'Comparison with {baseline_file} (ratios above 1 are slower or use more memory than the baseline)')
+    print(comparison.to_string(float_format=lambda value: f'{value:.3f}'))
+
+def get_virathon_version(virathon_file):
+    try:
+        return subprocess.check_output(['git','describe','--always','--dirty'],cwd=os.path.dirname(os.path.abspath(virathon_file)),stderr=subprocess.DEVNULL).decode().strip()
+    except (subprocess.CalledProcessError,OSError):
+        return 'NA'
+
+def file_hash(input_file):
+    hasher = hashlib.sha256()
+    with open(input_file,'rb') as IN:
+        for block in iter(lambda: IN.read(16777216),b''):
+            hasher.update(block)
+    return hasher.hexdigest()[:16]
+
+#Stub executables. Each one links the synthetic output of the benchmark (from the directory in $VIRATHON_BENCHMARK_DATA) to the output path given in its command line, or writes an empty output when there is none, so the external tools take no time
+stub_source = '''#! {python}
+import sys, os, shutil
+tool = os.path.basename(sys.argv[0])
+arguments = sys.argv[1:]
+data_dir = os.environ.get('VIRATHON_BENCHMARK_DATA','')
+
+def option(name):
+    return arguments[arguments.index(name) + 1] if (name in arguments) else None
+
+def link_output(data_name,out_file):
+    if ((out_file is None) or (out_file == '-')):
+        return
+    if (os.path.lexists(out_file)):
+        os.remove(out_file)
+    data_file = os.path.join(data_dir,data_name)
+    if (os.path.exists(data_file)):
+        os.symlink(data_file,out_file)
+    else:
+        open(out_file,'w').close()
+
+def print_output(data_name):
+    data_file = os.path.join(data_dir,data_name)
+    if (os.path.exists(data_file)):
+        with open(data_file,'rb') as IN:
+            shutil.copyfileobj(IN,sys.stdout.buffer,16777216)
+
+def open_input():
+    #Input file of a samtools command, skipping the values of its options. Older versions of Virathon give samtools the files written by bowtie2 -S, newer ones stream them (-)
+    input_file = '-'
+    pos = 1
+    while (pos < len(arguments)):
+        if (arguments[pos] in ['-@','-m','-o','-T']):
+            pos += 1
+        elif ((arguments[pos] == '-') or (not arguments[pos].startswith('-'))):
+            input_file = arguments[pos]
+        pos += 1
+    return sys.stdin.buffer if (input_file == '-') else open(input_file,'rb')
+
+def count_sam(IN):
+    #Mapped and unmapped records of each reference of a SAM stream, in the samtools idxstats format
+    ref_lengths = dict()
+    counts = dict()
+    for line in IN:
+        if (line.startswith(b'@')):
+            if (line.startswith(b'@SQ')):
+                tags = dict(tag.split(b':',1) for tag in line.rstrip(b'\\n').split(b'\\t')[1:])
+                ref_lengths[tags[b'SN']] = tags[b'LN']
+            continue
+        (name,flag,ref_name) = line.split(b'\\t',3)[:3]
+        is_unmapped = int(flag) & 4
+        ref_counts = counts.setdefault(ref_name,[0,0])
+        ref_counts[1 if (is_unmapped) else 0] += 1
+    for (ref_name,ref_length) in list(ref_lengths.items()) + [(b'*',b'0')]:
+        (mapped,unmapped) = counts.get(ref_name,[0,0])
+        sys.stdout.buffer.write(b'%s\\t%s\\t%d\\t%d\\n' % (ref_name,ref_length,mapped,unmapped))
+
+if (tool == 'blastn'):
+    link_output('Blastn.tsv',option('-out'))
+elif (tool == 'makeblastdb'):
+    open(f"{{option('-out')}}.nsq",'w').close()
+elif (tool == 'mmseqs'):
+    positional = [argument for argument in arguments if (not argument.startswith('-'))]
+    if ((positional) and (positional[0] == 'easy-cluster')):
+        link_output('Cluster.tsv',positional[2]+'_cluster.tsv')
+        open(positional[2]+'_rep_seq.fasta','w').close()
+    elif ((positional) and (positional[0] == 'easy-search')):
+        link_output('Search.m8',positional[3])
+elif (tool in ['hmmsearch','hmmscan']):
+    link_output('Hmmer.txt',option('-o'))
+    link_output('Hmmer.tblout',option('--tblout'))
+    link_output('Hmmer.domtblout',option('--domtblout'))
+elif (tool == 'bowtie2-build'):
+    open(f'{{arguments[-1]}}.1.bt2','w').close()
+elif (tool == 'bowtie2'):
+    if (option('-S') is not None):
+        link_output('Bowtie2.sam',option('-S'))
+    else:
+        print_output('Bowtie2.sam')
+elif (tool == 'samtools'):
+    #Only used when samtools is not installed. The SAM records are passed through by view and sort and counted by idxstats
+    if ((arguments) and (arguments[0] == 'view')):
+        with open_input() as IN:
+            shutil.copyfileobj(IN,sys.stdout.buffer,16777216)
+    elif ((arguments) and (arguments[0] == 'sort')):
+        with open_input() as IN, open(option('-o'),'wb') as OUT:
+            shutil.copyfileobj(IN,OUT,16777216)
+    elif ((arguments) and (arguments[0] == 'idxstats')):
+        with open_input() as IN:
+            count_sam(IN)
+elif (tool == 'prodigal'):
+    link_output('CDS.faa',option('-a'))
+    link_output('Genes.fna',option('-d'))
+    link_output('Genes.gff',option('-o'))
+'''
+stub_tools = ['blastn','makeblastdb','blastdb_aliastool','mmseqs','hmmsearch','hmmscan','hmmpress','hmmbuild','bowtie2','bowtie2-build','samtools','prodigal','muscle','FastTreeMP','spades.py','metabat2','jgi_summarize_bam_contig_depths','checkv','VIBRANT_run.py','virsorter','bacphlip','vpf-class','PHIST.py','RaFAH.pl','VirHostMatcher-Net.py']
+
+def install_stubs(bin_dir):
+    #samtools counts the reads of calc_abundance, so it is only replaced by the stub when it is not installed
+    os.makedirs(bin_dir,exist_ok=True)
+    stub_file = f'{bin_dir}/virathon_stub.py'
+    with open(stub_file,'w') as OUT:
+        OUT.write(stub_source.format(python=sys.executable))
+    os.chmod(stub_file,0o755)
+    for tool in stub_tools:
+        tool_file = f'{bin_dir}/{tool}'
+        if (os.path.lexists(tool_file)):
+            os.remove(tool_file)
+        if ((tool == 'samtools') and (shutil.which('samtools'))):
+            continue
+        os.symlink('virathon_stub.py',tool_file)
+    return bin_dir
+
+#Synthetic datasets. Genomes are named Bench_Genome_N and their genes and CDS Bench_Genome_N_M, as expected by Virathon
+#Increased whenever the synthetic datasets change, so datasets cached by older versions of this script are not reused
+dataset_version = 2
+
+def make_dataset(benchmark,scale,data_root):
+    #Datasets are generated once per benchmark, scale, seed and dataset parameters, and reused afterwards
+    #Benchmarks with the same generator (e.g. parse_hmmer_output and write_hmmer_tables) share their datasets
+    dataset = benchmarks[benchmark]['Generate'].__name__.replace('generate_','')
+    data_dir = f'{data_root}/{dataset}_{scale}_{args.seed}_{args.genes_per_genome}_{args.gene_length}_{args.samples}_v{dataset_version}'
+    if (os.path.exists(f'{data_dir}/Dataset_Complete')):
+        return data_dir
+    print(f'Generating the {dataset} dataset with {scale} records in {data_dir}')
+    os.makedirs(data_dir,exist_ok=True)
+    rng = np.random.default_rng(args.seed)
+    benchmarks[benchmark]['Generate'](scale,data_dir,rng)
+    open(f'{data_dir}/Dataset_Complete','w').close()
+    return data_dir
+
+def genome_names(genome_count):
+    return np.array([f'Bench_Genome_{genome}' for genome in range(1,genome_count+1)],dtype=object)
+
+def gene_names(genome_codes,gene_numbers):
+    return np.array([f'Bench_Genome_{genome}_{gene}' for (genome,gene) in zip((genome_codes + 1).tolist(),gene_numbers.tolist())],dtype=object)
+
+def write_fasta(out_file,seq_ids,lengths,alphabet,rng,block_size=10000):
+    letters = np.frombuffer(alphabet.encode(),dtype=np.uint8)
+    with open(out_file,'wb') as OUT:
+        for block_start in range(0,len(seq_ids),block_size):
+            block_lengths = lengths[block_start:block_start+block_size]
+            block_seq = letters[rng.integers(0,len(letters),int(block_lengths.sum()))].tobytes()
+            offset = 0
+            records = []
+            for (seq_id,length) in zip(seq_ids[block_start:block_start+block_size],block_lengths.tolist()):
+                seq = block_seq[offset:offset+length]
+                offset += length
+                records.append(b'>%s\n%s\n' % (seq_id.encode(),b'\n'.join(seq[i:i+60] for i in range(0,length,60))))
+            OUT.writelines(records)
+
+def write_tsv(out_file,data_frame,header=False,block_size=1000000):
+    with open(out_file,'w') as OUT:
+        for block_start in range(0,max(1,len(data_frame)),block_size):
+            data_frame.iloc[block_start:block_start+block_size].to_csv(OUT,sep='\t',header=((header) and (block_start == 0)),index=False)
+
+def write_tsv_blocks(out_file,scale,make_block,header=False,block_size=1000000):
+    #Write a table of scale rows made by make_block(first_row,row_count) one block at a time
+    with open(out_file,'w') as OUT:
+        for block_start in range(0,scale,block_size):
+            make_block(block_start,min(block_size,scale - block_start)).to_csv(OUT,sep='\t',header=((header) and (block_start == 0)),index=False)
+
+def make_blast_block(row_count,genome_count,rng,ident_scale):
+    #BLAST outfmt 6 (or MMSeqs2 m8, with identities from 0 to 1) lines between genes of the same or nearby genomes, half of them with high identity, so that some genome pairs pass the population cutoffs
+    query_genomes = rng.integers(0,genome_count,row_count)
+    subject_genomes = np.clip(query_genomes + rng.integers(-2,3,row_count),0,genome_count - 1)
+    lengths = rng.integers(30,args.gene_length,row_count)
+    return pd.DataFrame({'qseqid': gene_names(query_genomes,rng.integers(1,args.genes_per_genome+1,row_count)), 'sseqid': gene_names(subject_genomes,rng.integers(1,args.genes_per_genome+1,row_count)), 'pident': np.round(np.where(rng.random(row_count) < 0.5,rng.uniform(95,100,row_count),rng.uniform(30,100,row_count)),3) / ident_scale, 'length': lengths, 'mismatch': rng.integers(0,30,row_count), 'gapopen': rng.integers(0,5,row_count), 'qstart': 1, 'qend': lengths, 'sstart': 1, 'send': lengths, 'evalue': 10.0 ** -rng.uniform(5,50,row_count), 'bitscore': np.round(rng.uniform(30,500,row_count),1)})
+
+def generate_index_seqs(scale,data_dir,rng):
+    #scale genes and CDS, in genomes of --genes_per_genome genes
+    genome_count = max(1,scale // args.genes_per_genome)
+    genome_codes = np.arange(scale) % genome_count
+    gene_numbers = (np.arange(scale) // genome_count) + 1
+    write_fasta(f'{data_dir}/Genomes.fasta',genome_names(genome_count),np.full(genome_count,args.genes_per_genome * args.gene_length),'ACGT',rng)
+    write_fasta(f'{data_dir}/Genes.fna',gene_names(genome_codes,gene_numbers),np.full(scale,args.gene_length),'ACGT',rng)
+    write_fasta(f'{data_dir}/CDS.faa',gene_names(genome_codes,gene_numbers),np.full(scale,args.gene_length // 3),'ACDEFGHIKLMNPQRSTVWY',rng)
+
+def generate_make_pops(scale,data_dir,rng):
+    #scale BLASTN lines, about 5 for each gene
+    genome_count = max(2,scale // (5 * args.genes_per_genome))
+    write_tsv_blocks(f'{data_dir}/Blastn.tsv',scale,lambda block_start,row_count: make_blast_block(row_count,genome_count,rng,1))
+    with open(f'{data_dir}/Genome_Count.txt','w') as OUT:
+        OUT.write(f'{genome_count}\n')
+
+def generate_calc_recip_scores(scale,data_dir,rng):
+    #scale MMSeqs2 m8 lines, about 5 for each CDS
+    genome_count = max(2,scale // (5 * args.genes_per_genome))
+    write_tsv_blocks(f'{data_dir}/Search.m8',scale,lambda block_start,row_count: make_blast_block(row_count,genome_count,rng,100))
+    with open(f'{data_dir}/Genome_Count.txt','w') as OUT:
+        OUT.write(f'{genome_count}\n')
+
+def generate_parse_mmseqs_cluster_file(scale,data_dir,rng):
+    #scale proteins in clusters of 5 on average. Lines are grouped by cluster with the representative first, as in the output of easy-cluster
+    genome_count = max(1,scale // args.genes_per_genome)
+    proteins = rng.permutation(scale)
+    cluster_starts = np.sort(rng.choice(np.arange(1,scale),size=min(scale - 1,max(0,scale // 5 - 1)),replace=False)) if (scale > 1) else np.zeros(0,dtype=np.int64)
+    cluster_codes = np.zeros(scale,dtype=np.int64)
+    cluster_codes[cluster_starts] = 1
+    cluster_codes = np.cumsum(cluster_codes)
+    representatives = proteins[np.r_[0,cluster_starts]][cluster_codes]
+    write_tsv_blocks(f'{data_dir}/Cluster.tsv',scale,lambda block_start,row_count: pd.DataFrame({'Representative': gene_names(representatives[block_start:block_start+row_count] % genome_count,(representatives[block_start:block_start+row_count] // genome_count) + 1), 'Member': gene_names(proteins[block_start:block_start+row_count] % genome_count,(proteins[block_start:block_start+row_count] // genome_count) + 1)}))
+
+def hmmer_text_query(query,subjects,evalues,scores,descriptions):
+    #A query of the hmmer3-text output of hmmsearch with one domain per hit and without alignments
+    lines = [f'Query:       {query}  [M=120]\n','Scores for complete sequences (score includes all domains):\n','   --- full sequence ---   --- best 1 domain ---    -#dom-\n','    E-value  score  bias    E-value  score  bias    exp  N  Sequence      Description\n','    ------- ------ -----    ------- ------ -----   ---- --  --------      -----------\n']
+    for (subject,evalue,score,description) in zip(subjects,evalues,scores,descriptions):
+        lines.append(f'    {evalue:7.2g} {score:6.1f}   0.1    {evalue:7.2g} {score:6.1f}   0.1    1.0  1  {subject}  {description}\n')
+    lines.append('\n\nDomain annotation for each sequence (and alignments):\n')
+    for (subject,evalue,score,description) in zip(subjects,evalues,scores,descriptions):
+        lines.append(f'>> {subject}  {description}\n   #    score  bias  c-Evalue  i-Evalue hmmfrom  hmm to    alifrom  ali to    envfrom  env to     acc\n ---   ------ ----- --------- --------- ------- -------    ------- -------    ------- -------    ----\n   1 ! {score:6.1f}   0.1 {evalue:9.2g} {evalue:9.2g}       1     120 ..       1     120 ..       1     120 .. 0.99\n\n')
+    lines.append('\n\nInternal pipeline statistics summary:\n-------------------------------------\nQuery model(s):                            1  (120 nodes)\n//\n')
+    return ''.join(lines)
+
+def generate_hmmer(scale,data_dir,rng):
+    #scale hmmsearch hits, 100 per query HMM, in the hmmer3-text and --domtblout formats, and the HMM file with the name and description of each query
+    query_count = max(1,scale // 100)
+    genome_count = max(1,scale // args.genes_per_genome)
+    query_codes = np.sort(rng.integers(0,query_count,scale))
+    #Each protein is hit by a single query, as SearchIO does not accept repeated hits in a query
+    subject_codes = rng.permutation(scale)
+    subjects = gene_names(subject_codes % genome_count,(subject_codes // genome_count) + 1)
+    evalues = 10.0 ** -rng.uniform(1,80,scale)
+    scores = np.round(rng.uniform(10,400,scale),1)
+    descriptions = np.where(rng.random(scale) < 0.5,'-','hypothetical protein')
+    query_starts = np.searchsorted(query_codes,np.arange(query_count + 1))
+    with open(f'{data_dir}/Hmmer.txt','w') as OUT:
+        OUT.write('# hmmsearch :: search profile(s) against a sequence database\n# HMMER 3.3.2 (Nov 2020); http://hmmer.org/\n# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -\n# query HMM file:                  Bench.hmm\n# target sequence database:        Bench.faa\n# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -\n\n')
+        for query in range(query_count):
+            (start,end) = (query_starts[query],query_starts[query+1])
+            OUT.write(hmmer_text_query(f'Bench_OG_{query}',subjects[start:end],evalues[start:end],scores[start:end],descriptions[start:end]))
+        OUT.write('[ok]\n')
+    with open(f'{data_dir}/Hmmer.domtblout','w') as OUT:
+        OUT.write('# target name        accession   tlen query name           accession   qlen   E-value  score  bias   #  of  c-Evalue  i-Evalue  score  bias  from    to  from    to  from    to  acc description of target\n')
+        for block_start in range(0,scale,1000000):
+            block = slice(block_start,block_start+1000000)
+            OUT.writelines(f'{subject} - 100 Bench_OG_{query} - 120 {evalue:.2g} {score} 0.1 1 1 {evalue:.2g} {evalue:.2g} {score} 0.1 1 120 1 100 1 100 0.99 {description}\n' for (subject,query,evalue,score,description) in zip(subjects[block].tolist(),query_codes[block].tolist(),evalues[block].tolist(),scores[block].tolist(),descriptions[block].tolist()))
+        OUT.write('#\n# Program:         hmmsearch\n# [ok]\n')
+    with open(f'{data_dir}/Bench.hmm','w') as OUT:
+        OUT.writelines(f'HMMER3/f [3.3.2 | Nov 2020]\nNAME  Bench_OG_{query}\nDESC  Synthetic OG {query}\nLENG  120\n//\n' for query in range(query_count))
+
+def generate_calc_abundance(scale,data_dir,rng):
+    #SAM output of bowtie2 with scale sequences and scale read pairs, each pair mapped to a random sequence, and the read table of --samples samples
+    sample_table = pd.DataFrame({'Sample': [f'Bench_Sample_{sample}' for sample in range(1,args.samples+1)]})
+    sample_table['R1'] = sample_table['Sample'] + '_R1.fastq'
+    sample_table['R2'] = sample_table['Sample'] + '_R2.fastq'
+    sample_table['Group'] = sample_table['Sample']
+    write_tsv(f'{data_dir}/Raw_Read_Table.tsv',sample_table,header=True)
+    seq_length = args.genes_per_genome * args.gene_length
+    with open(f'{data_dir}/Bowtie2.sam','w') as OUT:
+        OUT.write('@HD\tVN:1.0\tSO:unsorted\n')
+        for block_start in range(0,scale,1000000):
+            OUT.writelines(f'@SQ\tSN:Bench_Genome_{seq}\tLN:{seq_length}\n' for seq in range(block_start+1,min(scale,block_start+1000000)+1))
+        OUT.write('@PG\tID:bowtie2\tPN:bowtie2\n')
+        for block_start in range(0,scale,1000000):
+            pair_count = min(1000000,scale - block_start)
+            seqs = rng.integers(1,scale+1,pair_count).tolist()
+            positions = rng.integers(1,max(2,seq_length - 250),pair_count).tolist()
+            OUT.writelines(f'Bench_Read_{read}\t99\tBench_Genome_{seq}\t{position}\t42\t100M\t=\t{position+150}\t250\t*\t*\nBench_Read_{read}\t147\tBench_Genome_{seq}\t{position+150}\t42\t100M\t=\t{position}\t-250\t*\t*\n' for (read,seq,position) in zip(range(block_start,block_start+pair_count),seqs,positions))
+
+def generate_print_results(scale,data_dir,rng):
+    #CheckV summary of scale sequences, VIBRANT quality table of half of them (with descriptions and lysogen fragments) and one AMG for every tenth
+    seq_names = genome_names(scale)
+    write_tsv(f'{data_dir}/CheckV_Summary.tsv',pd.DataFrame({'contig_id': seq_names, 'contig_length': args.genes_per_genome * args.gene_length, 'provirus': np.where(rng.random(scale) < 0.1,'Yes','No'), 'proviral_length': 'NA', 'gene_count': args.genes_per_genome, 'viral_genes': rng.integers(0,args.genes_per_genome,scale), 'host_genes': rng.integers(0,3,scale), 'checkv_quality': rng.choice(['Complete','High-quality','Medium-quality','Low-quality','Not-determined'],scale), 'miuvig_quality': 'Genome-fragment', 'completeness': np.round(rng.uniform(0,100,scale),2), 'completeness_method': 'AAI-based', 'contamination': np.round(rng.uniform(0,10,scale),2), 'kmer_freq': 1.0, 'warnings': ''}),header=True)
+    vibrant_names = seq_names[:max(1,scale // 2)]
+    is_fragment = rng.random(len(vibrant_names)) < 0.1
+    vibrant_scaffolds = np.where(is_fragment,vibrant_names + ' Synthetic genome_fragment_1',vibrant_names + ' Synthetic genome')
+    write_tsv(f'{data_dir}/VIBRANT_Quality.tsv',pd.DataFrame({'scaffold': vibrant_scaffolds, 'type': np.where(is_fragment,'lysogenic','lytic'), 'Quality': rng.choice(['complete circular','high quality draft','medium quality draft','low quality draft'],len(vibrant_names))}),header=True)
+    amg_scaffolds = vibrant_scaffolds[rng.integers(0,len(vibrant_scaffolds),max(1,scale // 10))]
+    write_tsv(f'{data_dir}/VIBRANT_AMG.tsv',pd.DataFrame({'protein': [f'Bench_AMG_{amg}' for amg in range(len(amg_scaffolds))], 'scaffold': amg_scaffolds, 'AMG KO': [f'K{ko:05d}' for ko in rng.integers(0,30000,len(amg_scaffolds)).tolist()], 'AMG KO name': 'Synthetic AMG', 'Pfam': 'PF00001', 'Pfam name': 'Synthetic domain'}),header=True)
+
+def supported_args(virathon_file,virathon_args):
+    #Keep only the options (given as option and value pairs) defined by the parser of virathon_file, so older versions of Virathon can be benchmarked without the options added since, such as --chunk_size
+    with open(virathon_file) as IN:
+        virathon_source = IN.read()
+    kept_args = []
+    for pos in range(0,len(virathon_args),2):
+        option = virathon_args[pos]
+        if ((f'"{option}"' in virathon_source) or (f"'{option}'" in virathon_source)):
+            kept_args.extend(virathon_args[pos:pos+2])
+        else:
+            print(f'{option} is not an option of {virathon_file} and will not be used')
+    return kept_args
+
+def is_central_call(node):
+    return ((isinstance(node,ast.Expr)) and (isinstance(node.value,ast.Call)) and (isinstance(node.value.func,ast.Name)) and (node.value.func.id == 'central'))
+
+def set_seq_info(virathon,column,seq_ids,values):
+    #Store values of a seq_info column. Older versions of Virathon keep seq_info as a dict of dicts rather than a SeqInfoTable
+    if (hasattr(virathon,'SeqInfoTable')):
+        virathon.seq_info[column].assign(seq_ids,values)
+    else:
+        #Values are stored as Python scalars, as the stages of those versions did
+        values = [values] * len(seq_ids) if (np.ndim(values) == 0) else np.asarray(values).tolist()
+        for seq_id,value in zip(seq_ids,values):
+            virathon.seq_info[column][seq_id] = value
+
+#Setup of each benchmark in its own process. The inputs are linked to the run directory and seq_info is filled with what the previous stages of a Virathon run would have stored. Returns the function call to measure
+def read_genome_count(data_dir):
+    with open(f'{data_dir}/Genome_Count.txt') as IN:
+        return int(IN.read())
+
+def setup_index_seqs(virathon,scale,data_dir):
+    for data_file in ['Genomes.fasta','Genes.fna','CDS.faa']:
+        os.symlink(f'{data_dir}/{data_file}',data_file)
+    def benchmark_call():
+        virathon.index_seqs(in_seq_files=['Genomes.fasta'],rename_seqs=False,seq_type='genomic',out_seq_file='All_Genomic.fasta')
+        virathon.index_seqs(in_seq_files=['Genes.fna'],rename_seqs=False,seq_type='gene',out_seq_file='All_Genes.fna')
+        virathon.index_seqs(in_seq_files=['CDS.faa'],rename_seqs=False,seq_type='cds',out_seq_file='All_CDS.faa')
+    return benchmark_call
+
+def setup_genome_counts(virathon,genome_count,count_column):
+    genomes = genome_names(genome_count)
+    set_seq_info(virathon,'Length',genomes,np.full(genome_count,args.genes_per_genome * args.gene_length,dtype=np.int64))
+    set_seq_info(virathon,count_column,genomes,np.full(genome_count,args.genes_per_genome,dtype=np.int64))
+
+def setup_make_pops(virathon,scale,data_dir):
+    setup_genome_counts(virathon,read_genome_count(data_dir),'Gene_Count')
+    for data_file in ['Bench.fasta','Bench_Genes.fna']:
+        open(data_file,'w').close()
+    return lambda: virathon.make_pops('Bench.fasta','Bench_Genes.fna')
+
+def setup_calc_recip_scores(virathon,scale,data_dir):
+    setup_genome_counts(virathon,read_genome_count(data_dir),'CDS_Count')
+    os.symlink(f'{data_dir}/Search.m8','Bench.m8')
+    return lambda: virathon.print_scores(virathon.calc_recip_scores('Bench.m8'),'Bench.m8.Pairwise_Protein_Scores.tsv',virathon.args.pps_min_aai,virathon.args.pps_min_matched,virathon.args.pps_min_perc_matched)
+
+def setup_parse_mmseqs_cluster_file(virathon,scale,data_dir):
+    os.symlink(f'{data_dir}/Cluster.tsv','Bench_cluster.tsv')
+    return lambda: virathon.parse_mmseqs_cluster_file('Bench_cluster.tsv')
+
+def setup_parse_hmmer_output(virathon,scale,data_dir):
+    os.symlink(f'{data_dir}/Hmmer.txt','BenchxBench_OGs')
+    return lambda: virathon.parse_hmmer_output('BenchxBench_OGs',0.001,50)
+
+def setup_write_hmmer_tables(virathon,scale,data_dir):
+    for (data_file,run_file) in [('Hmmer.txt','BenchxBench_OGs'),('Hmmer.domtblout','BenchxBench_OGs.domtblout'),('Bench.hmm','Bench.hmm')]:
+        os.symlink(f'{data_dir}/{data_file}',run_file)
+    return lambda: virathon.write_hmmer_tables('BenchxBench_OGs','Bench.hmm',0.001,50,'OG_Pairwise_Score_Table_Bench.tsv','OG_Score_Table_Bench.tsv')
+
+def setup_calc_abundance(virathon,scale,data_dir):
+    #Reads are mapped by the bowtie2 stub and counted by samtools, as in a run without --parse_only. Empty read files and Bowtie2 index stand in for the real ones
+    genomes = genome_names(scale)
+    set_seq_info(virathon,'Length',genomes,np.full(scale,args.genes_per_genome * args.gene_length,dtype=np.int64))
+    os.symlink(f'{data_dir}/Raw_Read_Table.tsv','Raw_Read_Table.tsv')
+    sample_table = pd.read_csv('Raw_Read_Table.tsv',sep='\t')
+    for read_file in list(sample_table['R1']) + list(sample_table['R2']) + ['Bench_DB.1.bt2']:
+        open(read_file,'w').close()
+    return lambda: virathon.calc_abundance('Bench.fasta','Bench_DB','NA','fastq',0,'sensitive',0,'Raw_Read_Table.tsv')
+
+def setup_print_results(virathon,scale,data_dir):
+    genomes = genome_names(scale)
+    rng = np.random.default_rng(args.seed)
+    set_seq_info(virathon,'Description',genomes,'Synthetic genome')
+    set_seq_info(virathon,'GC',genomes,rng.uniform(0.3,0.7,scale))
+    set_seq_info(virathon,'Length',genomes,np.full(scale,args.genes_per_genome * args.gene_length,dtype=np.int64))
+    set_seq_info(virathon,'Original_File',genomes,'Bench.fasta')
+    set_seq_info(virathon,'Gene_Count',genomes,np.full(scale,args.genes_per_genome,dtype=np.int64))
+    set_seq_info(virathon,'CDS_Count',genomes,np.full(scale,args.genes_per_genome,dtype=np.int64))
+    for data_file in ['CheckV_Summary.tsv','VIBRANT_Quality.tsv','VIBRANT_AMG.tsv']:
+        os.symlink(f'{data_dir}/{data_file}',data_file)
+    return lambda: virathon.print_results(virathon.seq_info,'NA','NA','VIBRANT_Quality.tsv','VIBRANT_AMG.tsv','CheckV_Summary.tsv','NA','Seq_Info.tsv','Bench.fasta','NA','NA')
+
+#Each benchmark has the function generating its dataset, the function setting up the measured call and the arguments given to Virathon
+benchmarks = {
+    'index_seqs': {'Generate': generate_index_seqs, 'Setup': setup_index_seqs, 'Args': []},
+    'make_pops': {'Generate': generate_make_pops, 'Setup': setup_make_pops, 'Args': ['--make_pops_module','True']},
+    'calc_recip_scores': {'Generate': generate_calc_recip_scores, 'Setup': setup_calc_recip_scores, 'Args': ['--pairwise_protein_scores','True']},
+    'parse_mmseqs_cluster_file': {'Generate': generate_parse_mmseqs_cluster_file, 'Setup': setup_parse_mmseqs_cluster_file, 'Args': []},
+    'parse_hmmer_output': {'Generate': generate_hmmer, 'Setup': setup_parse_hmmer_output, 'Args': []},
+    'write_hmmer_tables': {'Generate': generate_hmmer, 'Setup': setup_write_hmmer_tables, 'Args': []},
+    'calc_abundance': {'Generate': generate_calc_abundance, 'Setup': setup_calc_abundance, 'Args': ['--abundance_table','True','--abundance_rpkm','True']},
+    'print_results': {'Generate': generate_print_results, 'Setup': setup_print_results, 'Args': ['--call_vibrant_module','True','--call_checkv_module','True']},
+}
+
+if __name__ == '__main__':
+    central()
@@ -0,0 +1,50 @@
+import importlib.util
+import os
+import sys
+import numpy as np
+import pytest
+
+#Virathon parses its arguments when imported, so it is loaded with an empty command line
+@pytest.fixture(scope='module')
+def virathon():
+    argv = sys.argv
+    sys.argv = ['Virathon.py']
+    try:
+        spec = importlib.util.spec_from_file_location('Virathon',os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'Virathon.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.argv = argv
+    return module
+
+def test_categorical_column_accepts_numbers_and_nan(virathon):
+    seq_info = virathon.SeqInfoTable()
+    column = seq_info['Mixed']
+    column['A'] = 'foo'
+    column['B'] = 'bar'
+    column['C'] = np.nan
+    column['D'] = 3
+    column['E'] = 2.5
+    assert column['A'] == 'foo'
+    assert column['B'] == 'bar'
+    assert np.isnan(column['C'])
+    assert column['D'] == 3
+    assert column['E'] == 2.5
+    assert list(seq_info.to_dataframe()['Mixed'].astype(object).fillna('NA')) == ['foo','bar','NA',3,2.5]
+
+def test_categorical_column_bulk_assign_numbers(virathon):
+    seq_info = virathon.SeqInfoTable()
+    column = seq_info['Mixed']
+    column.assign(['A','B'],['foo','bar'])
+    column.assign(['C','D'],np.array([np.nan,3.0]))
+    column.assign(['E'],7)
+    assert [column.get(seq_id) for seq_id in ['A','B','D','E']] == ['foo','bar',3.0,7]
+    assert np.isnan(column['C'])
+
+def test_numeric_column_becomes_categorical(virathon):
+    seq_info = virathon.SeqInfoTable()
+    column = seq_info['Score']
+    column['A'] = 1
+    column['B'] = 2.5
+    column['C'] = 'high'
+    assert [column['A'],column['B'],column['C']] == [1.0,2.5,'high']